@@ -0,0 +1,7 @@
+"""
+Benchmarks processing synthetic workloads on a loopback cluster of a server and clients on localhost.
+
+Run from the repository root, e.g.:
+
+    python -m benchmarks.run --workload word_count --clients 4 --output results.json
+"""
@@ -0,0 +1,137 @@
+import multiprocessing
+import resource
+import threading
+import time
+
+from client import Client
+from server import Server
+
+
+def run_client(port, workers):
+    """
+    Connect a client to the benchmark server on localhost and process tasks until disconnected.
+
+    Args:
+        port (int): Server port number.
+        workers (int): Number of worker processes of the client.
+
+    Returns:
+        None
+    """
+    Client(workers, socket_map={}).connect_to_server("localhost", port)
+
+
+class LoopbackCluster(object):
+    """
+    LoopbackCluster runs a server and a number of clients on localhost, and measures a workload processed by them. The
+    server runs in the calling process, clients run in processes or threads of their own.
+
+    Clients run in threads share the interpreter lock with each other and with the server, so tasks of different
+    clients never run in parallel and the server is slowed down by them. Thread mode is meant for profiling the
+    protocol in one process; it's measurements are not comparable with those of process mode, and are marked as such.
+
+    Attributes:
+        clients (int): Number of clients.
+        mode (str): Run clients in "process"es or "thread"s.
+        workers (int): Number of worker processes of every client.
+        server_settings (dict): Server attribute name to value, set before running the server.
+    """
+    MODES = ("process", "thread")
+
+    def __init__(self, clients=2, mode="process", workers=0, server_settings=None):
+        """
+        Initialize loopback cluster.
+
+        Args:
+            clients (int): Number of clients.
+            mode (str): Run clients in "process"es or "thread"s.
+            workers (int): Number of worker processes of every client.
+            server_settings (dict/None): Server attribute name to value, set before running the server.
+        """
+        if mode not in LoopbackCluster.MODES:
+            raise ValueError("Unknown client mode: %s." % mode)
+
+        self.clients = clients
+        self.mode = mode
+        self.workers = workers
+        self.server_settings = server_settings or {}
+
+    def start_clients(self, port):
+        """
+        Start clients connecting to the server.
+
+        Args:
+            port (int): Server port number.
+
+        Returns:
+            [Process/Thread]: Started clients.
+        """
+        runner = multiprocessing.Process if self.mode == "process" else threading.Thread
+
+        clients = [runner(target=run_client, args=(port, self.workers)) for _ in xrange(self.clients)]
+        for client in clients:
+            client.start()
+
+        return clients
+
+    def run(self, workload):
+        """
+        Process workload on the cluster, measuring it.
+
+        Args:
+            workload (Workload): Workload to process.
+
+        Returns:
+            dict: Measurements of the run, in a JSON serializable format.
+        """
+        server = Server()
+        server.map = workload.map
+        server.reduce = workload.reduce
+        server.collect = workload.collect
+        server.data = workload.data
+        for name, value in self.server_settings.iteritems():
+            setattr(server, name, value)
+
+        # Clients are started once the server listens, connections wait in the backlog until the server runs.
+        port = server.bind_server("localhost", 0)
+
+        started = time.time()
+        clients = self.start_clients(port)
+        results = server.run_server()
+        seconds = time.time() - started
+
+        for client in clients:
+            client.join()
+
+        stats = server.metrics.snapshot()
+        counters = stats["counters"]
+        histograms = stats["histograms"]
+
+        def phase_seconds(phase):
+            histogram = histograms.get(phase + ".phase_seconds")
+            return histogram["sum"] if histogram else None
+
+        return {
+            "workload": workload.name,
+            "params": workload.params,
+            "clients": self.clients,
+            "mode": self.mode,
+            # Clients in threads share the interpreter lock with the server, see the class docstring.
+            "comparable": self.mode == "process",
+            "workers": self.workers,
+            "server_settings": self.server_settings,
+            "seconds": seconds,
+            "records": workload.records,
+            "input_bytes": workload.input_bytes,
+            "records_per_second": workload.records / seconds,
+            "input_bytes_per_second": workload.input_bytes / seconds,
+            "map_phase_seconds": phase_seconds("map"),
+            "reduce_phase_seconds": phase_seconds("reduce"),
+            "bytes_sent": counters.get("channel.bytes_sent", 0),
+            "bytes_received": counters.get("channel.bytes_received", 0),
+            # Maximum resident set size is reported in kilobytes on Linux.
+            "peak_memory_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            "result_keys": len(results) if results is not None else None,
+            "counters": counters,
+            "histograms": histograms
+        }
@@ -0,0 +1,143 @@
+import argparse
+import json
+import multiprocessing
+import sys
+
+from benchmarks.harness import LoopbackCluster
+from benchmarks.workloads import WORKLOADS
+
+
+def run_isolated(workload_name, scale, seed, cluster_settings):
+    """
+    Generate workload and run it on a loopback cluster in a fresh process, so peak memory is measured per run.
+
+    Args:
+        workload_name (str): Name of the workload.
+        scale (float): Size multiplier of the workload.
+        seed (int): Seed of the generated data.
+        cluster_settings (dict): Keyword arguments of the loopback cluster.
+
+    Returns:
+        dict: Measurements of the run.
+    """
+    queue = multiprocessing.Queue()
+
+    def run():
+        workload = WORKLOADS[workload_name](scale, seed)
+        measurements = LoopbackCluster(**cluster_settings).run(workload)
+        measurements["scale"] = scale
+        measurements["seed"] = seed
+        queue.put(measurements)
+
+    process = multiprocessing.Process(target=run)
+    process.start()
+    measurements = queue.get()
+    process.join()
+
+    return measurements
+
+
+def parse_arguments(arguments):
+    """
+    Parse command line arguments.
+
+    Args:
+        arguments ([str]): Command line arguments.
+
+    Returns:
+        argparse.Namespace
+    """
+    parser = argparse.ArgumentParser(description="Benchmark workloads on a loopback cluster.")
+    parser.add_argument("--workload", action="append", choices=sorted(WORKLOADS),
+                        help="Workload to run, may be repeated. Every workload is run if not given.")
+    parser.add_argument("--scale", type=float, default=1.0, help="Size multiplier of the workloads.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the generated data.")
+    parser.add_argument("--clients", type=int, default=2, help="Number of clients.")
+    parser.add_argument("--mode", choices=LoopbackCluster.MODES, default="process",
+                        help="Run clients in. Thread mode shares one interpreter lock with the server, so it's "
+                             "measurements are not comparable with process mode.")
+    parser.add_argument("--workers", type=int, default=0, help="Number of worker processes per client.")
+    parser.add_argument("--repeat", type=int, default=1, help="Number of runs of every workload.")
+    parser.add_argument("--task-window", type=int, help="Number of tasks in flight per client.")
+    parser.add_argument("--compression", action="append", help="Compression offered by the server, may be repeated.")
+    parser.add_argument("--no-columnar", action="store_true",
+                        help="Have clients send map results as dictionaries, never as columns.")
+    parser.add_argument("--peer-shuffle", action="store_true",
+                        help="Shuffle map outputs between clients, instead of through the server.")
+    parser.add_argument("--associative-reduce", action="store_true",
+                        help="Fold map results with the reduce function as they arrive.")
+    parser.add_argument("--early-reduce", action="store_true",
+                        help="Reduce partitions while the last map tasks finish.")
+    parser.add_argument("--merge-queue-size", type=int,
+                        help="Map results merged off the event loop at once, 0 to merge them on the event loop.")
+    parser.add_argument("--map-chunk-bytes", type=int,
+                        help="Estimated bytes of map task output sent per chunk, 0 to send map task output whole.")
+    parser.add_argument("--map-chunk-values", type=int, help="Maximum values of map task output sent per chunk.")
+    parser.add_argument("--map-chunk-window", type=int,
+                        help="Bytes of map output chunks a client may send without them being acknowledged.")
+    parser.add_argument("--output", help="File to write measurements to as JSON, standard output if not given.")
+
+    return parser.parse_args(arguments)
+
+
+def main(arguments):
+    """
+    Run benchmarks and write their measurements as a JSON list, one entry per run.
+
+    Args:
+        arguments ([str]): Command line arguments.
+
+    Returns:
+        None
+    """
+    options = parse_arguments(arguments)
+
+    server_settings = {}
+    if options.task_window is not None:
+        server_settings["task_window"] = options.task_window
+    if options.compression is not None:
+        server_settings["compressions"] = options.compression
+    if options.no_columnar:
+        server_settings["columnar"] = False
+    if options.peer_shuffle:
+        server_settings["peer_shuffle"] = True
+    if options.associative_reduce:
+        server_settings["associative_reduce"] = True
+    if options.early_reduce:
+        server_settings["early_reduce"] = True
+    if options.merge_queue_size is not None:
+        server_settings["merge_queue_size"] = options.merge_queue_size
+    if options.map_chunk_bytes is not None:
+        server_settings["map_chunk_bytes"] = options.map_chunk_bytes
+    if options.map_chunk_values is not None:
+        server_settings["map_chunk_values"] = options.map_chunk_values
+    if options.map_chunk_window is not None:
+        server_settings["map_chunk_window"] = options.map_chunk_window
+
+    cluster_settings = {
+        "clients": options.clients,
+        "mode": options.mode,
+        "workers": options.workers,
+        "server_settings": server_settings
+    }
+
+    runs = []
+    for workload_name in options.workload or sorted(WORKLOADS):
+        for _ in xrange(options.repeat):
+            measurements = run_isolated(workload_name, options.scale, options.seed, cluster_settings)
+            runs.append(measurements)
+
+            sys.stderr.write("%s: %.3fs, %.0f records/s\n" % (workload_name, measurements["seconds"],
+                                                              measurements["records_per_second"]))
+
+    output = open(options.output, "w") if options.output else sys.stdout
+    try:
+        json.dump(runs, output, indent=2, sort_keys=True)
+        output.write("\n")
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
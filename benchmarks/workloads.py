@@ -0,0 +1,167 @@
+import random
+
+# Map, reduce and collect functions are sent to clients as code, so they may only use builtins and what they import.
+
+
+def count_words_map(key, values):
+    for word in values.split():
+        yield (word, 1)
+
+
+def sum_reduce(key, values):
+    return sum(values)
+
+
+def sum_collect(key, values):
+    return [sum(values)]
+
+
+def unique_keys_map(key, values):
+    for token in values.split():
+        yield (token, 1)
+
+
+def large_values_map(key, values):
+    yield (key % 8, values)
+
+
+def total_length_reduce(key, values):
+    return sum(len(value) for value in values)
+
+
+def tiny_records_map(key, values):
+    yield (values, 1)
+
+
+class Workload(object):
+    """
+    Workload is a synthetic MapReduce job for benchmarking. Data is generated from a seed, so every run of a workload
+    with the same parameters processes the same data.
+
+    Attributes:
+        name (str): Workload name.
+        map (Function): Map function.
+        reduce (Function): Reduce function.
+        collect (Function/None): Collect function.
+        data (dict): MapReduce data.
+        params (dict): Parameters the data was generated with.
+        records (int): Number of input records.
+        input_bytes (int): Size of the input values in bytes.
+    """
+    def __init__(self, name, map, reduce, collect, data, params):
+        """
+        Initialize workload, measuring it's data.
+
+        Args:
+            name (str): Workload name.
+            map (Function): Map function.
+            reduce (Function): Reduce function.
+            collect (Function/None): Collect function.
+            data (dict): MapReduce data.
+            params (dict): Parameters the data was generated with.
+        """
+        self.name = name
+        self.map = map
+        self.reduce = reduce
+        self.collect = collect
+        self.data = data
+        self.params = params
+
+        self.records = len(data)
+        self.input_bytes = sum(len(value) for value in data.itervalues())
+
+
+def word_count(scale, seed):
+    """
+    Word count over synthetic text, with word frequencies following a power law like natural text.
+
+    Args:
+        scale (float): Size multiplier of the workload.
+        seed (int): Seed of the generated data.
+
+    Returns:
+        Workload
+    """
+    params = {"documents": int(200 * scale), "words_per_document": 1000, "vocabulary": 50000}
+    generator = random.Random(seed)
+
+    data = {}
+    for document in xrange(params["documents"]):
+        words = ("w%i" % (int(generator.paretovariate(1.0)) % params["vocabulary"])
+                 for _ in xrange(params["words_per_document"]))
+        data[document] = " ".join(words)
+
+    return Workload("word_count", count_words_map, sum_reduce, sum_collect, data, params)
+
+
+def high_cardinality(scale, seed):
+    """
+    Counting of keys which are almost all distinct, so map results hardly shrink when combined.
+
+    Args:
+        scale (float): Size multiplier of the workload.
+        seed (int): Seed of the generated data.
+
+    Returns:
+        Workload
+    """
+    params = {"records": int(200 * scale), "keys_per_record": 1000}
+    generator = random.Random(seed)
+
+    data = {}
+    for record in xrange(params["records"]):
+        data[record] = " ".join("%016x" % generator.getrandbits(64) for _ in xrange(params["keys_per_record"]))
+
+    return Workload("high_cardinality", unique_keys_map, sum_reduce, None, data, params)
+
+
+def large_values(scale, seed):
+    """
+    Few records with large values, which are passed on whole as map results.
+
+    Args:
+        scale (float): Size multiplier of the workload.
+        seed (int): Seed of the generated data.
+
+    Returns:
+        Workload
+    """
+    params = {"records": int(32 * scale), "value_size": 1024 * 1024}
+    generator = random.Random(seed)
+
+    data = {}
+    for record in xrange(params["records"]):
+        # Random bytes, so compressing the values does not hide their size.
+        bits = generator.getrandbits(8 * params["value_size"])
+        data[record] = ("%0*x" % (2 * params["value_size"], bits)).decode("hex")
+
+    return Workload("large_values", large_values_map, total_length_reduce, None, data, params)
+
+
+def tiny_records(scale, seed):
+    """
+    Many records with tiny values, where per task overhead dominates.
+
+    Args:
+        scale (float): Size multiplier of the workload.
+        seed (int): Seed of the generated data.
+
+    Returns:
+        Workload
+    """
+    params = {"records": int(50000 * scale), "vocabulary": 1000}
+    generator = random.Random(seed)
+
+    data = dict((record, "t%i" % generator.randint(0, params["vocabulary"] - 1))
+                for record in xrange(params["records"]))
+
+    return Workload("tiny_records", tiny_records_map, sum_reduce, sum_collect, data, params)
+
+
+# Workload name to function generating it from a scale and seed.
+WORKLOADS = {
+    "word_count": word_count,
+    "high_cardinality": high_cardinality,
+    "large_values": large_values,
+    "tiny_records": tiny_records
+}
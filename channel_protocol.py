@@ -1,25 +1,75 @@
 import asynchat
+import asyncore
+import collections
+import errno
 import logging
-import cPickle as pickle
+import socket
+import struct
+import time
+
+from payload_codec import PayloadCodec
 
 
 class ChannelProtocol(asynchat.async_chat):
     """
-    ChannelProtocol implements underlying structure for client and server channels. In particular, handling of
-    buffer terminator cases.
+    ChannelProtocol implements underlying structure for client and server channels. In particular, framing of commands
+    and their data on the connection.
 
-    Commands can contain pickled binary data after them. If data follows a command, a colon will separate the
-    command and the length of the following pickled data. In this case, the channel terminator will be changed
-    from a newline to 'until this number of bytes have been read'. After the data is read, the terminator will
-    return to it's default state.
+    Every command is sent as a frame made of a fixed size binary header followed by the command's encoded data, if it
+    exists. The header holds the command's opcode, flags, task id and the length of the following data. The flags
+    record the codec the data was encoded with. The channel first reads a header into a preallocated buffer, then
+    reads the data straight into a buffer allocated for its length, from which it is decoded without further copies.
 
     Attributes:
-        buffer ([str]): Buffer containing blocks of received data.
+        header_buffer (bytearray): Preallocated buffer for receiving frame headers.
+        receive_buffer (bytearray): Buffer frame header or data is currently received into.
+        receive_view (memoryview): View over receive_buffer, used to receive into it without copying.
+        received (int): Number of bytes of receive_buffer received so far.
         mid_command (str/None): Previous command while we are waiting on binary data associated to that command.
+        mid_flags (int): Header flags of the previous command while we are waiting on it's binary data.
+        task_id (int): Task id of the command being received or processed.
+        codec (PayloadCodec): Codec data of sent commands is encoded with.
+        bytes_sent (int): Number of bytes of frames sent.
+        bytes_received (int): Number of bytes of frames received.
+        metrics (Metrics/None): Metrics encoding and decoding times are recorded in, if any.
     """
 
-    COMMAND_SEPARATOR = ":"
-    DEFAULT_TERMINATOR = "\n"
+    # Opcode, flags, task id and data length.
+    HEADER = struct.Struct("!BBII")
+
+    # Commands by opcode. Opcodes are shared by clients and servers, so every command of either side is listed here.
+    COMMANDS = (
+        "disconnect",
+        "offer_codecs",
+        "accept_codecs",
+        "offer_function",
+        "request_function",
+        "set_function",
+        "map",
+        "reduce",
+        "map_done",
+        "reduce_done",
+        "set_task_window",
+        "end_job",
+        "set_broadcast",
+        "set_job_broadcasts",
+        "drop_broadcast",
+        "stats",
+        "set_job_shuffle",
+        "set_shuffle_address",
+        "fetch_partition",
+        "partition_data",
+        "set_map_chunking",
+        "map_chunk",
+        "ack_chunk",
+        "task_started",
+        "reduce_input",
+        "shuffle_token"
+    )
+    OPCODES = dict((command, opcode) for opcode, command in enumerate(COMMANDS))
+
+    # Send data in larger blocks than asynchat's default, as frames tend to be large.
+    ac_out_buffer_size = 65536
 
     def __init__(self, connection=None, socket_map=None):
         """
@@ -31,80 +81,206 @@ class ChannelProtocol(asynchat.async_chat):
         """
         asynchat.async_chat.__init__(self, sock=connection, map=socket_map)
 
-        self.set_terminator(ChannelProtocol.DEFAULT_TERMINATOR)
+        self.header_buffer = bytearray(ChannelProtocol.HEADER.size)
+        self.receive_buffer = None
+        self.receive_view = None
+        self.received = 0
 
-        self.buffer = []
         self.mid_command = None
+        self.mid_flags = 0
+        self.task_id = 0
+
+        self.codec = PayloadCodec()
+
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.metrics = None
 
-    def collect_incoming_data(self, data):
+        self.expect_header()
+
+    def set_socket(self, sock, map=None):
         """
-        Append data to channel protocol buffer once it has been received.
+        Set channel socket, disabling Nagle's algorithm on it so headers and small frames are sent without delay.
 
         Args:
-            data (str): Incoming data.
+            sock (socket): Socket of the channel.
+            map (map[socket]): Socket map to which to be added to, if exists.
 
         Returns:
             None
         """
-        self.buffer.append(data)
+        asynchat.async_chat.set_socket(self, sock, map)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def expect_header(self):
+        """
+        Set channel protocol to receive the next frame header.
+
+        Returns:
+            None
+        """
+        self.receive_buffer = self.header_buffer
+        self.receive_view = memoryview(self.header_buffer)
+        self.received = 0
+
+    def expect_data(self, data_length):
+        """
+        Set channel protocol to receive data of given length into a newly allocated buffer.
+
+        Args:
+            data_length (int): Length of the data following current header.
+
+        Returns:
+            None
+        """
+        self.receive_buffer = bytearray(data_length)
+        self.receive_view = memoryview(self.receive_buffer)
+        self.received = 0
+
+    def handle_read(self):
+        """
+        Receive as much of the incoming frames as is available, processing every frame once it is complete.
+
+        Returns:
+            None
+        """
+        while self.connected:
+            try:
+                received = self.socket.recv_into(self.receive_view[self.received:])
+            except socket.error as why:
+                if why.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                    return
+                if why.args[0] in asyncore._DISCONNECTED:
+                    self.handle_close()
+                    return
+                raise
+
+            if not received:  # Connection has been closed by the other side.
+                self.handle_close()
+                return
+
+            self.received += received
+            self.bytes_received += received
+            if self.received == len(self.receive_buffer):
+                self.found_terminator()
 
     def found_terminator(self):
         """
-        Process data in buffer after terminator has been found.
+        Process buffer after a whole frame header or frame data has been received.
 
         There are two possible cases for received buffer data:
-            1. Either a new command has been received, which may be followed by it's binary data.
+            1. Either a new command header has been received, which may be followed by it's binary data.
             2. Binary data for the previous command.
 
         Returns:
             None
         """
-        buffer_data = ''.join(self.buffer)
-        self.buffer[:] = []
-
         if self.mid_command is not None:
-            # Unpickle data and process command
             command = self.mid_command
-            data = pickle.loads(buffer_data)
+            payload = self.receive_buffer
 
             # Reset channel protocol state.
             self.mid_command = None
-            self.set_terminator(ChannelProtocol.DEFAULT_TERMINATOR)
+            self.expect_header()
 
-            self.process_command(command, data)
+            self.process_payload(command, self.mid_flags, payload)
         else:
-            command, data_length = buffer_data.split(ChannelProtocol.COMMAND_SEPARATOR)
+            opcode, flags, self.task_id, data_length = ChannelProtocol.HEADER.unpack_from(self.header_buffer)
+            command = ChannelProtocol.COMMANDS[opcode]
 
             if data_length:  # Binary data follows current command.
                 self.mid_command = command
-                self.set_terminator(int(data_length))
+                self.mid_flags = flags
+                self.expect_data(data_length)
             else:
+                self.expect_header()
                 self.process_command(command)
 
-    def send_command(self, command, data=None):
+    def process_payload(self, command, flags, payload):
         """
-        Send command, optionally with according data. Pickling the data in case it exists.
+        Decode data of a command straight from the buffer it was received into, and process the command. Subclasses
+        may hand data of some commands elsewhere to be decoded, instead of decoding it on the event loop.
+
+        Args:
+            command (str): Command the data belongs to.
+            flags (int): Header flags of the command, recording the codec the data was encoded with.
+            payload (bytearray): Encoded data.
+
+        Returns:
+            None
+        """
+        if self.metrics is not None:
+            started = time.time()
+            data = PayloadCodec.decode(flags, payload)
+            self.metrics.observe("decode.seconds", time.time() - started)
+        else:
+            data = PayloadCodec.decode(flags, payload)
+
+        self.process_command(command, data)
+
+    def send_command(self, command, data=None, task_id=0):
+        """
+        Send command, optionally with according data. Encoding the data with the channel codec in case it exists.
 
         Args:
             command (str): Command to send.
             data (None/str): Data to follow command, if it exists.
+            task_id (int): Id of the task the command belongs to, if any.
+
+        Returns:
+            None
+        """
+        for frame in self.encode_command(command, data, task_id):
+            self.push(frame)
+
+    def send_commands_lazily(self, commands, task_id=0):
+        """
+        Send commands produced lazily, each being produced and encoded only once the connection is done sending the
+        ones before it, so their data is never held as a whole. Commands sent afterwards follow the last of them.
+
+        Args:
+            commands (iterable): (command, data) tuples to send, in order.
+            task_id (int): Id of the task the commands belong to, if any.
 
         Returns:
             None
         """
-        # Add command separator if does not exist due to how commands are parsed.
-        if ChannelProtocol.COMMAND_SEPARATOR not in command:
-            command += ChannelProtocol.COMMAND_SEPARATOR
+        self.push_with_producer(CommandProducer(self, commands, task_id))
+
+    def encode_command(self, command, data=None, task_id=0):
+        """
+        Encode command into a frame, optionally with according data. Encoding the data with the channel codec in case
+        it exists.
+
+        Args:
+            command (str): Command to encode.
+            data (None/str): Data to follow command, if it exists.
+            task_id (int): Id of the task the command belongs to, if any.
+
+        Returns:
+            [str]: Parts of the frame, in order.
+        """
+        opcode = ChannelProtocol.OPCODES[command]
 
         if data is not None:
-            pickled_data = pickle.dumps(data)
-            command += str(len(pickled_data))
+            if self.metrics is not None:
+                started = time.time()
+                flags, encoded_data = self.codec.encode(data)
+                self.metrics.observe("encode.seconds", time.time() - started)
+            else:
+                flags, encoded_data = self.codec.encode(data)
+            header = ChannelProtocol.HEADER.pack(opcode, flags, task_id, len(encoded_data))
+            self.bytes_sent += len(header) + len(encoded_data)
 
-            logging.debug("Sending command with data: %s." % command)
-            self.push(command + ChannelProtocol.DEFAULT_TERMINATOR + pickled_data)
+            logging.debug("Sending command with data: %s:%i.", command, len(encoded_data))
+            if len(encoded_data) < self.ac_out_buffer_size:
+                return [header + encoded_data]
+            else:  # Avoid copying large data into a single frame.
+                return [header, encoded_data]
         else:
-            logging.debug("Sending command: %s." % command)
-            self.push(command + ChannelProtocol.DEFAULT_TERMINATOR)
+            logging.debug("Sending command: %s.", command)
+            self.bytes_sent += ChannelProtocol.HEADER.size
+            return [ChannelProtocol.HEADER.pack(opcode, 0, task_id, 0)]
 
     def process_command(self, command, data=None):
         """
@@ -122,7 +298,7 @@ class ChannelProtocol(asynchat.async_chat):
         if command in commands:
             commands[command](command, data)
         else:
-            logging.error("Command does not exist: %s." % command)
+            logging.error("Command does not exist: %s.", command)
             raise NotImplementedError("This command does not exist: %s." % command)
 
     def handle_close(self):
@@ -133,3 +309,46 @@ class ChannelProtocol(asynchat.async_chat):
              None
         """
         self.close()
+
+
+class CommandProducer(object):
+    """
+    CommandProducer is an asynchat producer of frames of commands produced lazily. Asynchat asks it for more data only
+    once everything queued before it has been sent, so each command is produced and encoded only when the connection
+    is ready for it.
+
+    Attributes:
+        channel (ChannelProtocol): Channel the commands are sent on, encoding them.
+        commands (iterator): (command, data) tuples still to send.
+        task_id (int): Id of the task the commands belong to.
+        frame_parts (deque): Parts of the frame of the last encoded command not handed to asynchat yet.
+    """
+
+    def __init__(self, channel, commands, task_id):
+        """
+        Initialize command producer.
+
+        Args:
+            channel (ChannelProtocol): Channel the commands are sent on, encoding them.
+            commands (iterable): (command, data) tuples to send, in order.
+            task_id (int): Id of the task the commands belong to.
+        """
+        self.channel = channel
+        self.commands = iter(commands)
+        self.task_id = task_id
+        self.frame_parts = collections.deque()
+
+    def more(self):
+        """
+        Get next part of a frame to send, encoding the next command once the last one's frame has been handed out.
+
+        Returns:
+            str: Part of a frame, or an empty string once every command has been sent.
+        """
+        if not self.frame_parts:
+            command = next(self.commands, None)
+            if command is None:
+                return ""
+            self.frame_parts.extend(self.channel.encode_command(command[0], command[1], self.task_id))
+
+        return self.frame_parts.popleft()
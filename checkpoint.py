@@ -0,0 +1,104 @@
+import logging
+import os
+import cPickle as pickle
+
+
+class Checkpoint(object):
+    """
+    Checkpoint is an append-only write-ahead log of a job's finished tasks, from which the job's progress is restored
+    after the server restarts. Every event is pickled onto the end of the log and flushed, so it survives the server
+    process dying. The log is synced to disk periodically, so it survives the machine going down as of the last sync.
+
+    A record cut short by the server dying while appending it is dropped when the log is replayed, and the log is
+    truncated after the last whole record so further events can be appended.
+
+    Attributes:
+        path (str): Path of the log.
+        file (file/None): Log, while open for appending.
+    """
+    def __init__(self, path):
+        """
+        Initialize checkpoint.
+
+        Args:
+            path (str): Path of the log.
+        """
+        self.path = path
+        self.file = None
+
+    def replay(self):
+        """
+        Lazily read every whole event of the log, truncating the log after the last of them.
+
+        Returns:
+            Generator of events (tuple).
+        """
+        if not os.path.exists(self.path):
+            return
+
+        with open(self.path, "rb") as f:
+            while True:
+                offset = f.tell()
+                try:
+                    event = pickle.load(f)
+                except EOFError:
+                    break
+                except (pickle.UnpicklingError, ValueError, IndexError, KeyError, AttributeError, ImportError):
+                    logging.warning("Dropping incomplete checkpoint record at offset %i of %s.", offset, self.path)
+                    break
+
+                yield event
+
+        if offset < os.path.getsize(self.path):
+            with open(self.path, "r+b") as f:
+                f.truncate(offset)
+
+    def open(self):
+        """
+        Open log for appending, creating it's directory if it does not exist.
+
+        Returns:
+            None
+        """
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.file = open(self.path, "ab")
+
+    def append(self, event):
+        """
+        Append event to the log, flushing it to the operating system.
+
+        Args:
+            event (tuple): Event, starting with it's name.
+
+        Returns:
+            None
+        """
+        pickle.dump(event, self.file, pickle.HIGHEST_PROTOCOL)
+        self.file.flush()
+
+    def sync(self):
+        """
+        Sync appended events to disk.
+
+        Returns:
+            None
+        """
+        if self.file is not None:
+            os.fsync(self.file.fileno())
+
+    def remove(self):
+        """
+        Close and remove the log, once the job is done.
+
+        Returns:
+            None
+        """
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -1,32 +1,157 @@
-import asyncore
+import collections
+import event_loop
 import logging
-import marshal
+import multiprocessing
+import os
+import shutil
 import socket
-import types
+import task_runner
+import tempfile
+import cPickle as pickle
 
 from channel_protocol import ChannelProtocol
+from columnar import ColumnarResults
+from function_cache import FunctionCache
+from map_stream import MapStream, SpooledMapStream
+from payload_codec import PayloadCodec
+from peer_shuffle import MapOutputStore, PartitionFetch, ShuffleEndpoint, merge_outputs
 
 
 class Client(ChannelProtocol):
     """
-    Client connects to server. After which immediately receives MapReduce functions to be used for current job. After
-    functions have been loaded, client will process multiple independent map/reduce jobs; sending results back
-    to the server every time.
+    Client connects to server. Before the first task of every job, it is offered the MapReduce functions to be used
+    for that job. After functions have been loaded, client will process multiple independent map/reduce tasks of the
+    job; sending results back to the server every time. Every task carries the id of it's job, so tasks of several jobs
+    may be processed side by side. Functions of a job are dropped once the server ends the job.
+
+    Functions are offered by the digest of their code, and kept in a function cache. The client only asks the server
+    for the code of functions it does not have cached, and holds back tasks of the job until their code arrives.
+
+    Broadcast values are received once per version, and exposed to the functions of every job as the broadcasts
+    dictionary, holding the versions seen by the job. Each job's functions are bound to globals of their own holding
+    it's broadcasts, so nothing is shared between jobs or between clients in one process. With workers, broadcast
+    values are written to files which workers read each version of once.
+
+    The server may send several tasks ahead of time. These are queued, and one task is processed each time the
+    connection is ready for writing so results are sent while the remaining tasks wait.
+
+    With workers, tasks are instead handed to a pool of worker processes as soon as a worker is free, and the
+    connection is serviced while they are processed. The pool is started once the first task arrives, and kept for
+    every following job; workers build the functions of a job once, on their first task of the job. The client asks
+    the server to keep enough tasks in flight to keep every worker busy.
+
+    The client tells the server when it starts each task, so the server measures how long tasks run without the time
+    they waited in the client's queue.
+
+    Once the server sets how to chunk map task output, the output of map tasks is sent in chunks of a bounded estimated
+    size, each sent as soon as it is full, followed by the rest of the output when the task finishes. Map tasks run in
+    the client process are run a chunk at a time, each time the connection is ready for writing, so their output is
+    never held as a whole. The client stops producing chunks while the server has not acknowledged a window of chunk
+    bytes, and queued tasks wait until the output being sent is done. With workers, worker processes write the output of
+    map tasks to a file a chunk at a time, notifying the client of each chunk, and the client reads it back a chunk at a
+    time as it is sent, while the map task is still running, so neither holds the output as a whole. Only the output of
+    a batch map function is held whole, as it is returned at once.
+
+    The map outputs of a reduce task's partition are sent by the server in frames ahead of the task, and gathered until
+    the task itself arrives.
+
+    Map results whose values are all ints or all floats are sent as ColumnarResults, if the server accepts them, so
+    their values are sent as raw typed buffers instead of being pickled one by one.
+
+    For jobs with a peer to peer shuffle, outputs of map tasks are kept by the client instead of being sent to the
+    server, which is only told which partitions they hold. The client serves them to peers from a shuffle endpoint,
+    started on the first such job. Reduce tasks of these jobs name the peers holding the partition's outputs, which
+    are fetched from them before the task is processed. Peers only serve and fetch outputs of a job along with the
+    job's shuffle token, which the server hands to the clients it gives tasks of the job.
 
     Attributes:
-        map_fn (func): Map function.
-        collect_fn (func): Collect function.
-        reduce_fn (func): Reduce function.
+        functions (dict): Job id to the job's loaded functions by name, "map" or "batch_map", "reduce" or "collect".
+        function_globals (dict): Job id to the globals the job's functions are bound to.
+        function_codes (dict): Job id to binary versions of the job's loaded functions by name, to be built in worker
+            processes.
+        function_cache (FunctionCache): Functions received from servers, by the digest of their code.
+        missing_functions (dict): Job id to names of the job's functions whose code has been asked for.
+        deferred_tasks (deque): Tasks of jobs with missing functions, as (command, data, task id) tuples.
+        broadcasts (dict): Broadcast (name, version) to value.
+        job_broadcasts (dict): Job id to broadcast name to the version seen by the job.
+        broadcast_directory (str/None): Directory of broadcast value files read by worker processes, once created.
+        task_queue (deque): Received tasks waiting to be processed, as (command, data, task id) tuples.
+        reduce_inputs (dict): Task id of reduce tasks being received to the map outputs of their partition received so
+            far.
+        current_task_id (int): Task id of the task being processed.
+        workers (int): Number of worker processes, or 0 to process tasks in the client process.
+        pool (multiprocessing.Pool/None): Pool of worker processes, once started.
+        pool_queue (deque): Tasks waiting for a free worker process, as (command, data, task id) tuples.
+        pool_tasks (int): Number of tasks handed to the worker pool which have not finished yet.
+        finished_tasks (deque): Tasks finished by worker processes waiting to be sent, as (command, task id, job id,
+            task key, spool path, (succeeded, results)) tuples.
+        spool_directory (str/None): Directory of files worker processes write chunks of map task output to, once
+            created.
+        spooled_tasks (int): Number of map tasks whose output is written to files, used to name the files.
+        task_notifier (TaskNotifier/None): Wakes up the event loop when worker processes finish tasks.
+        job_shuffles (dict): Job id of jobs with a peer to peer shuffle to their number of reduce partitions.
+        map_outputs (MapOutputStore): Outputs of finished map tasks of jobs with a peer to peer shuffle.
+        shuffle_endpoint (ShuffleEndpoint/None): Endpoint serving map outputs to peers, once started.
+        fetches (set): PartitionFetches of reduce tasks in progress.
+        map_chunk_bytes (int): Estimated encoded size in bytes of a chunk of a map task's output, or 0 to send the
+            output whole.
+        map_chunk_values (int): Maximum number of values of a chunk of a map task's output, whatever their size.
+        map_chunk_window (int): Number of bytes of chunks which may be sent without being acknowledged by the server.
+        unacked_bytes (int): Number of bytes of chunks sent which the server has not acknowledged yet.
+        map_streams (deque): MapStreams, or SpooledMapStreams with workers, of map tasks whose output is being sent in
+            chunks, sent one after another. SpooledMapStreams are added as their map tasks are handed to the workers.
     """
-    def __init__(self):
+    # Tasks kept in flight per worker process, so workers do not wait on the server between tasks.
+    TASKS_PER_WORKER = 2
+
+    def __init__(self, workers=0, function_cache_directory=None, socket_map=None):
         """
         Initialize client and it's parent class.
-        """
-        ChannelProtocol.__init__(self)
 
-        self.map_fn = None
-        self.reduce_fn = None
-        self.collect_fn = None
+        Args:
+            workers (int): Number of worker processes, or 0 to process tasks in the client process.
+            function_cache_directory (str/None): Directory to keep received functions in across restarts, or None to
+                only keep them in memory.
+            socket_map (map[socket]): Socket map to run the client on, asyncore's global socket map if not given.
+                Clients share no state, so several can run in threads of one process on socket maps of their own,
+                though they then share one interpreter lock.
+        """
+        ChannelProtocol.__init__(self, socket_map=socket_map)
+
+        self.functions = {}
+        self.function_globals = {}
+        self.function_codes = {}
+        self.function_cache = FunctionCache(directory=function_cache_directory)
+        self.missing_functions = {}
+        self.deferred_tasks = collections.deque()
+
+        self.broadcasts = {}
+        self.job_broadcasts = {}
+        self.broadcast_directory = None
+
+        self.task_queue = collections.deque()
+        self.reduce_inputs = {}
+        self.current_task_id = 0
+
+        self.workers = workers
+        self.pool = None
+        self.pool_queue = collections.deque()
+        self.pool_tasks = 0
+        self.finished_tasks = collections.deque()
+        self.task_notifier = None
+        self.spool_directory = None
+        self.spooled_tasks = 0
+
+        self.job_shuffles = {}
+        self.map_outputs = MapOutputStore()
+        self.shuffle_endpoint = None
+        self.fetches = set()
+
+        self.map_chunk_bytes = 0
+        self.map_chunk_values = 0
+        self.map_chunk_window = 0
+        self.unacked_bytes = 0
+        self.map_streams = collections.deque()
 
     def connect_to_server(self, server_address, server_port):
         """
@@ -42,9 +167,13 @@ class Client(ChannelProtocol):
         self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
         self.connect((server_address, server_port))
 
-        logging.info("Client connected to server at address %s:%s." % (server_address, server_port))
+        logging.info("Client connected to server at address %s:%s.", server_address, server_port)
 
-        asyncore.loop()
+        if self.workers:
+            self.task_notifier = task_runner.TaskNotifier(self.send_finished_tasks, self._map)
+            self.send_command("set_task_window", self.workers * Client.TASKS_PER_WORKER)
+
+        event_loop.loop(self._map)
 
     def process_command(self, command, data=None):
         """
@@ -60,14 +189,22 @@ class Client(ChannelProtocol):
         Returns:
             None or NotImplementedError if command does not exist in both client and channel protocol functions.
         """
-        logging.debug("Attempting to process command: %s." % command)
+        logging.debug("Attempting to process command: %s.", command)
 
         commands = {
-            "set_map": self.set_map,
-            "set_reduce": self.set_reduce,
-            "set_collect": self.set_collect,
-            "map": self.map,
-            "reduce": self.reduce
+            "offer_codecs": self.offer_codecs,
+            "offer_function": self.offer_function,
+            "set_function": self.set_function,
+            "end_job": self.end_job,
+            "set_broadcast": self.set_broadcast,
+            "set_job_broadcasts": self.set_job_broadcasts,
+            "drop_broadcast": self.drop_broadcast,
+            "set_job_shuffle": self.set_job_shuffle,
+            "set_map_chunking": self.set_map_chunking,
+            "ack_chunk": self.ack_chunk,
+            "map": self.queue_task,
+            "reduce": self.queue_task,
+            "reduce_input": self.add_reduce_input
         }
 
         if command in commands:
@@ -75,91 +212,651 @@ class Client(ChannelProtocol):
         else:
             ChannelProtocol.process_command(self, command, data)
 
+    def queue_task(self, command, data):
+        """
+        Queue map or reduce task to be processed once the connection is ready for writing, along with it's task id
+        so results can be sent back under the same id. With workers, the task is handed to the worker pool instead.
+        Tasks of a job whose functions are missing are held back until the functions arrive.
+
+        Args:
+            command (str): Task command, "map" or "reduce".
+            data (tuple): Task data.
+
+        Returns:
+            None
+        """
+        if command == "reduce" and self.task_id in self.reduce_inputs:
+            self.add_reduce_input(command, data)
+            data = data[:2] + (self.reduce_inputs.pop(self.task_id),)
+
+        if data[0] in self.missing_functions:
+            self.deferred_tasks.append((command, data, self.task_id))
+        else:
+            self.start_task(command, data, self.task_id)
+
+    def add_reduce_input(self, command, data):
+        """
+        Gather map outputs of a reduce task's partition, sent ahead of the task. Values of a key may be split across
+        several frames.
+
+        Args:
+            command (str): Command currently being processed.
+            data (tuple): Job id, partition number and mapped keys of the partition and their values.
+
+        Returns:
+            None
+        """
+        partition_data = self.reduce_inputs.setdefault(self.task_id, {})
+
+        for key, values in data[2].iteritems():
+            if key in partition_data:
+                partition_data[key].extend(values)
+            else:
+                partition_data[key] = values
+
+    def start_task(self, command, data, task_id):
+        """
+        Queue task, or queue it for the worker pool with workers. Reduce tasks of jobs with a peer to peer shuffle
+        are started once their data has been fetched from peers.
+
+        Args:
+            command (str): Task command, "map" or "reduce".
+            data (tuple): Task data.
+            task_id (int): Task id to send results back under.
+
+        Returns:
+            None
+        """
+        if command == "reduce" and data[0] in self.job_shuffles:
+            self.fetch_partition(data, task_id)
+        elif self.workers:
+            self.pool_queue.append((command, data, task_id))
+            self.submit_tasks()
+        else:
+            self.task_queue.append((command, data, task_id))
+
+    def submit_tasks(self):
+        """
+        Hand tasks waiting for the worker pool to it, while there are free worker processes. Tasks are only handed over
+        once a worker is free, so they start right away.
+
+        Returns:
+            None
+        """
+        while self.pool_queue and self.pool_tasks < self.workers:
+            self.submit_task(*self.pool_queue.popleft())
+
+    def submit_task(self, command, data, task_id):
+        """
+        Hand map or reduce task to the worker pool, starting the pool if it has not been started yet, and tell the
+        server the task started. If map task output is sent in chunks, the worker writes the output of a map task to a
+        file in chunks.
+
+        Args:
+            command (str): Task command, "map" or "reduce".
+            data (tuple): Task data, starting with the job id.
+            task_id (int): Task id to send results back under.
+
+        Returns:
+            None
+        """
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.workers)
+
+        job_id = data[0]
+
+        spool_path = None
+        if command == "map" and self.map_chunk_bytes and job_id not in self.job_shuffles:
+            if self.spool_directory is None:
+                self.spool_directory = tempfile.mkdtemp(prefix="map-output-")
+            spool_path = os.path.join(self.spool_directory, "%i.chunks" % self.spooled_tasks)
+            self.spooled_tasks += 1
+
+        def task_finished(result):
+            # Called on a worker pool thread, hand results over to the event loop.
+            self.finished_tasks.append((command, task_id, job_id, data[1], spool_path, result))
+            self.task_notifier.notify()
+
+        broadcast_files = dict((name, (version, self.broadcast_path(name, version)))
+                               for name, version in self.job_broadcasts.get(job_id, {}).iteritems())
+
+        chunk_bytes = self.map_chunk_bytes if spool_path is not None else 0
+        self.pool.apply_async(task_runner.run_task,
+                              (command, job_id, self.function_codes[job_id], broadcast_files, data[1:], chunk_bytes,
+                               self.map_chunk_values, spool_path, self.task_notifier.write_fd),
+                              callback=task_finished)
+        if spool_path is not None:
+            # Chunks are sent as the worker writes them.
+            self.map_streams.append(SpooledMapStream(job_id, data[1], task_id, spool_path))
+        self.pool_tasks += 1
+        self.send_command("task_started", task_id=task_id)
+
+    def send_finished_tasks(self):
+        """
+        Send results of tasks finished by worker processes to server. A failed task closes the client, like an exception
+        raised while processing a task in the client process does. Tasks of jobs the server has ended are dropped, as
+        their results are no longer needed. Map tasks whose output is written to a file in chunks finish once every
+        chunk has been sent. Freed workers are handed waiting tasks.
+
+        Returns:
+            None
+        """
+        while self.finished_tasks:
+            command, task_id, job_id, key, spool_path, (succeeded, results) = self.finished_tasks.popleft()
+            self.pool_tasks -= 1
+
+            if not succeeded:
+                if job_id not in self.functions:
+                    continue
+
+                logging.error("Worker failed to process %s task:\n%s", command, results)
+                self.handle_close()
+                return
+
+            if spool_path is not None:
+                self.finish_spooled_stream(task_id, spool_path, results)
+            elif job_id not in self.functions:
+                continue
+            elif command == "map":
+                self.send_map_results(job_id, key, results, task_id)
+            else:
+                self.send_command("reduce_done", (job_id, key, results), task_id)
+
+        self.submit_tasks()
+
+    def finish_spooled_stream(self, task_id, spool_path, chunks):
+        """
+        Record the number of chunks a worker process wrote for a map task, so it's stream finishes once they have all
+        been sent. The file is removed if the stream has been dropped meanwhile, as the worker may have created it
+        afterwards.
+
+        Args:
+            task_id (int): Task id of the map task.
+            spool_path (str): Path of the file holding the chunks.
+            chunks (int): Number of chunks written.
+
+        Returns:
+            None
+        """
+        for stream in self.map_streams:
+            if stream.task_id == task_id:
+                stream.finish(chunks)
+                return
+
+        try:
+            os.remove(spool_path)
+        except OSError:
+            pass
+
+    def run_next_task(self):
+        """
+        Process the oldest queued task, telling the server it started.
+
+        Returns:
+            None
+        """
+        tasks = {
+            "map": self.map,
+            "reduce": self.reduce
+        }
+
+        command, data, self.current_task_id = self.task_queue.popleft()
+        self.send_command("task_started", task_id=self.current_task_id)
+        tasks[command](command, data)
+
+    def writable(self):
+        """
+        Client is writable while there are queued tasks, or map output ready to send in chunks within the window of
+        unacknowledged bytes, in addition to when there is data left to send.
+
+        Returns:
+            Bool whether client should be checked for writing.
+        """
+        if self.map_streams:
+            return (self.unacked_bytes < self.map_chunk_window and self.map_streams[0].ready()) or \
+                ChannelProtocol.writable(self)
+
+        return len(self.task_queue) > 0 or ChannelProtocol.writable(self)
+
+    def handle_write(self):
+        """
+        Send the next chunk of map output if the window of unacknowledged bytes allows, or else process one queued
+        task, then send as much pending data as possible.
+
+        Returns:
+            None
+        """
+        if self.map_streams:
+            if self.unacked_bytes < self.map_chunk_window and self.map_streams[0].ready():
+                self.send_map_chunk()
+        elif self.task_queue:
+            self.run_next_task()
+
+        ChannelProtocol.handle_write(self)
+
+    def send_map_chunk(self):
+        """
+        Send the next chunk of the output being sent in chunks, running the map task until the chunk is full. Once the
+        output is exhausted, the rest of it is sent as the map task's results.
+
+        Returns:
+            None
+        """
+        stream = self.map_streams[0]
+        stream.step()
+
+        if stream.finished:
+            self.map_streams.popleft()
+            self.send_command("map_done", (stream.job_id, stream.key, self.compact_results(stream.take_chunk())),
+                              stream.task_id)
+        else:
+            sent = self.bytes_sent
+            self.send_command("map_chunk", (stream.job_id, stream.key, self.compact_results(stream.take_chunk())),
+                              stream.task_id)
+            self.unacked_bytes += self.bytes_sent - sent
+
     def map(self, command, data):
         """
-        Map given data based on loaded map function and send results to server.
+        Map given data based on loaded map function and send results to server. If a collect function has been
+        loaded, the values of each key are combined by it before being sent. If the server has set how to chunk map
+        task output, the map task is run as it's output is sent in chunks instead.
 
         Args:
             command (str): Command being processed, not relevant to current mapping process.
-            data (str): Data being mapped.
+            data (tuple): Job id, map key and data being mapped.
+
+        Returns:
+            None
+        """
+        logging.debug("Mapping %s.", data[1])
+        functions = self.functions[data[0]]
+
+        if self.map_chunk_bytes and data[0] not in self.job_shuffles:
+            pairs, grouped = task_runner.map_output(functions, data[1:])
+            self.map_streams.append(MapStream(data[0], data[1], self.current_task_id, pairs, grouped,
+                                              functions.get("collect"), self.map_chunk_bytes, self.map_chunk_values))
+            return
+
+        results = task_runner.map_with(functions, data[1:])
+
+        self.send_map_results(data[0], data[1], results, self.current_task_id)
+
+    def send_map_results(self, job_id, key, results, task_id):
+        """
+        Send results of a map task to server. For jobs with a peer to peer shuffle, the results are kept for peers to
+        fetch, and only the numbers of the partitions they hold are sent.
+
+        Args:
+            job_id (int): Job id.
+            key: Key of the map task.
+            results (dict/ColumnarResults): Mapped keys and their values.
+            task_id (int): Task id to send results back under.
+
+        Returns:
+            None
+        """
+        if job_id in self.job_shuffles:
+            results = self.map_outputs.add(job_id, key, results, self.job_shuffles[job_id])
+        else:
+            results = self.compact_results(results)
+
+        self.send_command("map_done", (job_id, key, results), task_id)
+
+    def compact_results(self, results):
+        """
+        Convert map results to ColumnarResults, if the server accepts them and the values are all ints or all floats.
+        Results already in columns are converted back to a dictionary if the server does not accept them.
+
+        Args:
+            results (dict/ColumnarResults): Mapped keys and their values.
+
+        Returns:
+            dict/ColumnarResults: Map results to send.
+        """
+        if isinstance(results, ColumnarResults):
+            return results if self.codec.columnar else results.to_dict()
+
+        if not self.codec.columnar:
+            return results
+
+        columns = ColumnarResults.from_dict(results)
+        return columns if columns is not None else results
+
+    def fetch_partition(self, data, task_id):
+        """
+        Fetch map outputs of a reduce task's partition from the peers holding them. Fetching is part of running the
+        task, so the server is told the task started.
+
+        Args:
+            data (tuple): Job id, partition number and dictionary of peer shuffle address to keys of the map tasks
+                whose outputs it holds.
+            task_id (int): Task id to send results back under.
+
+        Returns:
+            None
+        """
+        job_id, partition, sources = data
+        logging.debug("Fetching partition %s from %i peers.", partition, len(sources))
+
+        self.send_command("task_started", task_id=task_id)
+
+        fetch = PartitionFetch(job_id, partition, task_id, self.map_outputs.tokens[job_id], self.partition_fetched)
+        self.fetches.add(fetch)
+        fetch.start(sources, self.codec, self._map)
+
+    def partition_fetched(self, fetch, outputs):
+        """
+        Start reduce task whose partition has been fetched from peers. If fetching failed, the server is sent no
+        results for the task, along with the peers which no longer hold their outputs, so it can hand the task out
+        again, recreating those outputs first.
+
+        Args:
+            fetch (PartitionFetch): Finished fetch.
+            outputs ([dict/ColumnarResults]/None): Fetched outputs per map task, or None if fetching failed.
 
         Returns:
             None
         """
-        logging.debug("Mapping %s." % data[0])
-        results = {}
+        self.fetches.discard(fetch)
 
-        for k, v in self.map_fn(data[0], data[1]):
-            if k not in results:
-                results[k] = []
+        if outputs is None:
+            self.send_command("reduce_done", (fetch.job_id, fetch.partition, None, fetch.missing), fetch.task_id)
+            return
 
-            results[k].append(v)
+        merged = merge_outputs(outputs, self.functions[fetch.job_id].get("collect"))
+        data = (fetch.job_id, fetch.partition, merged)
 
-        self.send_command("map_done", (data[0], results))
+        if self.workers:
+            self.pool_queue.append(("reduce", data, fetch.task_id))
+            self.submit_tasks()
+        else:
+            self.task_queue.append(("reduce", data, fetch.task_id))
 
     def reduce(self, command, data):
         """
-        Reduce mapped data based on loaded reduce function, and send results to server.
+        Reduce every key of a mapped data partition based on loaded reduce function, and send results of the whole
+        partition to server.
 
         Args:
             command (str): Command being processed, not relevant to current reducing process.
-            data (str): Data being reduced.
+            data (tuple): Job id, partition number and dictionary of mapped keys and their values being reduced.
+
+        Returns:
+            None
+        """
+        logging.debug("Reducing partition %s.", data[1])
+        results = task_runner.reduce_task(self.functions[data[0]]["reduce"], data[1:])
+
+        self.send_command("reduce_done", (data[0], data[1], results), self.current_task_id)
+
+    def offer_codecs(self, command, data):
+        """
+        Accept the best codec both client and server support, and send further commands with it.
+
+        Args:
+            command (str): Command currently being process.
+            data (dict): Codec offer made by the server.
+
+        Returns:
+            None
+        """
+        accepted = PayloadCodec.accept_offer(data)
+
+        self.send_command("accept_codecs", accepted)
+        self.codec = PayloadCodec.from_accepted(accepted)
+
+        logging.debug("Client accepted codec: %s.", accepted)
+
+    def offer_function(self, command, data):
+        """
+        Load offered function from the function cache, or ask the server for it's code if it is not cached.
+
+        Args:
+            command (str): Command currently being process.
+            data (tuple): Job id, function name, "map" or "batch_map", "reduce" or "collect", and digest of the
+                function's code.
+
+        Returns:
+            None
+        """
+        job_id, name, digest = data
+
+        entry = self.function_cache.get(digest, name)
+        if entry is not None:
+            self.load_function(job_id, name, entry)
+            return
+
+        self.missing_functions.setdefault(job_id, set()).add(name)
+        self.send_command("request_function", (job_id, name))
+
+    def set_function(self, command, data):
+        """
+        Set function whose code has been asked for, caching it. Once no functions of the job are missing, it's held
+        back tasks are started.
+
+        Args:
+            command (str): Command currently being process.
+            data (tuple): Job id, function name and binary version of function code.
+
+        Returns:
+            None
+        """
+        job_id, name, code = data
+        self.load_function(job_id, name, self.function_cache.add(code, name))
+
+        missing = self.missing_functions.get(job_id, set())
+        missing.discard(name)
+        if missing:
+            return
+
+        self.missing_functions.pop(job_id, None)
+
+        deferred_tasks = self.deferred_tasks
+        self.deferred_tasks = collections.deque()
+        for command, data, task_id in deferred_tasks:
+            if data[0] == job_id:
+                self.start_task(command, data, task_id)
+            else:
+                self.deferred_tasks.append((command, data, task_id))
+
+    def load_function(self, job_id, name, entry):
+        """
+        Set map, reduce or collect function to be used by client for a job, bound to the job's globals.
+
+        Args:
+            job_id (int): Job id.
+            name (str): Function name, "map" or "batch_map", "reduce" or "collect".
+            entry (tuple): Binary version of function code and function built from it.
+
+        Returns:
+            None
+        """
+        code, function = entry
+
+        self.function_codes.setdefault(job_id, {})[name] = code
+        self.functions.setdefault(job_id, {})[name] = task_runner.bind_function(function, self.job_globals(job_id))
+
+        logging.debug("Client %s function set for job %i.", name, job_id)
+
+    def set_job_shuffle(self, command, data):
+        """
+        Set a job to shuffle it's map outputs peer to peer, starting the shuffle endpoint if it has not been started
+        yet and telling the server it's address.
+
+        Args:
+            command (str): Command currently being process.
+            data (tuple): Job id, number of reduce partitions and shuffle token of the job.
 
         Returns:
             None
         """
-        logging.debug("Reducing %s." % data[0])
-        results = self.reduce_fn(data[0], data[1])
+        job_id, partition_count, token = data
+        self.job_shuffles[job_id] = partition_count
+        self.map_outputs.set_token(job_id, token)
 
-        self.send_command("reduce_done", (data[0], results))
+        if self.shuffle_endpoint is None:
+            # Peers reach the endpoint on the address the client reaches the server from.
+            address = self.getsockname()[0]
+            self.shuffle_endpoint = ShuffleEndpoint(self.map_outputs, self.codec, self._map, address)
+            self.send_command("set_shuffle_address", (address, self.shuffle_endpoint.port()))
 
-    def set_map(self, command, data):
+    def set_map_chunking(self, command, data):
         """
-        Set map function to be used by client.
+        Set how map task output is chunked, as asked by the server.
 
         Args:
             command (str): Command currently being process.
-            data (str): Binary version of function code.
+            data (tuple): Estimated encoded size in bytes of a chunk of a map task's output, maximum number of values of
+                a chunk, and number of bytes of chunks which may be sent without being acknowledged.
 
         Returns:
             None
         """
-        map_code = marshal.loads(data)
-        self.map_fn = types.FunctionType(map_code, globals(), "map")
+        self.map_chunk_bytes, self.map_chunk_values, self.map_chunk_window = data
+
+    def ack_chunk(self, command, data):
+        """
+        Take acknowledged chunk bytes off the window of unacknowledged bytes.
+
+        Args:
+            command (str): Command currently being process.
+            data (int): Number of bytes of the acknowledged chunk.
 
-        logging.debug("Client map function set.")
+        Returns:
+            None
+        """
+        self.unacked_bytes = max(self.unacked_bytes - data, 0)
 
-    def set_reduce(self, command, data):
+    def end_job(self, command, data):
         """
-        Set reduce function to be used by client.
+        Drop functions of a finished job, along with it's queued tasks, map output being sent in chunks and map outputs,
+        which the server no longer needs.
 
         Args:
             command (str): Command currently being process.
-            data (str): Binary version of function code.
+            data (int): Job id.
 
         Returns:
             None
         """
-        reduce_code = marshal.loads(data)
-        self.reduce_fn = types.FunctionType(reduce_code, globals(), "reduce")
+        self.functions.pop(data, None)
+        self.function_globals.pop(data, None)
+        self.function_codes.pop(data, None)
+        self.missing_functions.pop(data, None)
+        self.job_broadcasts.pop(data, None)
+        self.task_queue = collections.deque(task for task in self.task_queue if task[1][0] != data)
+        self.pool_queue = collections.deque(task for task in self.pool_queue if task[1][0] != data)
+        self.deferred_tasks = collections.deque(task for task in self.deferred_tasks if task[1][0] != data)
+        for stream in self.map_streams:
+            if stream.job_id == data:
+                stream.close()
+        self.map_streams = collections.deque(stream for stream in self.map_streams if stream.job_id != data)
+
+        self.job_shuffles.pop(data, None)
+        self.map_outputs.drop_job(data)
+        for fetch in [fetch for fetch in self.fetches if fetch.job_id == data]:
+            fetch.cancel()
+            self.fetches.discard(fetch)
+
+        logging.debug("Client ended job %i.", data)
+
+    def set_broadcast(self, command, data):
+        """
+        Store broadcast value. With workers, the value is also written to a file for workers to read.
 
-        logging.debug("Client reduce function set.")
+        Args:
+            command (str): Command currently being process.
+            data (tuple): Broadcast name, version and value.
 
-    def set_collect(self, command, data):
+        Returns:
+            None
+        """
+        name, version, value = data
+        self.broadcasts[(name, version)] = value
+
+        if self.workers:
+            if self.broadcast_directory is None:
+                self.broadcast_directory = tempfile.mkdtemp(prefix="broadcasts-")
+
+            with open(self.broadcast_path(name, version), "wb") as f:
+                pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+
+        logging.debug("Client broadcast %s set to version %i.", name, version)
+
+    def set_job_broadcasts(self, command, data):
         """
-        Set collect function to be used by client.
+        Set broadcast versions seen by a job, exposing their values to the job's functions.
 
         Args:
             command (str): Command currently being process.
-            data (str): Binary version of function code.
+            data (tuple): Job id and dictionary of broadcast name to version.
 
         Returns:
             None
         """
-        collect_code = marshal.loads(data)
-        self.collect_fn = types.FunctionType(collect_code, globals(), "collect")
+        job_id, versions = data
+        self.job_broadcasts[job_id] = versions
+        self.job_globals(job_id)["broadcasts"] = self.job_broadcast_values(job_id)
 
-        logging.debug("Client collect function set.")
+    def drop_broadcast(self, command, data):
+        """
+        Drop broadcast version which is no longer seen by any job.
+
+        Args:
+            command (str): Command currently being process.
+            data (tuple): Broadcast name and version.
+
+        Returns:
+            None
+        """
+        self.broadcasts.pop(data, None)
+
+        if self.broadcast_directory is not None:
+            try:
+                os.remove(self.broadcast_path(*data))
+            except OSError:
+                pass
+
+    def broadcast_path(self, name, version):
+        """
+        Get path of the file holding a broadcast value for worker processes.
+
+        Args:
+            name (str): Broadcast name.
+            version (int): Broadcast version.
+
+        Returns:
+            str: Path of the file.
+        """
+        return os.path.join(self.broadcast_directory, "%s-%i.pickle" % (name.encode("hex"), version))
+
+    def job_globals(self, job_id):
+        """
+        Get globals the functions of a job are bound to, creating them on first use.
+
+        Args:
+            job_id (int): Job id.
+
+        Returns:
+            dict: Function globals.
+        """
+        if job_id not in self.function_globals:
+            self.function_globals[job_id] = task_runner.function_globals({})
+
+        return self.function_globals[job_id]
+
+    def job_broadcast_values(self, job_id):
+        """
+        Get broadcast values seen by a job.
+
+        Args:
+            job_id (int): Job id.
+
+        Returns:
+            dict: Broadcast name to value.
+        """
+        return dict((name, self.broadcasts[(name, version)])
+                    for name, version in self.job_broadcasts.get(job_id, {}).iteritems())
 
     def handle_close(self):
         """
@@ -171,3 +868,31 @@ class Client(ChannelProtocol):
         logging.info("Client disconnecting.")
         self.close()
 
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+
+        if self.task_notifier is not None:
+            self.task_notifier.handle_close()
+            self.task_notifier = None
+
+        if self.broadcast_directory is not None:
+            shutil.rmtree(self.broadcast_directory, ignore_errors=True)
+            self.broadcast_directory = None
+
+        for stream in self.map_streams:
+            stream.close()
+        self.map_streams = collections.deque()
+
+        if self.spool_directory is not None:
+            shutil.rmtree(self.spool_directory, ignore_errors=True)
+            self.spool_directory = None
+
+        for fetch in self.fetches:
+            fetch.cancel()
+        self.fetches = set()
+
+        if self.shuffle_endpoint is not None:
+            self.shuffle_endpoint.handle_close()
+            self.shuffle_endpoint = None
+
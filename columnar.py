@@ -0,0 +1,345 @@
+import array
+import itertools
+import struct
+import sys
+
+from partitioning import partition_of
+
+# Typecodes of int arrays, from narrowest to widest.
+INT_TYPECODES = ("b", "h", "i", "l")
+
+
+def narrowest_typecode(low, high):
+    """
+    Get the narrowest int typecode holding every value from low to high.
+
+    Args:
+        low (int): Lowest value.
+        high (int): Highest value.
+
+    Returns:
+        str: Typecode, one of INT_TYPECODES.
+    """
+    for typecode in INT_TYPECODES:
+        bound = 1 << (8 * array.array(typecode).itemsize - 1)
+        if -bound <= low and high < bound:
+            return typecode
+
+    return INT_TYPECODES[-1]
+
+
+def narrow_array(values):
+    """
+    Convert int array to the narrowest typecode holding every one of it's values.
+
+    Args:
+        values (array): Int array.
+
+    Returns:
+        array: Array of the narrowest typecode, or the given array if it is already narrowest.
+    """
+    if not values:
+        return array.array("b")
+
+    typecode = narrowest_typecode(min(values), max(values))
+
+    return values if typecode == values.typecode else array.array(typecode, values)
+
+
+def numpy_format(typecode):
+    """
+    Get NumPy dtype string of the items of an array typecode, so NumPy arrays can be converted to it's raw layout.
+
+    Args:
+        typecode (str): Typecode, one of INT_TYPECODES or "d".
+
+    Returns:
+        str: NumPy dtype string, e.g. "i4".
+    """
+    return "%s%i" % ("f" if typecode == "d" else "i", array.array(typecode).itemsize)
+
+
+def concatenate(first, second):
+    """
+    Concatenate two arrays of the same kind of values, widening either if their typecodes differ.
+
+    Args:
+        first (array): Array extended with the second one, unless it has to be widened.
+        second (array): Array appended to the first one.
+
+    Returns:
+        array: Concatenated array, either the first array or a widened copy of it.
+    """
+    if first.typecode != second.typecode:
+        typecode = max(first.typecode, second.typecode, key=INT_TYPECODES.index)
+        if first.typecode != typecode:
+            first = array.array(typecode, first)
+        if second.typecode != typecode:
+            second = array.array(typecode, second)
+
+    first.extend(second)
+    return first
+
+
+def load_array(typecode, itemsize, byteorder, data):
+    """
+    Load typed array from the raw buffer of an array dumped by another process, which may run on a platform with a
+    different byte order or item size.
+
+    Args:
+        typecode (str): Typecode of the dumped array.
+        itemsize (int): Item size in bytes of the dumped array.
+        byteorder (str): Byte order of the dumped array, "little" or "big".
+        data (str): Raw buffer of the dumped array.
+
+    Returns:
+        array: Loaded array.
+    """
+    loaded = array.array(typecode)
+
+    if loaded.itemsize == itemsize:
+        loaded.fromstring(data)
+        if byteorder != sys.byteorder:
+            loaded.byteswap()
+    else:
+        formats = {1: "b", 2: "h", 4: "i", 8: "q"}
+        prefix = "<" if byteorder == "little" else ">"
+        loaded.extend(struct.unpack("%s%i%s" % (prefix, len(data) // itemsize, formats[itemsize]), data))
+
+    return loaded
+
+
+class ColumnarResults(object):
+    """
+    ColumnarResults holds mapped keys and their values in columns, instead of as a dictionary of lists of boxed values,
+    when the values are all ints or all floats, as they are for counting jobs. Each key is held once per batch of
+    results along with it's number of values, and the values of every key are held back to back in a typed array.
+    Ints and counts are held in the narrowest typecode holding them, and widened as needed when results are merged.
+
+    Columns are pickled as the raw buffers of their arrays, so values are never pickled one by one. Keys which are
+    strings are interned when unpickled, so the server holds each key once however many map tasks emit it.
+
+    Results are merged by appending the columns of another batch, so a key may appear several times until the results
+    are grouped by key again.
+
+    Attributes:
+        keys (list): Mapped keys, in the order of their values.
+        counts (array): Number of values of each key.
+        values (array): Values of every key, back to back.
+    """
+
+    # Typecodes of value arrays by the type of the values they hold, before being narrowed.
+    TYPECODES = {int: "l", float: "d"}
+
+    def __init__(self, typecode, counts_typecode="l"):
+        """
+        Initialize empty columnar results.
+
+        Args:
+            typecode (str): Typecode of the values array, one of INT_TYPECODES for ints or "d" for floats.
+            counts_typecode (str): Typecode of the counts array, one of INT_TYPECODES.
+        """
+        self.keys = []
+        self.counts = array.array(counts_typecode)
+        self.values = array.array(typecode)
+
+    @staticmethod
+    def from_dict(results):
+        """
+        Convert mapped keys and their values to columns, if the values are all ints or all floats.
+
+        Args:
+            results (dict): Mapped keys and their values.
+
+        Returns:
+            ColumnarResults/None: Columnar results, or None if there are no values or they are not all ints or all
+                floats.
+        """
+        value_types = set(itertools.imap(type, itertools.chain.from_iterable(results.itervalues())))
+        if len(value_types) != 1:
+            return None
+
+        typecode = ColumnarResults.TYPECODES.get(value_types.pop())
+        if typecode is None:
+            return None
+
+        columns = ColumnarResults(typecode)
+        columns.keys = results.keys()
+        columns.counts.extend(map(len, results.itervalues()))
+        for values in results.itervalues():
+            columns.values.extend(values)
+
+        columns.counts = narrow_array(columns.counts)
+        if typecode != "d":
+            columns.values = narrow_array(columns.values)
+
+        return columns
+
+    @staticmethod
+    def from_arrays(keys, counts, values):
+        """
+        Build columns straight from NumPy arrays of the number of values of each key and of the values, copying their
+        raw buffers, so values are never boxed one by one. Ints and counts are held in the narrowest typecode holding
+        them.
+
+        Args:
+            keys (list): Mapped keys, in the order of their values.
+            counts (numpy.ndarray): Number of values of each key.
+            values (numpy.ndarray): Int or float values of every key, back to back.
+
+        Returns:
+            ColumnarResults: Columnar results.
+        """
+        if values.dtype.kind == "f":
+            typecode = "d"
+        else:
+            typecode = narrowest_typecode(int(values.min()), int(values.max()))
+
+        columns = ColumnarResults(typecode, narrowest_typecode(0, int(counts.max())))
+        columns.keys = keys
+        columns.counts.fromstring(counts.astype(numpy_format(columns.counts.typecode)).tobytes())
+        columns.values.fromstring(values.astype(numpy_format(typecode)).tobytes())
+
+        return columns
+
+    def value_type(self):
+        """
+        Get type of the values held.
+
+        Returns:
+            type: int or float.
+        """
+        return float if self.values.typecode == "d" else int
+
+    def __len__(self):
+        """
+        Get number of keys held, counting a key once per batch it appears in.
+
+        Returns:
+            int: Number of keys.
+        """
+        return len(self.keys)
+
+    def __iter__(self):
+        """
+        Iterate over keys, as over the keys of a dictionary of results.
+
+        Returns:
+            Iterator of keys.
+        """
+        return iter(self.keys)
+
+    def iteritems(self):
+        """
+        Lazily read each key and it's values, once per batch the key appears in.
+
+        Returns:
+            Generator of (key, values (list)) tuples.
+        """
+        values = self.values
+        offset = 0
+
+        for key, count in itertools.izip(self.keys, self.counts):
+            yield key, values[offset:offset + count].tolist()
+            offset += count
+
+    def extend(self, other):
+        """
+        Merge columns of another batch of results with values of the same type, by concatenating them.
+
+        Args:
+            other (ColumnarResults): Results to merge.
+
+        Returns:
+            None
+        """
+        self.keys.extend(other.keys)
+        self.counts = concatenate(self.counts, other.counts)
+        self.values = concatenate(self.values, other.values)
+
+    def split(self, partition_count):
+        """
+        Partition results by hashing each key, as the shuffle store does. Values are copied as slices of the values
+        array.
+
+        Args:
+            partition_count (int): Number of partitions keys are hashed into.
+
+        Returns:
+            dict: Partition number to ColumnarResults of the partition's keys.
+        """
+        partitions = {}
+        values = self.values
+        offset = 0
+
+        for key, count in itertools.izip(self.keys, self.counts):
+            partition = partition_of(key, partition_count)
+            if partition not in partitions:
+                partitions[partition] = ColumnarResults(values.typecode, self.counts.typecode)
+            columns = partitions[partition]
+
+            columns.keys.append(key)
+            columns.counts.append(count)
+            columns.values.extend(values[offset:offset + count])
+            offset += count
+
+        return partitions
+
+    def to_dict(self, collect=None):
+        """
+        Group values by key, combining the values of each key with collect function if it exists.
+
+        Args:
+            collect (Function/None): Collect function.
+
+        Returns:
+            dict: Mapped keys and their values.
+        """
+        results = {}
+
+        for key, values in self.iteritems():
+            if key in results:
+                results[key].extend(values)
+            else:
+                results[key] = values
+
+        if collect is not None:
+            for key, values in results.iteritems():
+                results[key] = list(collect(key, values))
+
+        return results
+
+    def nbytes(self):
+        """
+        Get number of bytes held by the counts and values arrays.
+
+        Returns:
+            int: Number of bytes.
+        """
+        return len(self.counts) * self.counts.itemsize + len(self.values) * self.values.itemsize
+
+    def __getstate__(self):
+        """
+        Get pickled state, holding the raw buffers of the arrays along with their layout.
+
+        Returns:
+            tuple: Keys, typecodes, item sizes and byte order, and raw buffers of the values and counts arrays.
+        """
+        return (self.keys, self.values.typecode, self.counts.typecode, self.counts.itemsize, self.values.itemsize,
+                sys.byteorder, self.counts.tostring(), self.values.tostring())
+
+    def __setstate__(self, state):
+        """
+        Restore from pickled state, interning keys which are strings.
+
+        Args:
+            state (tuple): State as returned by __getstate__.
+
+        Returns:
+            None
+        """
+        keys, typecode, counts_typecode, counts_itemsize, values_itemsize, byteorder, counts, values = state
+
+        self.keys = [intern(key) if type(key) is str else key for key in keys]
+        self.counts = load_array(counts_typecode, counts_itemsize, byteorder, counts)
+        self.values = load_array(typecode, values_itemsize, byteorder, values)
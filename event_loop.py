@@ -0,0 +1,105 @@
+import asyncore
+import errno
+import select
+
+
+def loop(socket_map=None, timeout=30.0, tick=None):
+    """
+    Run event loop over the channels of given socket map until all of them have been closed. Drop-in replacement for
+    asyncore.loop which waits on an epoll object, so the cost of waiting does not grow with the number of open
+    connections. Platforms without epoll fall back to asyncore's poll based loop.
+
+    A tick function may be given, which is called after every iteration. Iterations wait for events no longer than
+    the timeout, so it is called at least once per timeout.
+
+    Channels are only re-registered with epoll when they are replaced or the events they are interested in change.
+
+    Args:
+        socket_map (dict): Socket map of channels to run, asyncore's global socket map if not given.
+        timeout (float): Maximum time in seconds to wait for events in each iteration.
+        tick (func/None): Function called after every iteration.
+
+    Returns:
+        None
+    """
+    if socket_map is None:
+        socket_map = asyncore.socket_map
+
+    if not hasattr(select, "epoll"):
+        while socket_map:
+            asyncore.poll2(timeout, socket_map)
+            if tick is not None:
+                tick()
+        return
+
+    epoll = select.epoll()
+    registered = {}
+
+    try:
+        while socket_map:
+            update_registrations(epoll, registered, socket_map)
+
+            try:
+                events = epoll.poll(timeout)
+            except IOError as why:
+                if why.errno != errno.EINTR:
+                    raise
+                continue
+
+            for fd, flags in events:
+                channel = socket_map.get(fd)
+                if channel is not None:
+                    asyncore.readwrite(channel, flags)
+
+            if tick is not None:
+                tick()
+    finally:
+        epoll.close()
+
+
+def update_registrations(epoll, registered, socket_map):
+    """
+    Register channels of the socket map with epoll for the events they are currently interested in, and unregister
+    channels which have been removed from the socket map.
+
+    Args:
+        epoll (select.epoll): Epoll object to register channels with.
+        registered (dict): File descriptors currently registered with epoll, and their channels and event masks.
+        socket_map (dict): Socket map of channels.
+
+    Returns:
+        None
+    """
+    for fd, (channel, mask) in registered.items():
+        if socket_map.get(fd) is not channel:
+            del registered[fd]
+            try:
+                epoll.unregister(fd)
+            except (IOError, ValueError):  # Closing a file descriptor already unregisters it.
+                pass
+
+    for fd, channel in socket_map.items():
+        mask = 0
+        if channel.readable():
+            mask |= select.EPOLLIN | select.EPOLLPRI
+        # Accepting sockets should not be checked for writing.
+        if channel.writable() and not channel.accepting:
+            mask |= select.EPOLLOUT
+
+        if fd in registered and registered[fd][1] == mask:
+            continue
+
+        try:
+            if fd in registered:
+                epoll.modify(fd, mask)
+            else:
+                epoll.register(fd, mask)
+        except IOError as why:
+            if why.errno == errno.ENOENT:  # File descriptor was closed since it was registered.
+                epoll.register(fd, mask)
+            elif why.errno == errno.EEXIST:  # File descriptor was reused by a new channel without being closed.
+                epoll.modify(fd, mask)
+            else:
+                raise
+
+        registered[fd] = (channel, mask)
@@ -0,0 +1,167 @@
+import collections
+import hashlib
+import logging
+import os
+import task_runner
+
+
+class FunctionCache(object):
+    """
+    FunctionCache keeps functions sent by servers, identified by the digest of their binary code, so a function already
+    received is neither sent nor built again. Functions are kept in memory up to the capacity, least recently used
+    functions being dropped first.
+
+    With a directory, the binary code of every function is also kept on disk, so the cache survives client restarts.
+    Code read back from disk is only used if it still matches it's digest.
+
+    Attributes:
+        capacity (int): Maximum number of functions kept in memory.
+        directory (str/None): Directory functions are kept in on disk, or None to only keep them in memory.
+        entries (OrderedDict): Digest to (binary code, built function), least recently used first.
+    """
+    DEFAULT_CAPACITY = 64
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, directory=None):
+        """
+        Initialize function cache, creating it's directory if it does not exist.
+
+        Args:
+            capacity (int): Maximum number of functions kept in memory.
+            directory (str/None): Directory functions are kept in on disk, or None to only keep them in memory.
+        """
+        self.capacity = capacity
+        self.directory = directory
+        self.entries = collections.OrderedDict()
+
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def digest(code):
+        """
+        Get digest identifying binary function code.
+
+        Args:
+            code (str): Binary version of function code.
+
+        Returns:
+            str: Hex digest of the code.
+        """
+        return hashlib.sha1(code).hexdigest()
+
+    def path(self, digest):
+        """
+        Get path of a function's binary code on disk.
+
+        Args:
+            digest (str): Digest of the code.
+
+        Returns:
+            str: Path of the code.
+        """
+        return os.path.join(self.directory, digest + ".code")
+
+    def get(self, digest, name):
+        """
+        Get function by the digest of it's code, from memory or else from disk.
+
+        Args:
+            digest (str): Digest of the code.
+            name (str): Name to build the function with, if it is read from disk.
+
+        Returns:
+            (code (str), function) or None if the function is not cached.
+        """
+        entry = self.entries.pop(digest, None)
+
+        if entry is None and self.directory is not None:
+            code = self.read(digest)
+            if code is not None:
+                entry = code, task_runner.build_function(code, name)
+
+        if entry is not None:
+            self.insert(digest, entry)
+
+        return entry
+
+    def add(self, code, name):
+        """
+        Build function from it's binary code and cache it, writing the code to disk if the cache has a directory.
+
+        Args:
+            code (str): Binary version of function code.
+            name (str): Name of the function.
+
+        Returns:
+            (code (str), function)
+        """
+        digest = FunctionCache.digest(code)
+        entry = code, task_runner.build_function(code, name)
+
+        self.entries.pop(digest, None)
+        self.insert(digest, entry)
+
+        if self.directory is not None:
+            self.write(digest, code)
+
+        return entry
+
+    def insert(self, digest, entry):
+        """
+        Insert entry as the most recently used, dropping the least recently used entry beyond the capacity.
+
+        Args:
+            digest (str): Digest of the code.
+            entry (tuple): Binary code and built function.
+
+        Returns:
+            None
+        """
+        self.entries[digest] = entry
+
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def read(self, digest):
+        """
+        Read function code from disk.
+
+        Args:
+            digest (str): Digest of the code.
+
+        Returns:
+            str/None: Binary version of function code, or None if it is not on disk or does not match it's digest.
+        """
+        try:
+            with open(self.path(digest), "rb") as f:
+                code = f.read()
+        except IOError:
+            return None
+
+        if FunctionCache.digest(code) != digest:
+            logging.warning("Cached function %s does not match it's digest.", digest)
+            return None
+
+        return code
+
+    def write(self, digest, code):
+        """
+        Write function code to disk. The code is written to a temporary file first, so a partly written file is never
+        read back.
+
+        Args:
+            digest (str): Digest of the code.
+            code (str): Binary version of function code.
+
+        Returns:
+            None
+        """
+        path = self.path(digest)
+        temporary_path = "%s.%i.tmp" % (path, os.getpid())
+
+        try:
+            with open(temporary_path, "wb") as f:
+                f.write(code)
+            os.rename(temporary_path, path)
+        except (IOError, OSError) as e:
+            logging.warning("Could not cache function %s on disk: %s.", digest, e)
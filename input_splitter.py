@@ -0,0 +1,259 @@
+import bisect
+import glob
+import mmap
+import os
+
+
+class InputSplit(object):
+    """
+    InputSplit is a byte range of an input file, starting at the beginning of a record and ending after the last
+    record starting within it. Splits only hold their location, their data is read when they are dispatched.
+
+    Attributes:
+        path (str): Path of the input file.
+        start (int): Offset of the first byte of the split.
+        end (int): Offset after the last byte of the split.
+    """
+    def __init__(self, path, start, end):
+        """
+        Initialize input split.
+
+        Args:
+            path (str): Path of the input file.
+            start (int): Offset of the first byte of the split.
+            end (int): Offset after the last byte of the split.
+        """
+        self.path = path
+        self.start = start
+        self.end = end
+
+    def read(self):
+        """
+        Read data of the split from the input file through a memory map.
+
+        Returns:
+            str: Data of the split.
+        """
+        with open(self.path, "rb") as f:
+            mapped_file = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                return mapped_file[self.start:self.end]
+            finally:
+                mapped_file.close()
+
+
+class InputSplitter(object):
+    """
+    InputSplitter splits input files into byte ranges of about the split size, which can be used as MapReduce data in
+    place of a dictionary. Split boundaries are moved forward to the end of the record they fall in, so records are
+    never split between map tasks. Splits are produced lazily, so the input is never held in memory as a whole.
+
+    Each split is keyed by a tuple of it's file path and starting offset, and is mapped as the data of it's records.
+
+    Besides iterating over splits of the split size, the splitter can be consumed split by split with next_split, each
+    split sized by the caller. This lets the task manager size splits to the client they are handed to. Byte ranges
+    already processed, e.g. before the server restarted, can be excluded from consumption.
+
+    Attributes:
+        patterns ([str]): Paths or glob patterns of input files.
+        split_size (int): Size in bytes of a split, before it is aligned on a record boundary.
+        record_separator (str): Separator between records of the input files.
+        pending_paths ([str]/None): Input files not yet fully consumed by next_split, once consumption has started.
+        offset (int): Offset in the first pending input file up to which it has been consumed by next_split.
+        remaining_size (int/None): Size in bytes of input not yet consumed by next_split, once consumption has started.
+        excluded (dict): Path to sorted, non-overlapping (start, end) byte ranges skipped by next_split.
+    """
+    DEFAULT_SPLIT_SIZE = 16 * 1024 * 1024
+    DEFAULT_RECORD_SEPARATOR = "\n"
+
+    def __init__(self, patterns, split_size=DEFAULT_SPLIT_SIZE, record_separator=DEFAULT_RECORD_SEPARATOR):
+        """
+        Initialize input splitter.
+
+        Args:
+            patterns (str/[str]): Path or glob pattern of input files, or a list of them.
+            split_size (int): Size in bytes of a split, before it is aligned on a record boundary.
+            record_separator (str): Separator between records of the input files.
+        """
+        if isinstance(patterns, basestring):
+            patterns = [patterns]
+
+        self.patterns = patterns
+        self.split_size = split_size
+        self.record_separator = record_separator
+
+        self.pending_paths = None
+        self.offset = 0
+        self.remaining_size = None
+        self.excluded = {}
+
+    def exclude(self, path, start, end):
+        """
+        Exclude byte range of an input file from consumption by next_split. Ranges have to start and end on record
+        boundaries, as splits do, and be excluded before consumption starts.
+
+        Args:
+            path (str): Path of the input file.
+            start (int): Offset of the first byte of the range.
+            end (int): Offset after the last byte of the range.
+
+        Returns:
+            None
+        """
+        bisect.insort(self.excluded.setdefault(path, []), (start, end))
+
+    def paths(self):
+        """
+        Get paths of input files matching the patterns, in sorted order per pattern.
+
+        Returns:
+            [str]: Input file paths.
+        """
+        paths = []
+
+        for pattern in self.patterns:
+            paths.extend(sorted(glob.glob(pattern)))
+
+        return paths
+
+    def split_end(self, mapped_file, start, split_size):
+        """
+        Find end of split starting at given offset, moved forward to the end of the record it falls in.
+
+        Args:
+            mapped_file (mmap): Memory map of the input file.
+            start (int): Offset of the first byte of the split.
+            split_size (int): Size in bytes of the split, before it is aligned on a record boundary.
+
+        Returns:
+            int: Offset after the last byte of the split.
+        """
+        end = start + max(split_size, 1)
+        if end >= mapped_file.size():
+            return mapped_file.size()
+
+        separator = mapped_file.find(self.record_separator, end - 1)
+        return separator + len(self.record_separator) if separator != -1 else mapped_file.size()
+
+    def splits(self, path):
+        """
+        Lazily split input file into splits aligned on record boundaries.
+
+        Args:
+            path (str): Path of the input file.
+
+        Returns:
+            Generator of InputSplit.
+        """
+        size = os.path.getsize(path)
+        if size == 0:
+            return
+
+        with open(path, "rb") as f:
+            mapped_file = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                start = 0
+                while start < size:
+                    end = self.split_end(mapped_file, start, self.split_size)
+
+                    yield InputSplit(path, start, end)
+                    start = end
+            finally:
+                mapped_file.close()
+
+    def start_consuming(self):
+        """
+        Find input files to be consumed by next_split, if not done yet.
+
+        Returns:
+            None
+        """
+        if self.pending_paths is None:
+            self.pending_paths = [path for path in self.paths() if os.path.getsize(path) > 0]
+            self.remaining_size = sum(os.path.getsize(path) for path in self.pending_paths)
+            self.remaining_size -= sum(end - start for path in self.pending_paths
+                                       for start, end in self.excluded.get(path, []))
+
+    def next_split(self, split_size):
+        """
+        Consume the next split of the input files.
+
+        Args:
+            split_size (int): Size in bytes of the split, before it is aligned on a record boundary.
+
+        Returns:
+            InputSplit/None: Next split, or None once all input has been consumed.
+        """
+        self.start_consuming()
+
+        while self.pending_paths and self.skip_excluded():
+            self.pending_paths.pop(0)
+            self.offset = 0
+
+        if not self.pending_paths:
+            return None
+
+        path = self.pending_paths[0]
+        excluded = self.excluded.get(path, [])
+
+        with open(path, "rb") as f:
+            mapped_file = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                start = self.offset
+                end = self.split_end(mapped_file, start, split_size)
+                size = mapped_file.size()
+            finally:
+                mapped_file.close()
+
+        # Split ends where the next excluded range starts, if it would overlap it.
+        following = bisect.bisect_right(excluded, (start, size))
+        if following < len(excluded):
+            end = min(end, excluded[following][0])
+
+        if end < size:
+            self.offset = end
+        else:
+            self.pending_paths.pop(0)
+            self.offset = 0
+
+        self.remaining_size -= end - start
+        return InputSplit(path, start, end)
+
+    def skip_excluded(self):
+        """
+        Move offset in the first pending input file past excluded ranges starting at it.
+
+        Returns:
+            Bool whether the whole rest of the file is excluded.
+        """
+        path = self.pending_paths[0]
+        excluded = self.excluded.get(path, [])
+
+        index = bisect.bisect_left(excluded, (self.offset, 0))
+        while index < len(excluded) and excluded[index][0] == self.offset:
+            self.offset = excluded[index][1]
+            index += 1
+
+        return self.offset >= os.path.getsize(path)
+
+    def remaining(self):
+        """
+        Get size of input not yet consumed by next_split.
+
+        Returns:
+            int: Size in bytes.
+        """
+        self.start_consuming()
+
+        return self.remaining_size
+
+    def iteritems(self):
+        """
+        Lazily iterate over splits of all input files, in the same way as over a MapReduce data dictionary.
+
+        Returns:
+            Generator of (split key (tuple), InputSplit).
+        """
+        for path in self.paths():
+            for split in self.splits(path):
+                yield (split.path, split.start), split
@@ -0,0 +1,245 @@
+import collections
+import functools
+import itertools
+import marshal
+import multiprocessing
+import task_runner
+
+from input_splitter import InputSplit
+from result_sinks import DictSink
+from shuffle_store import ShuffleStore
+
+# Functions of the job in a worker process of the local runner, set once per worker process by init_worker.
+worker_functions = {}
+
+
+def build_functions(function_codes, broadcast_values):
+    """
+    Build the job's functions, with it's broadcast values as their globals.
+
+    Args:
+        function_codes (dict): Function name, "map" or "batch_map", "reduce" or "collect", to binary version of function
+            code.
+        broadcast_values (dict): Broadcast name to value.
+
+    Returns:
+        dict: Function name to function.
+    """
+    namespace = task_runner.function_globals(broadcast_values)
+
+    return dict((name, task_runner.build_function(code, name, namespace)) for name, code in function_codes.iteritems())
+
+
+def init_worker(function_codes, broadcast_values):
+    """
+    Build the job's functions once in a worker process.
+
+    Args:
+        function_codes (dict): Function name, "map" or "batch_map", "reduce" or "collect", to binary version of function
+            code.
+        broadcast_values (dict): Broadcast name to value.
+
+    Returns:
+        None
+    """
+    worker_functions.update(build_functions(function_codes, broadcast_values))
+
+
+def run_map(items, functions=None):
+    """
+    Map a chunk of data entries with the job's functions, each entry as a map task of it's own. Input splits are read
+    in the worker process.
+
+    Args:
+        items ([tuple]): Map keys and data being mapped, or InputSplits of it.
+        functions (dict/None): Function name to function, or None for the functions built by init_worker.
+
+    Returns:
+        [dict]: Mapped keys and their values, per map task.
+    """
+    functions = functions if functions is not None else worker_functions
+    results = []
+
+    for key, value in items:
+        if isinstance(value, InputSplit):
+            value = value.read()
+
+        results.append(task_runner.map_with(functions, (key, value)))
+
+    return results
+
+
+def run_reduce(item, functions=None):
+    """
+    Reduce a partition with the job's reduce function.
+
+    Args:
+        item (tuple): Partition number and mapped keys and their values being reduced, as a dictionary or an iterable
+            of (key, values).
+        functions (dict/None): Function name to function, or None for the functions built by init_worker.
+
+    Returns:
+        (partition number (int), reduced keys and their results (dict))
+    """
+    functions = functions if functions is not None else worker_functions
+    return item[0], task_runner.reduce_task(functions["reduce"], item)
+
+
+class LocalRunner(object):
+    """
+    LocalRunner runs a MapReduce job on the local machine, without a server, clients or sockets. It takes the same
+    functions, data and settings as the Server, and gives the same results. Tasks are run in the calling process, or
+    on a pool of worker processes.
+
+    Functions are built from their code the same way clients build them, so they see broadcast values the same way.
+    Map results are shuffled in memory, spilling to disk beyond the shuffle memory limit as on the server, and each
+    partition is reduced and written to the sink as on the server.
+
+    Attributes:
+        map (Function): Map function.
+        batch_map (bool): Whether the map function is a batch map function, called once per task with the task's data
+            and returning it's output grouped by key.
+        reduce (Function): Reduce function.
+        collect (Function): Collect function.
+        data (dict/InputSplitter): MapReduce data in dictionary format, or an InputSplitter over input files.
+        reduce_partitions (int): Number of partitions the mapped keys are hashed into for the reduce phase.
+        shuffle_memory_limit (int): Maximum number of map results values held in memory before spilling them to disk.
+        shuffle_directory (str/None): Directory in which map results are spilled, the system default if None.
+        sink (ResultSink/None): Sink results are written to, or None to collect them into a dictionary returned by run.
+        broadcasts (dict): Broadcast name to value, exposed to map and reduce functions.
+        workers (int): Number of worker processes, or 0 to run tasks in the calling process.
+        chunk_size (int): Number of map tasks handed to a worker process at once.
+    """
+    DEFAULT_REDUCE_PARTITIONS = 16
+    DEFAULT_CHUNK_SIZE = 16
+
+    # Chunks of tasks kept in flight per worker process, bounding how much data waits on the workers.
+    TASKS_PER_WORKER = 2
+
+    def __init__(self, workers=0):
+        """
+        Initialize local runner.
+
+        Args:
+            workers (int): Number of worker processes, or 0 to run tasks in the calling process.
+        """
+        self.map = None
+        self.batch_map = False
+        self.reduce = None
+        self.collect = None
+        self.data = None
+
+        self.reduce_partitions = LocalRunner.DEFAULT_REDUCE_PARTITIONS
+        self.shuffle_memory_limit = ShuffleStore.DEFAULT_MEMORY_LIMIT
+        self.shuffle_directory = None
+        self.sink = None
+        self.broadcasts = {}
+
+        self.workers = workers
+        self.chunk_size = LocalRunner.DEFAULT_CHUNK_SIZE
+
+    def broadcast(self, name, value):
+        """
+        Set broadcast value, exposed to map and reduce functions as broadcasts[name].
+
+        Args:
+            name (str): Broadcast name.
+            value: Broadcast value.
+
+        Returns:
+            None
+        """
+        self.broadcasts[name] = value
+
+    def function_codes(self):
+        """
+        Dump job's functions to a binary format, as sent to clients.
+
+        Returns:
+            dict: Function name, "map" or "batch_map", "reduce" or "collect", to binary version of function code.
+        """
+        function_codes = {}
+        map_name = "batch_map" if self.batch_map else "map"
+
+        for name, func in ((map_name, self.map), ("reduce", self.reduce), ("collect", self.collect)):
+            if func is not None:  # Collect function does not have to exist.
+                function_codes[name] = marshal.dumps(func.func_code)
+
+        return function_codes
+
+    def run_tasks(self, pool, func, items):
+        """
+        Run tasks in order of the items, on the pool of worker processes if any. Items are taken lazily, with a
+        bounded number of tasks in flight, so data of tasks is only produced as the workers need it.
+
+        Args:
+            pool (multiprocessing.Pool/None): Pool of worker processes, or None to run tasks in the calling process.
+            func (func): Task function.
+            items (iterable): Items to run the task function on.
+
+        Returns:
+            Generator of task function results.
+        """
+        if pool is None:
+            for item in items:
+                yield func(item)
+            return
+
+        pending = collections.deque()
+
+        for item in items:
+            pending.append(pool.apply_async(func, (item,)))
+
+            if len(pending) >= self.workers * LocalRunner.TASKS_PER_WORKER:
+                yield pending.popleft().get()
+
+        while pending:
+            yield pending.popleft().get()
+
+    def run(self):
+        """
+        Run job, if the runner contains the required data and MapReduce functions.
+
+        Returns:
+            Results of the job, or None if they have been written to a sink.
+        """
+        if self.map is None or self.reduce is None or self.data is None:
+            raise ValueError("Runner does not contain all functions and data necessary for MapReduce.")
+
+        sink = self.sink if self.sink is not None else DictSink()
+        map_results = ShuffleStore(self.reduce_partitions, self.shuffle_memory_limit, self.shuffle_directory,
+                                   self.collect)
+
+        if self.workers:
+            pool = multiprocessing.Pool(self.workers, init_worker, (self.function_codes(), self.broadcasts))
+            map_fn, reduce_fn = run_map, run_reduce
+        else:
+            # Functions are built for this run only, so runners in threads of one process do not share them.
+            pool = None
+            functions = build_functions(self.function_codes(), self.broadcasts)
+            map_fn = functools.partial(run_map, functions=functions)
+            reduce_fn = functools.partial(run_reduce, functions=functions)
+
+        try:
+            entries = self.data.iteritems()
+            chunks = iter(lambda: list(itertools.islice(entries, self.chunk_size)), [])
+
+            for chunk_results in self.run_tasks(pool, map_fn, chunks):
+                for results in chunk_results:
+                    map_results.add(results)
+
+            # Partitions are read as they are reduced in the calling process, and read whole for worker processes.
+            read_partition = map_results.read_partition if pool is None else \
+                (lambda partition: dict(map_results.read_partition(partition)))
+            partitions = ((partition, read_partition(partition)) for partition in map_results.partitions())
+
+            sink.open()
+            for partition, results in self.run_tasks(pool, reduce_fn, partitions):
+                sink.write_partition(partition, results)
+            sink.close()
+        finally:
+            map_results.close()
+            if pool is not None:
+                pool.terminate()
+
+        return sink.result()
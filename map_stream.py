@@ -0,0 +1,352 @@
+import os
+import struct
+import cPickle as pickle
+
+
+class MapStream(object):
+    """
+    MapStream runs a map task incrementally, buffering it's output until the buffer holds a chunk's worth of values.
+    The client sends each chunk as soon as it is full, so neither the client nor it's send buffer ever hold more than
+    a few chunks of the task's output, however much output the task has.
+
+    Chunks are bounded by their estimated encoded size, so they stay about the same size in bytes however large the
+    values are. The size of a value is estimated from the pickled size of a sample of the output, every one in
+    SAMPLE_INTERVAL pairs, along with it's key. The number of values of a chunk is capped as well.
+
+    Output is either taken from a map function, as (key, value) pairs, or is already grouped, as (key, values) pairs,
+    e.g. the output of a batch map function.
+
+    Attributes:
+        job_id (int): Job id of the map task.
+        key: Key of the map task.
+        task_id (int): Task id to send output back under.
+        pairs (iterator): Output of the map task not consumed yet.
+        grouped (bool): Whether pairs hold lists of values rather than single values.
+        collect (Function/None): Collect function, applied to the values of each key of a chunk.
+        chunk_bytes (int): Estimated encoded size in bytes of buffered values at which a chunk is full.
+        chunk_values (int): Number of buffered values at which a chunk is full, whatever their size.
+        buffer (dict): Buffered mapped keys and their values.
+        buffered_values (int): Number of values in the buffer.
+        sampled_pairs (int): Number of pairs consumed, counting towards the next sample.
+        sampled_bytes (int): Pickled size of the sampled values, along with their keys.
+        sampled_values (int): Number of sampled values.
+        finished (bool): Whether the output has been consumed entirely.
+    """
+    # One in this many pairs of the output is pickled to estimate the size of it's values.
+    SAMPLE_INTERVAL = 64
+
+    def __init__(self, job_id, key, task_id, pairs, grouped, collect, chunk_bytes, chunk_values):
+        """
+        Initialize map stream.
+
+        Args:
+            job_id (int): Job id of the map task.
+            key: Key of the map task.
+            task_id (int): Task id to send output back under.
+            pairs (iterable): Output of the map task.
+            grouped (bool): Whether pairs hold lists of values rather than single values.
+            collect (Function/None): Collect function, applied to the values of each key of a chunk.
+            chunk_bytes (int): Estimated encoded size in bytes of buffered values at which a chunk is full.
+            chunk_values (int): Number of buffered values at which a chunk is full, whatever their size.
+        """
+        self.job_id = job_id
+        self.key = key
+        self.task_id = task_id
+        self.pairs = iter(pairs)
+        self.grouped = grouped
+        self.collect = collect
+        self.chunk_bytes = chunk_bytes
+        self.chunk_values = chunk_values
+
+        self.buffer = {}
+        self.buffered_values = 0
+        self.sampled_pairs = 0
+        self.sampled_bytes = 0
+        self.sampled_values = 0
+        self.finished = False
+
+    def chunk_limit(self):
+        """
+        Get number of buffered values at which a chunk is full, by the estimated size of a value. Until a value has
+        been sampled, only the cap on the number of values applies.
+
+        Returns:
+            int: Number of values.
+        """
+        if not self.sampled_values:
+            return self.chunk_values
+
+        value_bytes = float(self.sampled_bytes) / self.sampled_values
+        return max(1, min(self.chunk_values, int(self.chunk_bytes / value_bytes)))
+
+    def sample(self, k, values):
+        """
+        Measure the pickled size of a sample of the output, refining the estimated size of a value.
+
+        Args:
+            k: Mapped key.
+            values (list): Values of the key, sampled along with it.
+
+        Returns:
+            int: Number of buffered values at which a chunk is full, by the refined estimate.
+        """
+        self.sampled_bytes += len(pickle.dumps((k, values), pickle.HIGHEST_PROTOCOL))
+        self.sampled_values += len(values)
+
+        return self.chunk_limit()
+
+    def ready(self):
+        """
+        Check whether the next step can be taken. The map task is run by the step itself, so it always can.
+
+        Returns:
+            True
+        """
+        return True
+
+    def step(self):
+        """
+        Consume output of the map task until a chunk is full or the output is exhausted.
+
+        Returns:
+            None
+        """
+        buffer = self.buffer
+        count = self.buffered_values
+        limit = self.chunk_limit()
+        interval = MapStream.SAMPLE_INTERVAL
+        seen = self.sampled_pairs
+
+        if self.grouped:
+            for k, values in self.pairs:
+                if k in buffer:
+                    buffer[k].extend(values)
+                else:
+                    buffer[k] = list(values)
+                count += len(values)
+
+                if seen % interval == 0 and values:
+                    limit = self.sample(k, list(values[:interval]))
+                seen += 1
+
+                if count >= limit:
+                    break
+            else:
+                self.finished = True
+        else:
+            for k, v in self.pairs:
+                if k in buffer:
+                    buffer[k].append(v)
+                else:
+                    buffer[k] = [v]
+                count += 1
+
+                if seen % interval == 0:
+                    limit = self.sample(k, [v])
+                seen += 1
+
+                if count >= limit:
+                    break
+            else:
+                self.finished = True
+
+        self.buffered_values = count
+        self.sampled_pairs = seen
+
+    def take_chunk(self):
+        """
+        Take buffered output, combining the values of each key with the collect function if it exists.
+
+        Returns:
+            dict: Mapped keys and their values.
+        """
+        chunk = self.buffer
+        self.buffer = {}
+        self.buffered_values = 0
+
+        if self.collect is not None:
+            for k, values in chunk.iteritems():
+                chunk[k] = list(self.collect(k, values))
+
+        return chunk
+
+    def close(self):
+        """
+        Drop the rest of the map task's output, e.g. once it's job has ended.
+
+        Returns:
+            None
+        """
+        self.pairs = iter(())
+        self.buffer = {}
+        self.buffered_values = 0
+
+
+def spool_map_stream(stream, path, notify_fd=None):
+    """
+    Run a map stream to the end, writing each chunk to a file as soon as it is full, so only one chunk of the output
+    is held at a time. Used by worker processes, which hand the file to the client instead of the output. Each chunk
+    is written whole, preceded by it's length, before the client is notified of it, so the client can read chunks
+    while the map task is still running.
+
+    Args:
+        stream (MapStream): Map stream to run.
+        path (str): Path of the file the chunks are written to, removed if the map task fails.
+        notify_fd (int/None): Write end of the pipe the client is notified of written chunks through, if any.
+
+    Returns:
+        int: Number of chunks written, at least one.
+    """
+    chunks = 0
+
+    try:
+        with open(path, "wb") as f:
+            while not stream.finished:
+                stream.step()
+                chunk = pickle.dumps(stream.take_chunk(), pickle.HIGHEST_PROTOCOL)
+                f.write(SpooledMapStream.HEADER.pack(len(chunk)))
+                f.write(chunk)
+                f.flush()
+                chunks += 1
+
+                if notify_fd is not None:
+                    os.write(notify_fd, "\0")
+    except Exception:
+        os.remove(path)
+        raise
+
+    return chunks
+
+
+class SpooledMapStream(object):
+    """
+    SpooledMapStream reads back the chunks of a map task's output a worker process writes to a file, one chunk each
+    step, so the client holds no more than a MapStream would. It is sent the same way as a MapStream. Chunks are read
+    as soon as the worker has written them whole, while the map task is still running, so the output is sent as it is
+    produced. The number of chunks is only known once the map task finishes, so the last chunk read before then is
+    sent as a chunk, and the stream then finishes with empty output. The file is removed once the last chunk has been
+    read, or the stream is closed.
+
+    Attributes:
+        job_id (int): Job id of the map task.
+        key: Key of the map task.
+        task_id (int): Task id to send output back under.
+        path (str): Path of the file holding the chunks.
+        chunks (int/None): Number of chunks written, or None while the map task is running.
+        read_chunks (int): Number of chunks read.
+        file (file/None): File holding the chunks, once opened.
+        buffer (dict): Chunk read by the last step.
+        finished (bool): Whether the last chunk has been read.
+    """
+
+    # Length of each chunk.
+    HEADER = struct.Struct("!I")
+
+    def __init__(self, job_id, key, task_id, path, chunks=None):
+        """
+        Initialize spooled map stream.
+
+        Args:
+            job_id (int): Job id of the map task.
+            key: Key of the map task.
+            task_id (int): Task id to send output back under.
+            path (str): Path of the file holding the chunks.
+            chunks (int/None): Number of chunks in the file, or None while the map task is running.
+        """
+        self.job_id = job_id
+        self.key = key
+        self.task_id = task_id
+        self.path = path
+        self.chunks = chunks
+        self.read_chunks = 0
+
+        self.file = None
+        self.buffer = {}
+        self.finished = False
+
+    def finish(self, chunks):
+        """
+        Record the number of chunks written, once the map task has finished.
+
+        Args:
+            chunks (int): Number of chunks in the file.
+
+        Returns:
+            None
+        """
+        self.chunks = chunks
+
+    def ready(self):
+        """
+        Check whether the next step can be taken without waiting on the worker process: the next chunk has been
+        written whole, or the map task has finished and every chunk has been read.
+
+        Returns:
+            Bool whether the stream is ready for the next step.
+        """
+        if self.chunks is not None and self.read_chunks == self.chunks:
+            return True
+
+        if self.file is None:
+            try:
+                self.file = open(self.path, "rb")
+            except IOError:  # Not created by the worker process yet.
+                return False
+
+        position = self.file.tell()
+        size = os.fstat(self.file.fileno()).st_size
+        if size < position + SpooledMapStream.HEADER.size:
+            return False
+
+        length = SpooledMapStream.HEADER.unpack(self.file.read(SpooledMapStream.HEADER.size))[0]
+        self.file.seek(position)
+
+        return size >= position + SpooledMapStream.HEADER.size + length
+
+    def step(self):
+        """
+        Read the next chunk, once the stream is ready. Once the map task has finished and every chunk has been read,
+        the stream finishes with empty output.
+
+        Returns:
+            None
+        """
+        if self.chunks is None or self.read_chunks < self.chunks:
+            if self.file is None:
+                self.file = open(self.path, "rb")
+
+            length = SpooledMapStream.HEADER.unpack(self.file.read(SpooledMapStream.HEADER.size))[0]
+            self.buffer = pickle.loads(self.file.read(length))
+            self.read_chunks += 1
+
+        if self.chunks is not None and self.read_chunks == self.chunks:
+            self.finished = True
+            self.close()
+
+    def take_chunk(self):
+        """
+        Take the chunk read by the last step.
+
+        Returns:
+            dict: Mapped keys and their values.
+        """
+        chunk = self.buffer
+        self.buffer = {}
+
+        return chunk
+
+    def close(self):
+        """
+        Close and remove the file holding the chunks.
+
+        Returns:
+            None
+        """
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
@@ -0,0 +1,123 @@
+import collections
+import logging
+import threading
+import Queue
+
+from task_runner import TaskNotifier
+
+
+class MergeWorker(object):
+    """
+    MergeWorker runs work handed to it by the event loop, such as decoding and merging map results, on a background
+    thread, so the event loop keeps servicing connections meanwhile. Once a piece of work is done, it's callback is
+    called with the outcome from the event loop.
+
+    Work is queued without a limit, but the worker counts as saturated once the number of unfinished pieces of work
+    reaches it's capacity. Callers are expected to stop handing it work then, e.g. by no longer reading from
+    connections, until it catches up.
+
+    Decompression releases the interpreter lock, so it runs in parallel with the event loop. Python code of the work,
+    such as merging, is interleaved with the event loop.
+
+    Attributes:
+        capacity (int): Number of unfinished pieces of work at which the worker is saturated.
+        requests (Queue): Work waiting for the thread, as (work, callback) tuples, or None to stop the thread.
+        finished (deque): Finished work waiting for the event loop, as (callback, outcome) tuples.
+        pending (int): Number of unfinished pieces of work, including those whose callback has not been called yet.
+        notifier (TaskNotifier): Wakes up the event loop when work is finished.
+        thread (Thread/None): Background thread, once started.
+    """
+    def __init__(self, capacity, socket_map):
+        """
+        Initialize merge worker. The thread is started once the first piece of work is handed to it.
+
+        Args:
+            capacity (int): Number of unfinished pieces of work at which the worker is saturated.
+            socket_map (map[socket]): Socket map of the event loop callbacks are called from.
+        """
+        self.capacity = capacity
+
+        self.requests = Queue.Queue()
+        self.finished = collections.deque()
+        self.pending = 0
+
+        self.notifier = TaskNotifier(self.deliver, socket_map)
+        self.thread = None
+
+    def submit(self, work, callback):
+        """
+        Hand work to the background thread.
+
+        Args:
+            work (func): Function run on the background thread, without arguments.
+            callback (func): Function called from the event loop with the return value of the work, or None if the
+                work raised an exception.
+
+        Returns:
+            None
+        """
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="merge-worker")
+            self.thread.daemon = True
+            self.thread.start()
+
+        self.pending += 1
+        self.requests.put((work, callback))
+
+    def saturated(self):
+        """
+        Check whether the worker has as much unfinished work as it's capacity.
+
+        Returns:
+            Bool whether the worker is saturated.
+        """
+        return self.pending >= self.capacity
+
+    def run(self):
+        """
+        Run work on the background thread until stopped.
+
+        Returns:
+            None
+        """
+        while True:
+            request = self.requests.get()
+            if request is None:
+                return
+
+            work, callback = request
+            try:
+                outcome = work()
+            except Exception:
+                logging.exception("Merge worker failed.")
+                outcome = None
+
+            self.finished.append((callback, outcome))
+            self.notifier.notify()
+
+    def deliver(self):
+        """
+        Call callbacks of finished work. Called from the event loop after being notified.
+
+        Returns:
+            None
+        """
+        while self.finished:
+            callback, outcome = self.finished.popleft()
+            self.pending -= 1
+            callback(outcome)
+
+    def stop(self):
+        """
+        Stop the background thread once it has finished queued work, and stop being notified. Waits for the thread, so
+        it never notifies through a closed pipe.
+
+        Returns:
+            None
+        """
+        if self.thread is not None:
+            self.requests.put(None)
+            self.thread.join()
+            self.thread = None
+
+        self.notifier.handle_close()
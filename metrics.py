@@ -0,0 +1,175 @@
+import collections
+import json
+import math
+import os
+import time
+
+
+class Histogram(object):
+    """
+    Histogram counts observed values, such as task latencies in seconds, in buckets bounded by powers of two. Bucket
+    bounds grow exponentially, so a fixed number of buckets covers values from milliseconds to hours with constant
+    relative precision.
+
+    Attributes:
+        count (int): Number of observed values.
+        total (float): Sum of observed values.
+        minimum (float/None): Smallest observed value, or None before any value is observed.
+        maximum (float/None): Largest observed value, or None before any value is observed.
+        buckets (dict): Exponent of the bucket's upper bound, a power of two, to number of values in the bucket.
+    """
+    # Exponent of the upper bound of the smallest bucket, values below it are counted in it.
+    MIN_EXPONENT = -10
+
+    # Percentiles reported in snapshots, estimated by the upper bound of the bucket they fall in.
+    PERCENTILES = (0.5, 0.9, 0.99)
+
+    def __init__(self):
+        """
+        Initialize histogram.
+        """
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+        self.buckets = collections.defaultdict(int)
+
+    def observe(self, value):
+        """
+        Count observed value.
+
+        Args:
+            value (float): Observed value.
+
+        Returns:
+            None
+        """
+        self.count += 1
+        self.total += value
+        self.minimum = value if self.minimum is None else min(self.minimum, value)
+        self.maximum = value if self.maximum is None else max(self.maximum, value)
+
+        exponent = int(math.ceil(math.log(value, 2))) if value > 0 else Histogram.MIN_EXPONENT
+        self.buckets[max(exponent, Histogram.MIN_EXPONENT)] += 1
+
+    def percentile(self, fraction):
+        """
+        Estimate percentile of observed values by the upper bound of the bucket it falls in.
+
+        Args:
+            fraction (float): Percentile, between 0 and 1.
+
+        Returns:
+            float/None: Estimated percentile, or None before any value is observed.
+        """
+        if not self.count:
+            return None
+
+        seen = 0
+        for exponent in sorted(self.buckets):
+            seen += self.buckets[exponent]
+            if seen >= fraction * self.count:
+                return min(2.0 ** exponent, self.maximum)
+
+    def snapshot(self):
+        """
+        Get state of the histogram, in a JSON serializable format.
+
+        Returns:
+            dict: Count, sum, minimum, maximum, mean and estimated percentiles of observed values, along with
+                [upper bound, count] pairs of non-empty buckets.
+        """
+        snapshot = {
+            "count": self.count,
+            "sum": self.total,
+            "min": self.minimum,
+            "max": self.maximum,
+            "mean": self.total / self.count if self.count else None,
+            "buckets": [[2.0 ** exponent, self.buckets[exponent]] for exponent in sorted(self.buckets)]
+        }
+
+        for fraction in Histogram.PERCENTILES:
+            snapshot["p%g" % (fraction * 100)] = self.percentile(fraction)
+
+        return snapshot
+
+
+class Metrics(object):
+    """
+    Metrics keeps counters and histograms by name, e.g. tasks dispatched per phase and task latencies. Names are
+    dotted, starting with what they measure, e.g. "map.dispatched" or "map.latency".
+
+    Attributes:
+        started (float): Time metrics started being recorded.
+        counters (dict): Counter name to count.
+        histograms (dict): Histogram name to Histogram.
+    """
+    def __init__(self):
+        """
+        Initialize metrics.
+        """
+        self.started = time.time()
+        self.counters = collections.defaultdict(int)
+        self.histograms = {}
+
+    def increment(self, name, amount=1):
+        """
+        Increment counter.
+
+        Args:
+            name (str): Counter name.
+            amount (int): Amount to increment by.
+
+        Returns:
+            None
+        """
+        self.counters[name] += amount
+
+    def observe(self, name, value):
+        """
+        Count observed value in histogram.
+
+        Args:
+            name (str): Histogram name.
+            value (float): Observed value.
+
+        Returns:
+            None
+        """
+        if name not in self.histograms:
+            self.histograms[name] = Histogram()
+
+        self.histograms[name].observe(value)
+
+    def snapshot(self):
+        """
+        Get state of every counter and histogram, in a JSON serializable format.
+
+        Returns:
+            dict: Uptime in seconds, counters and histogram snapshots.
+        """
+        return {
+            "uptime": time.time() - self.started,
+            "counters": dict(self.counters),
+            "histograms": dict((name, histogram.snapshot()) for name, histogram in self.histograms.iteritems())
+        }
+
+
+def dump_json(stats, path):
+    """
+    Write stats to a JSON file. Stats are written to a temporary file first, so readers never see a partly written
+    file.
+
+    Args:
+        stats (dict): JSON serializable stats.
+        path (str): Path of the JSON file.
+
+    Returns:
+        None
+    """
+    temporary_path = "%s.%i.tmp" % (path, os.getpid())
+
+    with open(temporary_path, "w") as f:
+        json.dump(stats, f, indent=2, sort_keys=True)
+
+    os.rename(temporary_path, path)
@@ -0,0 +1,45 @@
+import zlib
+import cPickle as pickle
+
+
+def key_bytes(key):
+    """
+    Get bytes identifying a mapped key, equal for equal keys in every process. Strings are taken as they are, unicode
+    strings as UTF-8, and ints, longs, bools and integral floats as their decimal digits, so keys which compare equal
+    across these types give the same bytes. Tuples are taken element by element. Any other key is taken as pickled, so
+    equal keys of other types have to be built the same way to give the same bytes.
+
+    Args:
+        key: Mapped key.
+
+    Returns:
+        str: Bytes of the key.
+    """
+    key_type = type(key)
+
+    if key_type is str:
+        return key
+    if key_type is unicode:
+        return key.encode("utf-8")
+    if key_type is int or key_type is long or key_type is bool or (key_type is float and key.is_integer()):
+        return "%d" % key
+    if key_type is tuple:
+        return "(%s)" % "".join("%i:%s" % (len(data), data) for data in map(key_bytes, key))
+
+    return pickle.dumps(key, 2)
+
+
+def partition_of(key, partition_count):
+    """
+    Get the partition a mapped key is hashed into, by the CRC-32 of it's bytes. Unlike the built-in hash, this is the
+    same in every process, whatever it's interpreter, build or hash randomization, so the server, clients and peers all
+    agree on it.
+
+    Args:
+        key: Mapped key.
+        partition_count (int): Number of partitions.
+
+    Returns:
+        int: Partition number.
+    """
+    return (zlib.crc32(key_bytes(key)) & 0xffffffff) % partition_count
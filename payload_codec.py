@@ -0,0 +1,195 @@
+import cStringIO
+import marshal
+import zlib
+import cPickle as pickle
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:  # lzma compression is optional.
+        lzma = None
+
+
+class PayloadCodec(object):
+    """
+    PayloadCodec serializes and compresses the data following a command, and records the codec used in the flags of
+    the command's frame header. Decoding only relies on those flags, so a channel can decode any frame regardless of
+    the codec it is sending with itself.
+
+    The low four bits of the flags hold the serializer and the high four bits hold the compression. Data of plain
+    builtin types is serialized with marshal, anything marshal can not represent falls back to pickle. Compression is
+    only applied to serialized data of at least the compression threshold in length.
+
+    Codecs are negotiated when a client connects. The server offers what it supports, the client accepts the best
+    codec both sides support and both sides then send with it. This includes whether map results may be sent as
+    ColumnarResults.
+
+    Attributes:
+        pickle_protocol (int): Pickle protocol used for pickled data.
+        use_marshal (bool): Whether data is serialized with marshal when possible.
+        compression (int): Compression applied to large data, one of the compression flags.
+        compression_threshold (int): Minimum length of serialized data to be compressed.
+        columnar (bool): Whether map results with values of a single numeric type are sent as ColumnarResults.
+    """
+    PICKLE = 0x00
+    MARSHAL = 0x01
+    SERIALIZER_MASK = 0x0f
+
+    NO_COMPRESSION = 0x00
+    ZLIB = 0x10
+    LZMA = 0x20
+    COMPRESSION_MASK = 0xf0
+
+    # Compressions by name, in the order they are preferred.
+    COMPRESSIONS = [("lzma", LZMA), ("zlib", ZLIB)]
+
+    # Pickle protocol used until codecs are negotiated, readable by every supported Python version.
+    DEFAULT_PICKLE_PROTOCOL = 2
+    DEFAULT_COMPRESSION_THRESHOLD = 4096
+
+    def __init__(self, pickle_protocol=DEFAULT_PICKLE_PROTOCOL, use_marshal=False, compression=NO_COMPRESSION,
+                 compression_threshold=DEFAULT_COMPRESSION_THRESHOLD, columnar=False):
+        """
+        Initialize payload codec. The default codec only pickles, and is used before codecs are negotiated.
+
+        Args:
+            pickle_protocol (int): Pickle protocol used for pickled data.
+            use_marshal (bool): Whether data is serialized with marshal when possible.
+            compression (int): Compression applied to large data, one of the compression flags.
+            compression_threshold (int): Minimum length of serialized data to be compressed.
+            columnar (bool): Whether map results with values of a single numeric type are sent as ColumnarResults.
+        """
+        self.pickle_protocol = pickle_protocol
+        self.use_marshal = use_marshal
+        self.compression = compression
+        self.compression_threshold = compression_threshold
+        self.columnar = columnar
+
+    @staticmethod
+    def supported_compressions():
+        """
+        Get names of compressions available to this process, in the order they are preferred.
+
+        Returns:
+            [str]: Compression names.
+        """
+        return [name for name, flag in PayloadCodec.COMPRESSIONS if flag != PayloadCodec.LZMA or lzma is not None]
+
+    @staticmethod
+    def make_offer(compressions, compression_threshold, columnar):
+        """
+        Make codec offer sent by the server to a newly connected client.
+
+        Args:
+            compressions ([str]): Names of compressions the server is willing to use, in the order they are preferred.
+            compression_threshold (int): Minimum length of serialized data to be compressed.
+            columnar (bool): Whether the server accepts map results sent as ColumnarResults.
+
+        Returns:
+            dict: Codec offer.
+        """
+        supported = PayloadCodec.supported_compressions()
+
+        return {
+            "pickle_protocol": pickle.HIGHEST_PROTOCOL,
+            "marshal_version": marshal.version,
+            "compressions": [name for name in compressions if name in supported],
+            "compression_threshold": compression_threshold,
+            "columnar": columnar
+        }
+
+    @staticmethod
+    def accept_offer(offer):
+        """
+        Accept the best codec supported by both sides from a server's codec offer.
+
+        Args:
+            offer (dict): Codec offer made by the server.
+
+        Returns:
+            dict: Accepted codec, to be sent back to the server and passed to from_accepted.
+        """
+        supported = PayloadCodec.supported_compressions()
+        compressions = [name for name in offer["compressions"] if name in supported]
+
+        return {
+            "pickle_protocol": min(offer["pickle_protocol"], pickle.HIGHEST_PROTOCOL),
+            "use_marshal": offer["marshal_version"] == marshal.version,
+            "compression": compressions[0] if compressions else None,
+            "compression_threshold": offer["compression_threshold"],
+            "columnar": offer.get("columnar", False)
+        }
+
+    @staticmethod
+    def from_accepted(accepted):
+        """
+        Create payload codec from an accepted codec.
+
+        Args:
+            accepted (dict): Codec accepted by the client.
+
+        Returns:
+            PayloadCodec: Codec to send with.
+        """
+        compression = dict(PayloadCodec.COMPRESSIONS).get(accepted["compression"], PayloadCodec.NO_COMPRESSION)
+
+        return PayloadCodec(accepted["pickle_protocol"], accepted["use_marshal"], compression,
+                            accepted["compression_threshold"], accepted.get("columnar", False))
+
+    def encode(self, data):
+        """
+        Serialize and possibly compress data.
+
+        Args:
+            data: Data to encode.
+
+        Returns:
+            (flags (int), payload (str))
+        """
+        flags = PayloadCodec.PICKLE
+        payload = None
+
+        if self.use_marshal:
+            try:
+                payload = marshal.dumps(data)
+                flags = PayloadCodec.MARSHAL
+            except ValueError:  # Data contains objects marshal can not represent.
+                pass
+
+        if payload is None:
+            payload = pickle.dumps(data, self.pickle_protocol)
+
+        if self.compression != PayloadCodec.NO_COMPRESSION and len(payload) >= self.compression_threshold:
+            if self.compression == PayloadCodec.ZLIB:
+                payload = zlib.compress(payload)
+            else:
+                payload = lzma.compress(payload)
+            flags |= self.compression
+
+        return flags, payload
+
+    @staticmethod
+    def decode(flags, payload):
+        """
+        Decompress and deserialize data according to the frame flags it was sent with.
+
+        Args:
+            flags (int): Frame header flags.
+            payload (bytearray): Received data.
+
+        Returns:
+            Decoded data.
+        """
+        compression = flags & PayloadCodec.COMPRESSION_MASK
+
+        if compression == PayloadCodec.ZLIB:
+            payload = zlib.decompress(buffer(payload))
+        elif compression == PayloadCodec.LZMA:
+            payload = lzma.decompress(str(payload))
+
+        if flags & PayloadCodec.SERIALIZER_MASK == PayloadCodec.MARSHAL:
+            return marshal.loads(buffer(payload))
+
+        return pickle.load(cStringIO.StringIO(buffer(payload)))
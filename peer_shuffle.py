@@ -0,0 +1,589 @@
+import asyncore
+import hmac
+import logging
+import socket
+import cPickle as pickle
+
+from channel_protocol import ChannelProtocol
+from columnar import ColumnarResults
+from partitioning import partition_of
+
+
+def partition_results(results, partition_count):
+    """
+    Partition mapped keys and their values by hashing each key, as the server's shuffle store does.
+
+    Args:
+        results (dict): Mapped keys and their values.
+        partition_count (int): Number of partitions mapped keys are hashed into.
+
+    Returns:
+        dict: Partition number to mapped keys of the partition and their values.
+    """
+    partitions = {}
+
+    for key, values in results.iteritems():
+        partition = partition_of(key, partition_count)
+        if partition not in partitions:
+            partitions[partition] = {}
+        partitions[partition][key] = values
+
+    return partitions
+
+
+def merge_outputs(outputs, collect=None):
+    """
+    Merge map outputs of a partition fetched from peers into the data of it's reduce task.
+
+    Args:
+        outputs ([dict/ColumnarResults]): Mapped keys of the partition and their values, per map task.
+        collect (Function/None): Collect function, used to combine values of a key when merging.
+
+    Returns:
+        dict: Mapped keys of the partition and their values.
+    """
+    merged = {}
+
+    for output in outputs:
+        if isinstance(output, ColumnarResults):
+            output = output.to_dict()
+
+        for key, values in output.iteritems():
+            if key in merged:
+                merged[key].extend(values)
+            else:
+                merged[key] = values
+
+    if collect is not None:
+        for key, values in merged.iteritems():
+            merged[key] = list(collect(key, values))
+
+    return merged
+
+
+class MapOutputStore(object):
+    """
+    MapOutputStore holds the outputs of map tasks a client has finished for jobs with a peer to peer shuffle, until
+    peers fetch them for their reduce tasks. Each output is partitioned and pickled once, when the map task finishes,
+    so serving it to a peer does not pickle it again. Partitions whose values are all ints or all floats are pickled
+    as ColumnarResults.
+
+    Attributes:
+        outputs (dict): Job id to map key to partition number to pickled mapped keys of the partition and their values.
+        tokens (dict): Job id to the shuffle token peers fetching the job's outputs have to present.
+    """
+    def __init__(self):
+        """
+        Initialize map output store.
+        """
+        self.outputs = {}
+        self.tokens = {}
+
+    def set_token(self, job_id, token):
+        """
+        Set the shuffle token of a job, as handed out by the server.
+
+        Args:
+            job_id (int): Job id.
+            token (str): Shuffle token of the job.
+
+        Returns:
+            None
+        """
+        self.tokens[job_id] = token
+
+    def check_token(self, job_id, token):
+        """
+        Check a token presented by a peer against the job's shuffle token, in constant time.
+
+        Args:
+            job_id (int): Job id.
+            token (str): Presented token.
+
+        Returns:
+            Bool whether the token is the job's shuffle token.
+        """
+        expected = self.tokens.get(job_id)
+        return expected is not None and hmac.compare_digest(expected, token)
+
+    def add(self, job_id, map_key, results, partition_count):
+        """
+        Partition and keep output of a finished map task.
+
+        Args:
+            job_id (int): Job id.
+            map_key: Key of the map task.
+            results (dict/ColumnarResults): Mapped keys and their values.
+            partition_count (int): Number of partitions mapped keys are hashed into.
+
+        Returns:
+            [int]: Sorted numbers of partitions the output holds keys of.
+        """
+        if isinstance(results, ColumnarResults):
+            partitions = results.split(partition_count)
+        else:
+            partitions = partition_results(results, partition_count)
+
+        pickled = {}
+        for partition, output in partitions.iteritems():
+            columns = output if isinstance(output, ColumnarResults) else ColumnarResults.from_dict(output)
+            pickled[partition] = pickle.dumps(output if columns is None else columns, pickle.HIGHEST_PROTOCOL)
+
+        self.outputs.setdefault(job_id, {})[map_key] = pickled
+
+        return sorted(partitions)
+
+    def get(self, job_id, partition, map_keys):
+        """
+        Get pickled outputs of map tasks for a partition.
+
+        Args:
+            job_id (int): Job id.
+            partition (int): Partition number.
+            map_keys (list): Keys of the map tasks.
+
+        Returns:
+            [str]/None: Pickled mapped keys of the partition and their values per map task, or None if any of the map
+                tasks' outputs is not held.
+        """
+        job_outputs = self.outputs.get(job_id, {})
+
+        try:
+            return [job_outputs[map_key][partition] for map_key in map_keys]
+        except KeyError:
+            return None
+
+    def drop_job(self, job_id):
+        """
+        Drop outputs of a finished job.
+
+        Args:
+            job_id (int): Job id.
+
+        Returns:
+            None
+        """
+        self.outputs.pop(job_id, None)
+        self.tokens.pop(job_id, None)
+
+
+class ShuffleEndpoint(asyncore.dispatcher):
+    """
+    ShuffleEndpoint listens for peers fetching map outputs held by the client, on a port of it's own next to the
+    client's connection to the server. Every accepted connection is served by a ShuffleChannel.
+
+    Anyone may connect to the endpoint, and the data of commands may be pickled, so nothing a peer sends is decoded
+    until it has presented the shuffle token of a job, sent as raw bytes. Only clients handed tasks of the job by the
+    server know it's token, and a peer may only fetch outputs of the job it presented the token of.
+
+    Attributes:
+        store (MapOutputStore): Map outputs served to peers.
+        codec (PayloadCodec): Codec map outputs are sent with.
+        channels (set): Open ShuffleChannels serving peers.
+    """
+    def __init__(self, store, codec, socket_map, address=""):
+        """
+        Initialize shuffle endpoint and start listening on a free port.
+
+        Args:
+            store (MapOutputStore): Map outputs served to peers.
+            codec (PayloadCodec): Codec map outputs are sent with.
+            socket_map (map[socket]): Socket map to run the endpoint and it's channels on.
+            address (str): Address to listen on.
+        """
+        asyncore.dispatcher.__init__(self, map=socket_map)
+
+        self.store = store
+        self.codec = codec
+        self.channels = set()
+
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((address, 0))
+        self.listen(socket.SOMAXCONN)
+
+    def port(self):
+        """
+        Get port number the endpoint listens on.
+
+        Returns:
+            int: Port number.
+        """
+        return self.getsockname()[1]
+
+    def handle_accept(self):
+        """
+        Accept a peer's connection, serving it with a ShuffleChannel.
+
+        Returns:
+            None
+        """
+        pair = self.accept()
+        if pair is not None:
+            self.channels.add(ShuffleChannel(pair[0], self))
+
+    def handle_close(self):
+        """
+        Stop listening and close every channel serving peers.
+
+        Returns:
+            None
+        """
+        self.close()
+
+        for channel in list(self.channels):
+            channel.handle_close()
+
+
+class ShuffleChannel(ChannelProtocol):
+    """
+    ShuffleChannel serves a peer's fetches of map outputs held by the client, once the peer has presented the shuffle
+    token of their job. Frames sent before then which are not the token, or are too long to be one, close the channel
+    without being decoded.
+
+    Attributes:
+        endpoint (ShuffleEndpoint): Endpoint which accepted the peer's connection.
+        job_id (int/None): Job id whose shuffle token the peer presented, once it has.
+    """
+    # Maximum length of a job id and shuffle token frame.
+    MAX_TOKEN_LENGTH = 256
+    def __init__(self, connection, endpoint):
+        """
+        Initialize shuffle channel and it's parent class.
+
+        Args:
+            connection (socket): Peer connection.
+            endpoint (ShuffleEndpoint): Endpoint which accepted the peer's connection.
+        """
+        ChannelProtocol.__init__(self, connection, endpoint._map)
+
+        self.endpoint = endpoint
+        self.codec = endpoint.codec
+        self.job_id = None
+
+    def expect_data(self, data_length):
+        """
+        Set channel protocol to receive data of given length, closing the channel instead if the peer has not presented
+        a token yet and the data is too long to be one.
+
+        Args:
+            data_length (int): Length of the data following current header.
+
+        Returns:
+            None
+        """
+        if self.job_id is None and data_length > ShuffleChannel.MAX_TOKEN_LENGTH:
+            self.refuse("sent a frame of %i bytes before it's token" % data_length)
+            return
+
+        ChannelProtocol.expect_data(self, data_length)
+
+    def process_payload(self, command, flags, payload):
+        """
+        Check the token presented by the peer, taken as raw bytes. Data of other commands is only decoded once the peer
+        has presented a valid token.
+
+        Args:
+            command (str): Command the data belongs to.
+            flags (int): Header flags of the command, recording the codec the data was encoded with.
+            payload (bytearray): Received data.
+
+        Returns:
+            None
+        """
+        if self.job_id is not None:
+            ChannelProtocol.process_payload(self, command, flags, payload)
+            return
+
+        if command != "shuffle_token":
+            self.refuse("sent %s before it's token" % command)
+            return
+
+        job_id, _, token = str(payload).partition(":")
+        if not job_id.isdigit() or not self.endpoint.store.check_token(int(job_id), token):
+            self.refuse("presented an invalid token")
+            return
+
+        self.job_id = int(job_id)
+
+    def process_command(self, command, data=None):
+        """
+        Send map outputs fetched by the peer, of the job whose token it presented. Every other command is handled by
+        the parent class.
+
+        Args:
+            command (str): Command to process.
+            data (None/str): Data to process with command, if exists.
+
+        Returns:
+            None
+        """
+        if command == "fetch_partition":
+            if data is None or data[0] != self.job_id:
+                self.refuse("fetched outputs of a job whose token it did not present")
+                return
+
+            job_id, partition, map_keys = data
+            self.send_command("partition_data", self.endpoint.store.get(job_id, partition, map_keys))
+        else:
+            ChannelProtocol.process_command(self, command, data)
+
+    def refuse(self, reason):
+        """
+        Close the connection of a peer which did not present a valid shuffle token.
+
+        Args:
+            reason (str): What the peer did.
+
+        Returns:
+            None
+        """
+        logging.warning("Refusing shuffle connection from %s, which %s.", self.addr, reason)
+        self.handle_close()
+
+    def handle_close(self):
+        """
+        Close channel.
+
+        Returns:
+            None
+        """
+        self.close()
+        self.endpoint.channels.discard(self)
+
+
+class PartitionFetch(object):
+    """
+    PartitionFetch fetches the map outputs of a reduce task's partition from every peer holding any of them, over a
+    connection per peer. The callback is called once, with the fetch and either the outputs of every map task or None
+    if fetching from any peer failed. Peers which answered they no longer hold the outputs are recorded, so the server
+    can recreate them.
+
+    Attributes:
+        job_id (int): Job id.
+        partition (int): Partition number.
+        task_id (int): Task id of the reduce task.
+        token (str): Shuffle token of the job, presented to peers.
+        callback (func): Function called with the fetch and the fetched outputs, or None on failure.
+        channels ([FetchChannel]): Channels fetching from peers.
+        outputs ([dict/ColumnarResults]): Outputs received so far, per map task.
+        pending (int): Number of peers whose outputs have not been received yet.
+        missing ([tuple]): Shuffle addresses of peers which no longer hold the outputs asked of them.
+        done (bool): Whether the callback has been called.
+    """
+    def __init__(self, job_id, partition, task_id, token, callback):
+        """
+        Initialize partition fetch.
+
+        Args:
+            job_id (int): Job id.
+            partition (int): Partition number.
+            task_id (int): Task id of the reduce task.
+            token (str): Shuffle token of the job, presented to peers.
+            callback (func): Function called with the fetch and the fetched outputs, or None on failure.
+        """
+        self.job_id = job_id
+        self.partition = partition
+        self.task_id = task_id
+        self.token = token
+        self.callback = callback
+
+        self.channels = []
+        self.outputs = []
+        self.pending = 0
+        self.missing = []
+        self.done = False
+
+    def start(self, sources, codec, socket_map):
+        """
+        Connect to every peer holding outputs of the partition and ask for them.
+
+        Args:
+            sources (dict): Peer shuffle address to keys of the map tasks whose outputs it holds.
+            codec (PayloadCodec): Codec fetches are sent with.
+            socket_map (map[socket]): Socket map to run the fetch channels on.
+
+        Returns:
+            None
+        """
+        self.pending = len(sources)
+        if not sources:
+            self.finish(self.outputs)
+            return
+
+        for address, map_keys in sources.iteritems():
+            channel = FetchChannel(self, codec, socket_map)
+            self.channels.append(channel)
+
+            try:
+                channel.fetch(tuple(address), map_keys)
+            except socket.error as why:
+                logging.warning("Fetching partition %i from %s:%s failed: %s.", self.partition, address[0],
+                                address[1], why)
+                self.failed()
+                return
+
+    def received(self, outputs):
+        """
+        Keep outputs received from a peer, finishing the fetch once every peer's outputs have been received.
+
+        Args:
+            outputs ([str]): Pickled outputs of the partition per map task.
+
+        Returns:
+            None
+        """
+        self.outputs.extend(pickle.loads(output) for output in outputs)
+        self.pending -= 1
+
+        if self.pending == 0:
+            self.finish(self.outputs)
+
+    def failed(self, missing_address=None):
+        """
+        Fail the fetch, closing connections to every peer.
+
+        Args:
+            missing_address (tuple/None): Shuffle address of a peer which no longer holds the outputs asked of it, or
+                None if fetching failed otherwise, e.g. as the peer could not be reached.
+
+        Returns:
+            None
+        """
+        if missing_address is not None:
+            self.missing.append(missing_address)
+
+        self.finish(None)
+
+    def finish(self, outputs):
+        """
+        Close connections to peers and call the callback, unless it has been called already.
+
+        Args:
+            outputs ([dict/ColumnarResults]/None): Fetched outputs per map task, or None if fetching failed.
+
+        Returns:
+            None
+        """
+        if self.done:
+            return
+        self.done = True
+
+        for channel in self.channels:
+            channel.finished = True
+            channel.close()
+
+        self.callback(self, outputs)
+
+    def cancel(self):
+        """
+        Close connections to peers without calling the callback, once the reduce task is no longer needed.
+
+        Returns:
+            None
+        """
+        self.done = True
+
+        for channel in self.channels:
+            channel.finished = True
+            channel.close()
+
+
+class FetchChannel(ChannelProtocol):
+    """
+    FetchChannel connects to a peer's shuffle endpoint and fetches map outputs of a partition from it.
+
+    Attributes:
+        partition_fetch (PartitionFetch): Fetch the channel is part of.
+        address (tuple/None): Peer shuffle address, once connecting.
+        finished (bool): Whether the outputs have been received, or the fetch is over.
+    """
+    def __init__(self, partition_fetch, codec, socket_map):
+        """
+        Initialize fetch channel and it's parent class.
+
+        Args:
+            partition_fetch (PartitionFetch): Fetch the channel is part of.
+            codec (PayloadCodec): Codec fetches are sent with.
+            socket_map (map[socket]): Socket map to run the channel on.
+        """
+        ChannelProtocol.__init__(self, socket_map=socket_map)
+
+        self.partition_fetch = partition_fetch
+        self.codec = codec
+        self.address = None
+        self.finished = False
+
+    def fetch(self, address, map_keys):
+        """
+        Connect to peer, present the job's shuffle token and ask for the partition's outputs of the given map tasks.
+
+        Args:
+            address (tuple): Peer shuffle address.
+            map_keys (list): Keys of the map tasks.
+
+        Returns:
+            None
+        """
+        self.address = address
+
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect(address)
+
+        fetch = self.partition_fetch
+
+        # Sent as raw bytes, as the peer decodes nothing before checking the token.
+        token = "%i:%s" % (fetch.job_id, fetch.token)
+        self.push(ChannelProtocol.HEADER.pack(ChannelProtocol.OPCODES["shuffle_token"], 0, 0, len(token)) + token)
+        self.bytes_sent += ChannelProtocol.HEADER.size + len(token)
+
+        self.send_command("fetch_partition", (fetch.job_id, fetch.partition, map_keys))
+
+    def process_command(self, command, data=None):
+        """
+        Hand received outputs to the partition fetch. Every other command is handled by the parent class.
+
+        Args:
+            command (str): Command to process.
+            data (None/str): Data to process with command, if exists.
+
+        Returns:
+            None
+        """
+        if command != "partition_data":
+            ChannelProtocol.process_command(self, command, data)
+            return
+
+        self.finished = True
+        self.close()
+
+        if data is None:
+            logging.warning("Peer %s:%s no longer holds outputs of partition %i.", self.address[0], self.address[1],
+                            self.partition_fetch.partition)
+            self.partition_fetch.failed(self.address)
+        else:
+            self.partition_fetch.received(data)
+
+    def handle_error(self):
+        """
+        Fail the fetch on errors, such as the peer refusing the connection, instead of raising them.
+
+        Returns:
+            None
+        """
+        logging.warning("Fetching partition %i from %s:%s failed.", self.partition_fetch.partition, self.address[0],
+                        self.address[1])
+        self.handle_close()
+
+    def handle_close(self):
+        """
+        Close channel, failing the fetch if the outputs have not been received.
+
+        Returns:
+            None
+        """
+        self.close()
+
+        if not self.finished:
+            self.finished = True
+            self.partition_fetch.failed()
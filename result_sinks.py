@@ -0,0 +1,273 @@
+import json
+import os
+
+
+class ResultSink(object):
+    """
+    ResultSink receives the results of a MapReduce job partition by partition, as reduce tasks finish, so results can
+    be written out without holding every result at once. Each partition is received once, in no particular order.
+
+    Sinks are opened before the first partition is written, and closed once the job is done.
+    """
+    def open(self):
+        """
+        Prepare sink for writing.
+
+        Returns:
+            None
+        """
+
+    def write_partition(self, partition, results):
+        """
+        Write results of a finished reduce task.
+
+        Args:
+            partition (int): Partition number.
+            results (dict): Reduced keys of the partition and their results.
+
+        Returns:
+            None
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Finish writing, once every partition has been written.
+
+        Returns:
+            None
+        """
+
+    def result(self):
+        """
+        Get results to be returned by the job, if the sink keeps any.
+
+        Returns:
+            None
+        """
+        return None
+
+
+class DictSink(ResultSink):
+    """
+    DictSink collects every result into a dictionary, which is returned by the job.
+
+    Attributes:
+        results (dict): Reduced keys and their results.
+    """
+    def __init__(self):
+        """
+        Initialize dictionary sink.
+        """
+        self.results = {}
+
+    def write_partition(self, partition, results):
+        """
+        Add results of a finished reduce task to the dictionary.
+
+        Args:
+            partition (int): Partition number.
+            results (dict): Reduced keys of the partition and their results.
+
+        Returns:
+            None
+        """
+        self.results.update(results)
+
+    def result(self):
+        """
+        Get collected results.
+
+        Returns:
+            dict: Reduced keys and their results.
+        """
+        return self.results
+
+
+class FileSink(ResultSink):
+    """
+    FileSink writes results to a single buffered file, one line per result. Lines are formatted by subclasses.
+
+    Attributes:
+        path (str): Path of the output file.
+        buffer_size (int): Size in bytes of the file's write buffer.
+        file (file/None): Output file, while open.
+    """
+    DEFAULT_BUFFER_SIZE = 1024 * 1024
+
+    def __init__(self, path, buffer_size=DEFAULT_BUFFER_SIZE):
+        """
+        Initialize file sink.
+
+        Args:
+            path (str): Path of the output file.
+            buffer_size (int): Size in bytes of the file's write buffer.
+        """
+        self.path = path
+        self.buffer_size = buffer_size
+        self.file = None
+
+    def open(self):
+        """
+        Open output file, truncating it.
+
+        Returns:
+            None
+        """
+        self.file = open(self.path, "w", self.buffer_size)
+
+    def write_partition(self, partition, results):
+        """
+        Write a line for every result of a finished reduce task.
+
+        Args:
+            partition (int): Partition number.
+            results (dict): Reduced keys of the partition and their results.
+
+        Returns:
+            None
+        """
+        self.file.writelines(self.format_line(key, value) for key, value in results.iteritems())
+
+    def format_line(self, key, value):
+        """
+        Format result as a line of the output file.
+
+        Args:
+            key: Reduced key.
+            value: Result of the key.
+
+        Returns:
+            str: Line, ending with a newline.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Flush and close output file.
+
+        Returns:
+            None
+        """
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class TextSink(FileSink):
+    """
+    TextSink writes every result as a text line of the key and result, separated by the separator.
+
+    Attributes:
+        separator (str): Separator between key and result.
+    """
+    def __init__(self, path, separator=" ", buffer_size=FileSink.DEFAULT_BUFFER_SIZE):
+        """
+        Initialize text sink.
+
+        Args:
+            path (str): Path of the output file.
+            separator (str): Separator between key and result.
+            buffer_size (int): Size in bytes of the file's write buffer.
+        """
+        FileSink.__init__(self, path, buffer_size)
+        self.separator = separator
+
+    def format_line(self, key, value):
+        """
+        Format result as a text line.
+
+        Args:
+            key: Reduced key.
+            value: Result of the key.
+
+        Returns:
+            str: Line, ending with a newline.
+        """
+        return "%s%s%s\n" % (key, self.separator, value)
+
+
+class JsonLinesSink(FileSink):
+    """
+    JsonLinesSink writes every result as a line holding a JSON list of the key and result.
+    """
+    def format_line(self, key, value):
+        """
+        Format result as a JSON line.
+
+        Args:
+            key: Reduced key.
+            value: Result of the key.
+
+        Returns:
+            str: Line, ending with a newline.
+        """
+        return json.dumps([key, value]) + "\n"
+
+
+class PartitionedSink(ResultSink):
+    """
+    PartitionedSink writes the results of each partition to a part-file of it's own in the output directory, so no
+    file is written by more than one reduce task. Lines are formatted by the line sink class, e.g. TextSink or
+    JsonLinesSink.
+
+    Attributes:
+        directory (str): Output directory, created if it does not exist.
+        sink_class (class): FileSink subclass formatting the lines of each part-file.
+        sink_arguments (dict): Keyword arguments of the sink class, besides the path.
+        extension (str): Extension of the part-files.
+    """
+    def __init__(self, directory, sink_class=TextSink, extension=".txt", **sink_arguments):
+        """
+        Initialize partitioned sink.
+
+        Args:
+            directory (str): Output directory, created if it does not exist.
+            sink_class (class): FileSink subclass formatting the lines of each part-file.
+            extension (str): Extension of the part-files.
+            **sink_arguments: Keyword arguments of the sink class, besides the path.
+        """
+        self.directory = directory
+        self.sink_class = sink_class
+        self.sink_arguments = sink_arguments
+        self.extension = extension
+
+    def open(self):
+        """
+        Create output directory if it does not exist.
+
+        Returns:
+            None
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def path(self, partition):
+        """
+        Get path of a partition's part-file.
+
+        Args:
+            partition (int): Partition number.
+
+        Returns:
+            str: Path of the part-file.
+        """
+        return os.path.join(self.directory, "part-%05i%s" % (partition, self.extension))
+
+    def write_partition(self, partition, results):
+        """
+        Write results of a finished reduce task to the partition's part-file.
+
+        Args:
+            partition (int): Partition number.
+            results (dict): Reduced keys of the partition and their results.
+
+        Returns:
+            None
+        """
+        sink = self.sink_class(self.path(partition), **self.sink_arguments)
+        sink.open()
+        try:
+            sink.write_partition(partition, results)
+        finally:
+            sink.close()
@@ -4,10 +4,14 @@ import sys
 
 serverAddress = 'localhost'
 serverPort = 12345
+# Number of worker processes, 0 processes tasks in the client process itself.
+clientWorkers = 0
+# Directory to keep received functions in across restarts, None keeps them in memory only.
+functionCacheDirectory = None
 
 if __name__ == '__main__':
 
-    client = Client()
+    client = Client(clientWorkers, functionCacheDirectory)
 
     logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
 
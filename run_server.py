@@ -1,3 +1,5 @@
+from input_splitter import InputSplitter
+from result_sinks import TextSink
 from server import Server
 import logging
 import sys
@@ -20,21 +22,11 @@ if __name__ == '__main__':
     server.reduce = reduce
 
     fileName = "text.txt"
-    data = ""
-    with open(fileName) as f:
-        data = [f.read().strip()]
-
-    server.data = dict(enumerate(data))
+    server.data = InputSplitter(fileName)
 
     logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 
     outputFileName = "words.txt"
-    buffer = ''
-
-    result = server.run_server()
-
-    for word, count in result.items():
-        buffer += word + ' ' + str(count) + '\n'
+    server.sink = TextSink(outputFileName)
 
-    with open(outputFileName, 'w') as f:
-        f.write(buffer)
+    server.run_server()
@@ -1,8 +1,23 @@
 import asyncore
+import collections
+import event_loop
 import logging
-import random
+import marshal
+import os
 import socket
+import threading
+import time
+from checkpoint import Checkpoint
+from function_cache import FunctionCache
+from input_splitter import InputSplit, InputSplitter
+from merge_worker import MergeWorker
+from metrics import Metrics, dump_json
+from partitioning import partition_of
+from result_sinks import DictSink
+from payload_codec import PayloadCodec
 from server_channel import ServerChannel
+from shuffle_store import ShuffleStore
+from task_leases import LeaseTracker
 
 
 class Server(asyncore.dispatcher, object):
@@ -11,15 +26,130 @@ class Server(asyncore.dispatcher, object):
     functions are to assigned to server before running the server. Along with the data, a TaskManager object is created
     to split the data into MapReduce tasks. The server is constantly running and listening for incoming connections.
 
+    Besides the job made of the assigned data and functions, any number of jobs can be queued with submit_job, before
+    running the server or while it runs, e.g. from the callback of a finished job. Up to max_concurrent_jobs jobs run
+    at once, clients being handed tasks of the oldest running job first. Clients stay connected across jobs, and
+    receive each job's functions once, before their first task of the job. Unless the server is persistent, clients
+    are disconnected and the server is shut down once no jobs are left.
+
+    Values can be broadcast to map and reduce functions, which read them from the broadcasts dictionary by name. A job
+    sees the broadcast values as they were when it was submitted, so iterative jobs can update a broadcast between
+    rounds. Each version of a broadcast value is sent to every client at most once.
+
+    Results of a job are written to it's result sink partition by partition, as reduce tasks finish. Unless a sink is
+    given, results are collected into a dictionary which is returned, otherwise they are never held as a whole.
+
+    Map results received by the server are decoded and merged on a background merge worker, so the event loop keeps
+    servicing clients meanwhile. While the merge worker is saturated, the server stops reading from clients and handing
+    out tasks until it catches up.
+
+    Clients send the output of large map tasks in chunks while the map function runs, followed by the rest of the output
+    when the task finishes. Chunks are staged on disk, still encoded, until the task finishes. Each client may only have
+    a window of unacknowledged chunk bytes in flight, and chunks are acknowledged once staged, so neither side holds
+    more than a few chunks of a task's output in memory. Acknowledgements are held back while more than a window of a
+    client's finished map task bytes wait on the merge worker, so staged chunks do not pile up faster than they are
+    merged.
+
+    The server records metrics of it's tasks, channels and jobs. These can be asked for by connecting to the server and
+    sending the stats command, and are periodically dumped to a JSON file if a stats path is set.
+
+    The barrier between the map and reduce phases can be softened per job. Jobs with an associative and commutative
+    reduce function may have map results folded by it as they arrive, and jobs may have partitions reduced early while
+    the last map tasks finish.
+
+    Jobs may shuffle their map outputs peer to peer. Clients then keep the outputs of their map tasks and serve them to
+    each other, the server only tracking which client holds which partitions. Reduce tasks tell clients which peers to
+    fetch their partition from, so map outputs never pass through the server.
+
+    If a checkpoint directory is set, every job logs it's finished tasks to a checkpoint in it, named after the job id.
+    A server restarted with the same checkpoint directory, and the same jobs submitted in the same order, resumes each
+    job from it's checkpoint instead of starting over. Checkpoints are removed once their job is done.
+
     Attributes:
         socket_map ([Socket]): List to which created ServerChannel instances should be added to.
         map (Function): Map function.
+        batch_map (bool): Whether the map function is a batch map function, called once per map task with the task's
+            data, e.g. the text of an input split, and returning it's output grouped by key. See
+            task_runner.batch_map_task for the forms the output may take.
         reduce (Function): Reduce function.
-        collect (Function): Collect function.
-        __data (dict): MapReduce data in dictionary format.
-        task_manager (TaskManager): TaskManager object associated to data for delegating MapReduce tasks.
+        collect (Function): Collect function. Optional combiner taking a key and a list of it's values and returning
+            a shorter list of values with the same reduce result, e.g. [sum(values)] for word count.
+        reduce_partitions (int): Number of partitions the mapped keys are hashed into for the reduce phase.
+        task_window (int): Number of tasks each client may have in flight at once.
+        compressions ([str]): Names of compressions offered to clients, in the order they are preferred. Either of
+            "zlib" or "lzma", the latter only when the lzma module is available.
+        compression_threshold (int): Minimum length of encoded command data to be compressed.
+        columnar (bool): Whether clients may send map results whose values are all ints or all floats as
+            ColumnarResults.
+        backlog (int): Maximum number of connection requests queued while waiting to be accepted.
+        shuffle_memory_limit (int): Maximum number of finished map task values held in memory before spilling them
+            to disk.
+        shuffle_directory (str/None): Directory in which finished map task data is spilled, the system default if None.
+        task_timeout (float/None): Seconds after which a task handed to a client is handed out again, or None to only
+            hand it out again when the client disconnects.
+        speculation_percentile (float): Percentile of finished task runtimes, between 0 and 1, an unfinished task has
+            to be running longer than for a speculative copy to be handed to another client.
+        target_task_duration (float): Seconds a map task should take a client, used to size input splits to the
+            measured throughput of the client they are handed to.
+        min_split_size (int): Minimum size in bytes of a sized input split.
+        max_split_size (int): Maximum size in bytes of a sized input split.
+        sink (ResultSink/None): Sink results of the job made of the assigned data and functions are written to, or None
+            to collect them into a dictionary returned by run_server.
+        peer_shuffle (bool): Whether the job made of the assigned data and functions shuffles it's map outputs peer to
+            peer, instead of through the server.
+        associative_reduce (bool): Whether the reduce function of the job made of the assigned data and functions is
+            associative and commutative, so map results are folded by it as they arrive.
+        early_reduce (bool): Whether the job made of the assigned data and functions reduces partitions while the last
+            map tasks finish.
+        merge_queue_size (int): Number of map results being decoded and merged at which the merge worker is saturated,
+            or 0 to decode and merge map results on the event loop.
+        merge_worker (MergeWorker/None): Worker decoding and merging map results, once running.
+        map_chunk_bytes (int): Estimated encoded size in bytes of a chunk of a map task's output clients send ahead of
+            finishing the task, or 0 for clients to send the output whole.
+        map_chunk_values (int): Maximum number of values of a chunk of a map task's output, whatever their size.
+        map_chunk_window (int): Number of bytes of chunks a client may have sent without them being acknowledged.
+        max_concurrent_jobs (int): Maximum number of jobs running at once.
+        persistent (bool): Whether the server keeps running and clients stay connected once no jobs are left.
+        jobs (OrderedDict): Job id to unfinished Job, in the order jobs were submitted.
+        next_job_id (int): Job id of the next submitted job.
+        broadcasts (dict): Broadcast name to it's current version and value.
+        metrics (Metrics): Metrics of tasks, encoding and decoding, and merging of map results.
+        stats_path (str/None): Path of the JSON file stats are periodically dumped to, or None not to dump them.
+        stats_interval (float): Seconds between dumps of stats.
+        last_stats_dump (float): Time stats were last dumped.
+        checkpoint_directory (str/None): Directory jobs are checkpointed to and resumed from, or None not to checkpoint.
+        checkpoint_sync_interval (float): Seconds between syncs of checkpoints to disk.
+        last_checkpoint_sync (float): Time checkpoints were last synced.
+        idle_channels (set): Server channels which were last refused a task, waiting for new tasks.
+        dispatch_pending (bool): Whether idle server channels should be refilled after the current event loop
+            iteration, as there may be new tasks.
+        last_lease_check (float): Time leases were last checked for expiry.
+        __data (dict/InputSplitter): MapReduce data in dictionary format, or an InputSplitter over input files.
+        task_manager (TaskManager/None): TaskManager of the job made of the assigned data and functions, once running.
     """
     DEFAULT_PORT = 12345
+    DEFAULT_REDUCE_PARTITIONS = 16
+    DEFAULT_TASK_WINDOW = 2
+    DEFAULT_COMPRESSIONS = ["zlib"]
+    DEFAULT_BACKLOG = socket.SOMAXCONN
+    DEFAULT_TASK_TIMEOUT = 600.0
+    DEFAULT_SPECULATION_PERCENTILE = 0.9
+
+    DEFAULT_TARGET_TASK_DURATION = 10.0
+    DEFAULT_MIN_SPLIT_SIZE = 1024 * 1024
+    DEFAULT_MAX_SPLIT_SIZE = 256 * 1024 * 1024
+    DEFAULT_MAX_CONCURRENT_JOBS = 4
+    DEFAULT_STATS_INTERVAL = 10.0
+    DEFAULT_CHECKPOINT_SYNC_INTERVAL = 5.0
+    DEFAULT_MERGE_QUEUE_SIZE = 4
+    DEFAULT_MAP_CHUNK_BYTES = 1024 * 1024
+    DEFAULT_MAP_CHUNK_VALUES = 100000
+    DEFAULT_MAP_CHUNK_WINDOW = 4 * 1024 * 1024
+
+    # Seconds between checks for expired task leases.
+    LEASE_CHECK_INTERVAL = 1.0
+    # Number of splits each client's share of the remaining input is at least cut into, so clients finish together.
+    TAIL_SPLITS_PER_CLIENT = 2
 
     def __init__(self):
         """
@@ -30,38 +160,345 @@ class Server(asyncore.dispatcher, object):
 
         # Set MapReduce functions and data members to None so they can be checked for later on.
         self.map = None
+        self.batch_map = False
         self.reduce = None
         self.collect = None
 
+        self.reduce_partitions = Server.DEFAULT_REDUCE_PARTITIONS
+        self.task_window = Server.DEFAULT_TASK_WINDOW
+        self.compressions = list(Server.DEFAULT_COMPRESSIONS)
+        self.compression_threshold = PayloadCodec.DEFAULT_COMPRESSION_THRESHOLD
+        self.columnar = True
+        self.backlog = Server.DEFAULT_BACKLOG
+        self.shuffle_memory_limit = ShuffleStore.DEFAULT_MEMORY_LIMIT
+        self.shuffle_directory = None
+        self.task_timeout = Server.DEFAULT_TASK_TIMEOUT
+        self.speculation_percentile = Server.DEFAULT_SPECULATION_PERCENTILE
+        self.target_task_duration = Server.DEFAULT_TARGET_TASK_DURATION
+        self.min_split_size = Server.DEFAULT_MIN_SPLIT_SIZE
+        self.max_split_size = Server.DEFAULT_MAX_SPLIT_SIZE
+        self.sink = None
+        self.peer_shuffle = False
+        self.associative_reduce = False
+        self.early_reduce = False
+        self.merge_queue_size = Server.DEFAULT_MERGE_QUEUE_SIZE
+        self.merge_worker = None
+        self.map_chunk_bytes = Server.DEFAULT_MAP_CHUNK_BYTES
+        self.map_chunk_values = Server.DEFAULT_MAP_CHUNK_VALUES
+        self.map_chunk_window = Server.DEFAULT_MAP_CHUNK_WINDOW
+        self.max_concurrent_jobs = Server.DEFAULT_MAX_CONCURRENT_JOBS
+        self.persistent = False
+
+        self.jobs = collections.OrderedDict()
+        self.next_job_id = 1
+        self.broadcasts = {}
+
+        self.metrics = Metrics()
+        self.stats_path = None
+        self.stats_interval = Server.DEFAULT_STATS_INTERVAL
+        self.last_stats_dump = 0.0
+
+        self.checkpoint_directory = None
+        self.checkpoint_sync_interval = Server.DEFAULT_CHECKPOINT_SYNC_INTERVAL
+        self.last_checkpoint_sync = 0.0
+
+        self.idle_channels = set()
+        self.dispatch_pending = False
+        self.last_lease_check = 0.0
+
         self.__data = None
         self.task_manager = None
 
+    def bind_server(self, address="", port=DEFAULT_PORT):
+        """
+        Bind server to address and start listening for connections, which are accepted once the server is run. Binding
+        before running lets the port be known beforehand, e.g. when binding to port 0.
+
+        Args:
+            address (str): Address for server to be bound to.
+            port (int): Port number for server to be bound to, or 0 for any free port.
+
+        Returns:
+            int: Port number the server listens on.
+        """
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.bind((address, port))
+        self.listen(self.backlog)
+
+        return self.getsockname()[1]
+
     def run_server(self, address="", port=DEFAULT_PORT):
         """
-        Run server and listen for connections, if it contains the required data and MapReduce functions.
+        Run server and listen for connections, if it contains the required data and MapReduce functions, queued jobs
+        or is persistent. Assigned data and functions are submitted as a job first. The server is bound to the given
+        address and port, unless it has been bound already.
 
         Args:
             address (str): Address for server to be started on.
             port (int): Port number for server to be started on.
 
         Returns:
-            None
+            Results of the job made of the assigned data and functions, or None if there is no such job or it's results
+            have been written to a sink.
         """
         if self.check_server_prerequisites():
-            self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.bind((address, port))
-            self.listen(1)
+            job_id = self.submit_job(self.map, self.reduce, self.data, self.collect, sink=self.sink,
+                                     batch_map=self.batch_map, peer_shuffle=self.peer_shuffle,
+                                     associative_reduce=self.associative_reduce, early_reduce=self.early_reduce)
+            self.task_manager = self.jobs[job_id].task_manager
+        elif not self.jobs and not self.persistent:
+            logging.warning("Server does not contain all functions and data necessary for MapReduce.")
+            return
 
-            logging.info("Server has been started on port %i." % port)
-            try:
-                asyncore.loop(map=self.socket_map)
-            except:
-                asyncore.close_all()
+        if self.socket is None:
+            port = self.bind_server(address, port)
+        else:
+            port = self.getsockname()[1]
 
+        if self.merge_queue_size > 0 and self.merge_worker is None:
+            self.merge_worker = MergeWorker(self.merge_queue_size, self.socket_map)
+
+        logging.info("Server has been started on port %i.", port)
+        try:
+            event_loop.loop(self.socket_map, Server.LEASE_CHECK_INTERVAL, self.tick)
+        except:
+            asyncore.close_all()
+
+        if self.task_manager is not None:
             return self.task_manager.results
+
+    def submit_job(self, map, reduce, data, collect=None, reduce_partitions=None, callback=None, sink=None,
+                   batch_map=False, peer_shuffle=False, associative_reduce=False, early_reduce=False):
+        """
+        Queue MapReduce job. Jobs can be submitted before running the server, or from the event loop while it runs.
+
+        Args:
+            map (Function): Map function.
+            reduce (Function): Reduce function.
+            data (dict/InputSplitter): MapReduce data in dictionary format, or an InputSplitter over input files.
+            collect (Function/None): Collect function.
+            reduce_partitions (int/None): Number of reduce partitions, the server's reduce partitions if None.
+            callback (Function/None): Function called with the job id and results once the job is done. Results are None
+                if they have been written to a sink.
+            sink (ResultSink/None): Sink results are written to, or None to collect them into a dictionary.
+            batch_map (bool): Whether the map function is a batch map function.
+            peer_shuffle (bool): Whether map outputs are shuffled peer to peer, instead of through the server.
+            associative_reduce (bool): Whether the reduce function is associative and commutative, e.g. a sum, so map
+                results held by the server are folded by it as they arrive. The reduce function then has to give the
+                same result for a key when called with results it gave for parts of the key's values.
+            early_reduce (bool): Whether partitions are reduced while the last map tasks finish, if the last map tasks
+                are unlikely to add values to them. Partitions the last map tasks turn out to add values to are reduced
+                again.
+
+        Returns:
+            int: Job id.
+        """
+        if reduce_partitions is None:
+            reduce_partitions = self.reduce_partitions
+        if sink is None:
+            sink = DictSink()
+
+        job = Job(self.next_job_id, map, reduce, collect, reduce_partitions, callback, dict(self.broadcasts), sink,
+                  batch_map, peer_shuffle, associative_reduce, early_reduce)
+        job.task_manager = TaskManager(data, self, job)
+        self.next_job_id += 1
+
+        self.jobs[job.job_id] = job
+        self.dispatch_pending = True
+
+        logging.debug("Job submitted: %i.", job.job_id)
+        return job.job_id
+
+    def broadcast(self, name, value):
+        """
+        Set broadcast value, exposed to map and reduce functions of jobs submitted from now on as broadcasts[name].
+
+        Args:
+            name (str): Broadcast name.
+            value: Broadcast value, serializable by the payload codec.
+
+        Returns:
+            int: Version of the broadcast value.
+        """
+        version = self.broadcasts[name][0] + 1 if name in self.broadcasts else 1
+        self.broadcasts[name] = (version, value)
+
+        logging.debug("Broadcast %s set to version %i.", name, version)
+        return version
+
+    def get_next_task(self, channel):
+        """
+        Get next task of the running jobs for a client, from the oldest running job first. No tasks are handed out
+        while the merge worker is saturated.
+
+        Args:
+            channel (ServerChannel): Channel requesting the task.
+
+        Returns:
+            (job (Job), command (str), data (str)) or (None, None, None) if there is no task for the client.
+        """
+        if self.merge_saturated():
+            return None, None, None
+
+        for job in self.jobs.values()[:self.max_concurrent_jobs]:
+            command, data = job.task_manager.get_next_task(channel)
+
+            if command is not None:
+                return job, command, data
+
+        return None, None, None
+
+    def merge_saturated(self):
+        """
+        Check whether the merge worker is saturated.
+
+        Returns:
+            Bool whether map results are waiting on the merge worker up to it's capacity.
+        """
+        return self.merge_worker is not None and self.merge_worker.saturated()
+
+    def job_done(self, job):
+        """
+        Remove finished job, tell clients which received it's functions to forget them, and pass it's results to it's
+        callback. Once no jobs are left, clients are disconnected and the server is shut down, unless it is persistent.
+
+        Args:
+            job (Job): Finished job.
+
+        Returns:
+            None
+        """
+        del self.jobs[job.job_id]
+
+        logging.info("Job done: %i.", job.job_id)
+
+        for channel in self.socket_map.values():
+            if isinstance(channel, ServerChannel):
+                channel.end_job(job.job_id)
+
+        if job.callback is not None:
+            job.callback(job.job_id, job.task_manager.results)
+
+        if not self.jobs and not self.persistent:
+            self.disconnect_clients()
+            self.handle_close()
         else:
-            logging.warning("Server does not contain all functions and data necessary for MapReduce.")
+            # Queued jobs may have started, with tasks for idle clients.
+            self.dispatch_pending = True
+
+    def tick(self):
+        """
+        Refill idle server channels if there may be new tasks, check leases, and dump stats and sync checkpoints when
+        due. Called after every event loop iteration.
+
+        Returns:
+            None
+        """
+        if self.dispatch_pending:
+            self.dispatch_tasks()
+
+        self.check_leases()
+
+        if self.stats_path is not None and time.time() - self.last_stats_dump >= self.stats_interval:
+            self.dump_stats()
+
+        if self.checkpoint_directory is not None and \
+                time.time() - self.last_checkpoint_sync >= self.checkpoint_sync_interval:
+            self.sync_checkpoints()
+
+    def sync_checkpoints(self):
+        """
+        Sync checkpoints of every job to disk.
+
+        Returns:
+            None
+        """
+        self.last_checkpoint_sync = time.time()
+
+        for job in self.jobs.itervalues():
+            if job.task_manager.checkpoint is not None:
+                job.task_manager.checkpoint.sync()
+
+    def stats(self):
+        """
+        Get metrics along with the state of every channel and job, in a JSON serializable format.
+
+        Returns:
+            dict: Metrics snapshot, with a list of channel stats under "channels" and job id to job stats under "jobs".
+        """
+        stats = self.metrics.snapshot()
+        stats["channels"] = [channel.stats() for channel in self.socket_map.values()
+                             if isinstance(channel, ServerChannel)]
+        stats["jobs"] = dict((str(job_id), job.task_manager.stats()) for job_id, job in self.jobs.iteritems())
+
+        return stats
+
+    def dump_stats(self):
+        """
+        Dump stats to the stats path. Failing to write them is logged, but does not stop the server.
+
+        Returns:
+            None
+        """
+        self.last_stats_dump = time.time()
+
+        try:
+            dump_json(self.stats(), self.stats_path)
+        except (IOError, OSError) as e:
+            logging.warning("Could not dump stats to %s: %s.", self.stats_path, e)
+
+    def release_channel(self, channel):
+        """
+        Expire leases of a closed channel in every job, so it's tasks are handed out again, along with map tasks whose
+        outputs it held.
+
+        Args:
+            channel (ServerChannel): Closed channel.
+
+        Returns:
+            int: Number of tasks to be handed out again.
+        """
+        return sum(job.task_manager.release_channel(channel) for job in self.jobs.values())
+
+    def check_leases(self):
+        """
+        Expire task leases whose deadline has passed and refill task windows of idle clients, with expired tasks or
+        speculative copies of tasks which have become slow since. Called after every event loop iteration, but only
+        checks once per lease check interval.
+
+        Returns:
+            None
+        """
+        now = time.time()
+        if now - self.last_lease_check < Server.LEASE_CHECK_INTERVAL:
+            return
+        self.last_lease_check = now
+
+        for job in self.jobs.values():
+            job.task_manager.expire_leases(now)
+        self.dispatch_tasks()
+
+    def channel_count(self):
+        """
+        Count connected clients.
+
+        Returns:
+            int: Number of server channels.
+        """
+        return sum(1 for channel in self.socket_map.itervalues() if isinstance(channel, ServerChannel))
+
+    def dispatch_tasks(self):
+        """
+        Refill task window of every idle server channel.
+
+        Returns:
+            None
+        """
+        self.dispatch_pending = False
+
+        for channel in list(self.idle_channels):
+            channel.fill_task_window()
 
     def handle_accept(self):
         """
@@ -73,7 +510,21 @@ class Server(asyncore.dispatcher, object):
         connection, address = self.accept()
         ServerChannel(connection, self.socket_map, self)
 
-        logging.debug("Server accepted client from address: (%s, %s)." % (address[0], address[1]))
+        logging.debug("Server accepted client from address: (%s, %s).", address[0], address[1])
+
+    def disconnect_clients(self):
+        """
+        Ask every client to disconnect, closing their server channels once the request has been sent. Clients which
+        never asked for another task, such as stragglers whose tasks have been finished by others, are disconnected as
+        well.
+
+        Returns:
+            None
+        """
+        for channel in self.socket_map.values():
+            if isinstance(channel, ServerChannel):
+                channel.send_command("disconnect")
+                channel.close_when_done()
 
     def handle_close(self):
         """
@@ -85,6 +536,13 @@ class Server(asyncore.dispatcher, object):
         logging.info("Server shutting down.")
         self.close()
 
+        if self.merge_worker is not None:
+            self.merge_worker.stop()
+            self.merge_worker = None
+
+        if self.stats_path is not None:
+            self.dump_stats()
+
     def check_server_prerequisites(self):
         """
         Check that required functions and data exist for MapReduce.
@@ -98,6 +556,10 @@ class Server(asyncore.dispatcher, object):
             return False
         if self.data is None:
             return False
+        if self.reduce_partitions < 1:
+            return False
+        if self.task_window < 1:
+            return False
 
         return True
 
@@ -108,138 +570,1021 @@ class Server(asyncore.dispatcher, object):
     @data.setter
     def data(self, value):
         self.__data = value
-        self.task_manager = TaskManager(self.__data, self)
+
+
+class Job(object):
+    """
+    Job is a MapReduce job queued on a server, made of it's functions and a TaskManager over it's data. Functions are
+    dumped to a binary format once, and identified to clients by the digest of their code.
+
+    Attributes:
+        job_id (int): Job id, sent to clients with every task of the job.
+        map (Function): Map function.
+        reduce (Function): Reduce function.
+        collect (Function/None): Collect function.
+        reduce_partitions (int): Number of partitions the mapped keys are hashed into for the reduce phase.
+        callback (Function/None): Function called with the job id and results once the job is done.
+        task_manager (TaskManager): TaskManager splitting the job's data into tasks.
+        function_codes (dict): Function name, "map" or "batch_map", "reduce" or "collect", to the digest and binary
+            version of it's code.
+        broadcasts (dict): Broadcast name to the version and value seen by the job.
+        sink (ResultSink): Sink results of the job are written to.
+        batch_map (bool): Whether the map function is a batch map function. It is then sent to clients as "batch_map".
+        peer_shuffle (bool): Whether map outputs are kept by clients and fetched by peers, instead of being sent to the
+            server.
+        shuffle_token (str/None): Random token peers fetching the job's map outputs have to present, with a peer to
+            peer shuffle. Only clients handed tasks of the job are told it.
+        associative_reduce (bool): Whether map results are folded by the reduce function as they arrive.
+        early_reduce (bool): Whether partitions are reduced while the last map tasks finish.
+    """
+    def __init__(self, job_id, map, reduce, collect, reduce_partitions, callback, broadcasts, sink, batch_map,
+                 peer_shuffle=False, associative_reduce=False, early_reduce=False):
+        """
+        Initialize job. It's task manager is to be assigned by the server.
+
+        Args:
+            job_id (int): Job id.
+            map (Function): Map function.
+            reduce (Function): Reduce function.
+            collect (Function/None): Collect function.
+            reduce_partitions (int): Number of partitions the mapped keys are hashed into for the reduce phase.
+            callback (Function/None): Function called with the job id and results once the job is done.
+            broadcasts (dict): Broadcast name to the version and value seen by the job.
+            sink (ResultSink): Sink results of the job are written to.
+            batch_map (bool): Whether the map function is a batch map function.
+            peer_shuffle (bool): Whether map outputs are shuffled peer to peer.
+            associative_reduce (bool): Whether map results are folded by the reduce function as they arrive.
+            early_reduce (bool): Whether partitions are reduced while the last map tasks finish.
+        """
+        self.job_id = job_id
+        self.map = map
+        self.reduce = reduce
+        self.collect = collect
+        self.reduce_partitions = reduce_partitions
+        self.callback = callback
+        self.broadcasts = broadcasts
+        self.sink = sink
+        self.batch_map = batch_map
+        self.peer_shuffle = peer_shuffle
+        self.shuffle_token = os.urandom(16).encode("hex") if peer_shuffle else None
+        self.associative_reduce = associative_reduce
+        self.early_reduce = early_reduce
+        self.task_manager = None
+
+        self.function_codes = {}
+        map_name = "batch_map" if batch_map else "map"
+        for name, func in ((map_name, map), ("reduce", reduce), ("collect", collect)):
+            if func is not None:  # Collect function does not have to exist.
+                code = marshal.dumps(func.func_code)
+                self.function_codes[name] = (FunctionCache.digest(code), code)
 
 
 class TaskManager(object):
     """
     TaskManager splits the data into MapReduce tasks for clients to process. While in the MAPPING state, data is sent
     to clients to be 'mapped'. After all map tasks have finished, the TaskManager is switched to the REDUCING state
-    where data is sent to clients to be 'reduced'. After all reduce states have finished the results are sent back to
-    the parent server.
+    where data is sent to clients to be 'reduced'. Results of each reduce task are written to the job's sink as they
+    arrive. After all reduce states have finished the parent server is told the job is done.
+
+    With an associative reduce function, values of a key are folded by it whenever map results are merged, so the
+    server holds about one value per key and reduce tasks are small. With early reduce, clients left without map tasks
+    while the last map tasks finish are handed reduce tasks of the partitions mapped so far, which the last map tasks
+    are unlikely to add values to. That is estimated from the share of finished map tasks which added values to each
+    partition, so with keys spread evenly over the partitions, as they are by hashing, no partition is reduced early.
+    Results of early reduce tasks are held until mapping is done. A partition the last map tasks add values to is
+    reduced again, and results of reduce tasks which were in flight when it changed are dropped. The reduce tasks
+    saved and those wasted are counted by the reduce.early_kept, reduce.invalidated and reduce.stale metrics.
+
+    With a peer to peer shuffle, finished map tasks only report which partitions their outputs hold, and the client
+    holding them is recorded. Reduce tasks are handed the clients to fetch their partition from. If a client holding
+    map outputs disconnects, it's map tasks are handed out again, returning to the MAPPING state if need be. Partitions
+    already reduced are not handed out again.
+
+    Map results may be handed to the parent server's merge worker still encoded, to be decoded and merged off the event
+    loop. The map task is only finished once they have been merged, so duplicates are dropped meanwhile. Reading from
+    the map results on the event loop, while merges may be running, is guarded by a lock. Chunks of a map task's data
+    the client sent ahead of finishing it are merged along with it, one chunk at a time.
+
+    If the parent server has a checkpoint directory, finished map and reduce tasks are appended to the job's checkpoint
+    before their results are used. When mapping starts, results of tasks finished before the server restarted are
+    replayed from the checkpoint, and those tasks are not handed out again. Input splits finished before the restart
+    are excluded from the splitter, so the rest of the input may be split differently than before.
 
     Attributes:
-        data (str): Data to be processed.
+        data (dict/InputSplitter): Data to be processed. Input splits are read as they are dispatched.
         parent_server (Server): Instance of parent Server.
+        job (Job): Job the data belongs to.
         state ([0|1|2|3]): The current state of data processing. Possible states: START, MAPPING, REDUCING, DONE.
-        results (dict): Results of the MapReduce job.
+        phase_started (float/None): Time the current state was entered, once mapping started.
+        results (dict/None): Results of the MapReduce job once done, if kept by the job's sink.
+        leases (LeaseTracker): Leases of map or reduce tasks that are currently being worked on.
         working_maps (dict): Map tasks that are currently being worked on; sent to clients.
-        map_iterator (dict iterator): Iterator over MapReduce data.
-        map_results (dict): Data of finished map tasks.
-        working_reduces (dict): Reduce tasks that are currently being worked on; sent to clients.
-        reduce_iter (dict iterator): Iterator over finished map tasks(map_results).
-
+        map_iterator (dict iterator/None): Iterator over MapReduce data, or None if data is an InputSplitter, which
+            is consumed split by split with splits sized for the requesting client.
+        map_results (ShuffleStore): Data of finished map tasks, partitioned by hashing each mapped key. Each
+            partition holds every mapped key hashing to it, and is sent to clients as a single reduce task.
+        working_reduces (dict): Partition number of reduce tasks that are currently being worked on to when they were
+            first handed out. Their data is read each time they are sent, rather than held while they are in flight.
+        reduce_iter (list iterator): Iterator over partition numbers of finished map tasks(map_results).
+        checkpoint (Checkpoint/None): Write-ahead log of finished tasks, or None if the job is not checkpointed.
+        finished_maps (set): Keys of map tasks over MapReduce data in dictionary format finished before the restart.
+        finished_reduces (set): Partition numbers of finished reduce tasks, including those finished before the restart.
+        map_locations (dict): Key of finished map tasks to the channel holding their outputs and the sorted numbers of
+            partitions they hold, with a peer to peer shuffle.
+        split_ends (dict): Key of finished map tasks over input splits to the end of their split, with a peer to peer
+            shuffle, so they can be handed out again.
+        lost_maps (deque): Keys of finished map tasks whose outputs have been lost, to be handed out again.
+        merging (set): Keys of map tasks whose results are being merged by the merge worker.
+        merge_lock (Lock): Lock held while map results are merged or read, as merges may run on the merge worker.
+        early_results (dict): Partition number to results of reduce tasks finished while mapping, with early reduce.
+        partition_maps (Counter): Partition number to the number of finished map tasks which added values to it, with
+            early reduce.
+        counted_maps (int): Number of finished map tasks counted in partition_maps.
+        stale_reduces (set): Channel and partition number of reduce tasks in flight whose partition changed since they
+            were handed out, and whose results are dropped.
     """
     START = 0
     MAPPING = 1
     REDUCING = 2
     DONE = 3
 
-    def __init__(self, data, parent_server):
+    # Estimated probability that the running map tasks add no values to a partition, above which it is reduced early.
+    EARLY_REDUCE_CONFIDENCE = 0.9
+
+    def __init__(self, data, parent_server, job):
 
         self.data = data
         self.parent_server = parent_server
+        self.job = job
 
         self.state = TaskManager.START
+        self.phase_started = None
         self.results = None
 
+        self.leases = LeaseTracker(parent_server.task_timeout, parent_server.speculation_percentile)
+
         self.working_maps = {}
         self.map_iterator = None
-        self.map_results = {}
+        self.map_results = None
 
         self.working_reduces = {}
         self.reduce_iter = None
 
-    def get_next_task(self):
+        self.map_locations = {}
+        self.split_ends = {}
+        self.lost_maps = collections.deque()
+
+        self.merging = set()
+        self.merge_lock = threading.Lock()
+
+        self.early_results = {}
+        self.partition_maps = collections.Counter()
+        self.counted_maps = 0
+        self.stale_reduces = set()
+
+        # Map outputs shuffled peer to peer are not held by the server, so they can not be checkpointed.
+        self.checkpoint = None
+        if parent_server.checkpoint_directory is not None and not job.peer_shuffle:
+            self.checkpoint = Checkpoint(os.path.join(parent_server.checkpoint_directory, "job-%i.log" % job.job_id))
+        self.finished_maps = set()
+        self.finished_reduces = set()
+
+    def get_next_task(self, channel):
         """
-        Get next MapReduce task for client to process. May return a map task, a reduce task, or even request to
-        disconnect if the MapReduce job is complete.
+        Get next MapReduce task for client to process. May return a map task or a reduce task. Once the MapReduce job
+        is complete, the parent server is told so.
+
+        Tasks are identified by their command and key, e.g. ("map", map_key). Every task handed out is leased to the
+        requesting channel. Tasks whose leases have expired are handed out first, then new tasks. Once there are no
+        new tasks, a speculative copy of a slow unfinished task may be handed out. Unfinished tasks are never handed to
+        a client which already has them in flight. If there is no task for the client, no task is returned.
+
+        Args:
+            channel (ServerChannel): Channel requesting the task.
 
         Returns:
-            (command (str), data (str))
+            (command (str), data (str)) or (None, None) if there is no task for the client.
         """
+        tasks_in_flight = [task[1:] for task in channel.tasks_in_flight.itervalues() if task[0] == self.job.job_id]
+        now = time.time()
+
         if self.state == TaskManager.START:
-            self.map_iterator = self.data.iteritems()
+            if not isinstance(self.data, InputSplitter):
+                self.map_iterator = self.data.iteritems()
+            self.map_results = ShuffleStore(self.job.reduce_partitions,
+                                            self.parent_server.shuffle_memory_limit,
+                                            self.parent_server.shuffle_directory,
+                                            self.fold if self.job.associative_reduce else self.job.collect)
+            if self.checkpoint is not None:
+                self.resume()
             self.state = TaskManager.MAPPING
+            self.phase_started = now
 
         if self.state == TaskManager.MAPPING:
+            task = self.leases.next_expired(self.is_unfinished, tasks_in_flight)
+            if task is not None:
+                return self.lease_task(task, channel, now, "reissued")
+
             try:
-                map_key, map_data = self.map_iterator.next()
+                map_key, map_data = self.next_map_input(channel)
+                if isinstance(map_data, InputSplit):
+                    map_data = map_data.read()
+
                 self.working_maps[map_key] = map_data
 
-                return "map", (map_key, map_data)
+                return self.lease_task(("map", map_key), channel, now, "dispatched")
             except StopIteration:  # No more new MapReduce data.
 
                 if len(self.working_maps) > 0:
-                    # Restart map task with new client, in case other client has timed out or failed.
-                    return "map", random.choice(self.working_maps.items())
+                    # Copy slow map task to new client, in case other client is a straggler.
+                    task = self.leases.speculative_task(tasks_in_flight, now)
+                    if task is not None or not self.job.early_reduce:
+                        return self.lease_task(task, channel, now, "speculative")
+
+                    # Reduce a partition while the last map tasks finish, instead of idling.
+                    return self.early_reduce_task(channel, tasks_in_flight, now)
 
-                # Switch to REDUCE state.
+                # Switch to REDUCE state. Leases of reduce tasks handed out early are kept.
                 self.state = TaskManager.REDUCING
+                self.leases.reset(lambda task: task[0] == "reduce")
+                self.end_phase("map", now)
+
+                if self.reduce_iter is None:
+                    self.job.sink.open()
+                    if self.finished_reduces:
+                        self.replay_reduces()
 
-                self.reduce_iter = self.map_results.iteritems()
-                self.working_reduces = {}
-                self.results = {}
+                if self.early_results:
+                    # Partitions reduced early which are not reduced again.
+                    self.parent_server.metrics.increment("reduce.early_kept", len(self.early_results))
+                for partition, results in sorted(self.early_results.iteritems()):
+                    self.finish_reduce(partition, results)
+                self.early_results = {}
+
+                self.reduce_iter = (partition for partition in self.reduce_partitions()
+                                    if partition not in self.finished_reduces and partition not in self.working_reduces)
 
         if self.state == TaskManager.REDUCING:
+            task = self.leases.next_expired(self.is_unfinished, tasks_in_flight)
+            if task is not None:
+                return self.lease_task(task, channel, now, "reissued")
+
             try:
-                reduce_key, reduce_data = self.reduce_iter.next()
-                self.working_reduces[reduce_key] = reduce_data
+                reduce_key = self.reduce_iter.next()
+                self.working_reduces[reduce_key] = now
 
-                return "reduce", (reduce_key, reduce_data)
+                return self.lease_task(("reduce", reduce_key), channel, now, "dispatched")
             except StopIteration:  # No more new map data.
 
                 if len(self.working_reduces) > 0:
-                    # Restart reduce task with new client, in case other client has timed out or failed.
-                    return "reduce", random.choice(self.working_reduces.items())
+                    # Copy slow reduce task to new client, in case other client is a straggler.
+                    return self.lease_task(self.leases.speculative_task(tasks_in_flight, now), channel, now,
+                                           "speculative")
 
                 self.state = TaskManager.DONE
+                self.leases.reset()
+                self.end_phase("reduce", now)
+                self.map_results.close()
+                self.job.sink.close()
+                if self.checkpoint is not None:
+                    self.checkpoint.remove()
+                self.results = self.job.sink.result()
+                self.parent_server.job_done(self.job)
+
+        return None, None
+
+    def fold(self, key, values):
+        """
+        Fold values of a key with the job's associative reduce function, used to combine map results as they are
+        merged.
+
+        Args:
+            key: Mapped key.
+            values (list): Values of the key.
+
+        Returns:
+            list: Reduce result of the values, as a single value.
+        """
+        return [self.job.reduce(key, values)]
+
+    def early_reduce_task(self, channel, tasks_in_flight, now):
+        """
+        Hand out a reduce task of a partition mapped so far which the last map tasks are unlikely to add values to,
+        while they finish.
+
+        Args:
+            channel (ServerChannel): Channel requesting the task.
+            tasks_in_flight (list): Tasks of the job already in flight to the channel.
+            now (float): Current time.
+
+        Returns:
+            (command (str), data (str)) or (None, None) if there is no partition left to reduce early.
+        """
+        # Rather than waiting on a running merge, try again once it is done.
+        if not self.merge_lock.acquire(False):
+            return None, None
+
+        try:
+            for partition in self.reduce_partitions():
+                if partition in self.finished_reduces or partition in self.early_results or \
+                        partition in self.working_reduces or ("reduce", partition) in tasks_in_flight or \
+                        not self.is_settled(partition):
+                    continue
+
+                self.working_reduces[partition] = now
+                break
+            else:
+                return None, None
+        finally:
+            self.merge_lock.release()
+
+        return self.lease_task(("reduce", partition), channel, now, "early")
+
+    def is_settled(self, partition):
+        """
+        Estimate whether the running map tasks will add no values to a partition, assuming each adds values to it with
+        the same probability as the finished map tasks did.
+
+        Args:
+            partition (int): Partition number.
+
+        Returns:
+            Bool whether the partition is unlikely to change before mapping is done.
+        """
+        if not self.counted_maps:
+            return False
+
+        untouched = 1.0 - float(self.partition_maps[partition]) / self.counted_maps
+        return untouched ** len(self.working_maps) >= TaskManager.EARLY_REDUCE_CONFIDENCE
+
+    def invalidate_reduces(self, partitions):
+        """
+        Drop results of partitions reduced early, and reduce tasks in flight for them, after map results have been added
+        to the partitions.
+
+        Args:
+            partitions (iterable): Numbers of the partitions map results have been added to.
+
+        Returns:
+            None
+        """
+        for partition in partitions:
+            if self.early_results.pop(partition, None) is not None:
+                self.parent_server.metrics.increment("reduce.invalidated")
+
+            if partition in self.working_reduces:
+                del self.working_reduces[partition]
+                for owner in self.leases.revoke(("reduce", partition)):
+                    self.stale_reduces.add((owner, partition))
+
+    def finish_reduce(self, partition, results):
+        """
+        Write results of a finished reduce task to the job's sink, logging them to the checkpoint first.
+
+        Args:
+            partition (int): Partition number.
+            results (dict): Reduced keys of the partition and their results.
+
+        Returns:
+            None
+        """
+        if self.checkpoint is not None:
+            self.checkpoint.append(("reduce_done", partition, results))
+
+        self.job.sink.write_partition(partition, results)
+        self.finished_reduces.add(partition)
+
+    def checkpoint_header(self):
+        """
+        Get first event of the job's checkpoint, identifying the job it was written for.
 
-        if self.state == TaskManager.DONE:
-            self.parent_server.handle_close()
-            return "disconnect", None
+        Returns:
+            tuple: "job", number of reduce partitions and sorted function names and digests.
+        """
+        functions = sorted((name, digest) for name, (digest, _) in self.job.function_codes.iteritems())
+        return "job", self.job.reduce_partitions, functions
+
+    def resume(self):
+        """
+        Replay map results of tasks finished before the server restarted from the job's checkpoint, and open it for
+        appending. Checkpoints written for a different job are discarded.
+
+        Returns:
+            None
+        """
+        header = self.checkpoint_header()
+        events = self.checkpoint.replay()
+
+        first_event = next(events, None)
+        if first_event is not None and first_event != header:
+            logging.warning("Discarding checkpoint %s, as it was written for a different job.", self.checkpoint.path)
+            events.close()
+            self.checkpoint.remove()
+            first_event = None
+
+        metrics = self.parent_server.metrics
+        # Chunks of a map task's data are logged right before the task itself, so chunks not followed by their task
+        # were cut short by the server dying.
+        chunks = []
+        for event in events:
+            if event[0] == "map_chunk":
+                if chunks and chunks[0][1] != event[1]:
+                    chunks = []
+                chunks.append(event)
+                continue
+
+            if event[0] in ("map_done", "map_payload"):
+                metrics.increment("map.restored")
+                if event[0] == "map_done":
+                    _, key, end, results = event
+                else:
+                    _, key, end, flags, payload = event
+                    results = PayloadCodec.decode(flags, payload)[2]
+                if isinstance(self.data, InputSplitter):
+                    self.data.exclude(key[0], key[1], end)
+                else:
+                    self.finished_maps.add(key)
+                for _, chunk_key, flags, payload in chunks:
+                    if chunk_key == key:
+                        self.map_results.add(PayloadCodec.decode(flags, payload)[2])
+                self.map_results.add(results)
+            elif event[0] == "reduce_done":
+                metrics.increment("reduce.restored")
+                self.finished_reduces.add(event[1])
+            chunks = []
+
+        self.checkpoint.open()
+        if first_event is None:
+            self.checkpoint.append(header)
+        else:
+            logging.info("Job %i resumed from checkpoint %s.", self.job.job_id, self.checkpoint.path)
+
+    def replay_reduces(self):
+        """
+        Write results of reduce tasks finished before the server restarted from the job's checkpoint to the job's sink,
+        which has just been opened.
+
+        Returns:
+            None
+        """
+        for event in self.checkpoint.replay():
+            if event[0] == "reduce_done":
+                self.job.sink.write_partition(event[1], event[2])
+
+    def end_phase(self, phase, now):
+        """
+        Record duration of the phase which just ended, and start timing the next one.
+
+        Args:
+            phase (str): Phase which ended, "map" or "reduce".
+            now (float): Current time.
+
+        Returns:
+            None
+        """
+        self.parent_server.metrics.observe(phase + ".phase_seconds", now - self.phase_started)
+        self.phase_started = now
+
+    def next_map_input(self, channel):
+        """
+        Get next MapReduce data entry, or next input split sized for the requesting client.
+
+        Args:
+            channel (ServerChannel): Channel requesting the task.
+
+        Returns:
+            (map key, map data) or raises StopIteration if there is no more MapReduce data.
+        """
+        if self.lost_maps:
+            map_key = self.lost_maps.popleft()
+            if self.map_iterator is not None:
+                return map_key, self.data[map_key]
+            return map_key, InputSplit(map_key[0], map_key[1], self.split_ends[map_key])
+
+        if self.map_iterator is not None:
+            map_key, map_data = self.map_iterator.next()
+            while map_key in self.finished_maps:
+                map_key, map_data = self.map_iterator.next()
+            return map_key, map_data
+
+        split = self.data.next_split(self.split_size(channel))
+        if split is None:
+            raise StopIteration
+
+        return (split.path, split.start), split
+
+    def reduce_partitions(self):
+        """
+        Get numbers of partitions holding any map outputs.
+
+        Returns:
+            [int]: Sorted partition numbers.
+        """
+        if not self.job.peer_shuffle:
+            return self.map_results.partitions()
+
+        return sorted(set(partition for _, partitions in self.map_locations.itervalues() for partition in partitions))
+
+    def reduce_input(self, partition):
+        """
+        Get data of a partition's reduce task: the partition's map outputs, or with a peer to peer shuffle the clients
+        to fetch them from. Once mapping is done, map outputs are read lazily as the task is sent. While mapping,
+        merges may change the map results, so the partition is read at once.
+
+        Args:
+            partition (int): Partition number.
+
+        Returns:
+            dict/generator: Mapped keys of the partition and their values, as a dictionary or a generator of
+                (key, values), or shuffle address of clients to keys of the map tasks whose outputs they hold.
+        """
+        if not self.job.peer_shuffle:
+            if self.state == TaskManager.REDUCING:
+                return self.map_results.read_partition(partition)
+
+            with self.merge_lock:
+                return dict(self.map_results.read_partition(partition))
+
+        sources = {}
+        for map_key, (channel, partitions) in self.map_locations.iteritems():
+            if partition in partitions:
+                sources.setdefault(channel.shuffle_address, []).append(map_key)
+
+        return sources
+
+    def split_size(self, channel):
+        """
+        Size input split for a client, so it takes the client about the target task duration at it's measured
+        throughput. Clients without a measured throughput get splits of the splitter's split size. Splits are capped
+        to a fraction of each client's share of the remaining input, so they shrink towards the end of the phase.
+
+        Args:
+            channel (ServerChannel): Channel requesting the task.
+
+        Returns:
+            int: Split size in bytes.
+        """
+        server = self.parent_server
+
+        if channel.throughput.bytes_per_second is None:
+            size = self.data.split_size
+        else:
+            size = int(channel.throughput.bytes_per_second * server.target_task_duration)
+
+        client_share = self.data.remaining() // max(server.channel_count(), 1)
+        size = min(size, client_share // Server.TAIL_SPLITS_PER_CLIENT)
+
+        return max(server.min_split_size, min(size, server.max_split_size))
+
+    def measure_map_data(self, map_data):
+        """
+        Measure map task data, for measuring the throughput of the client it is handed to.
+
+        Args:
+            map_data: Data of a map task.
+
+        Returns:
+            (records (int), size in bytes (int))
+        """
+        if isinstance(self.data, InputSplitter):
+            return map_data.count(self.data.record_separator), len(map_data)
+        if isinstance(map_data, basestring):
+            return 1, len(map_data)
+
+        return 1, 0
+
+    def is_unfinished(self, task):
+        """
+        Check whether a task is still being worked on.
+
+        Args:
+            task (tuple): Task, e.g. ("map", map_key).
+
+        Returns:
+            Bool whether the task is unfinished.
+        """
+        if task[0] == "map":
+            return task[1] in self.working_maps
+
+        return task[1] in self.working_reduces
+
+    def lease_task(self, task, channel, now, kind):
+        """
+        Lease task to channel, counting it by phase and kind of hand out. Data of reduce tasks is read for each hand
+        out, so it is only held while the task is being sent.
+
+        Args:
+            task (tuple/None): Task to lease, or None if there is no task for the channel.
+            channel (ServerChannel): Channel the task is handed to.
+            now (float): Current time.
+            kind (str): Kind of hand out, "dispatched", "reissued", "speculative" or "early".
+
+        Returns:
+            (command (str), data (str)) or (None, None) if there is no task.
+        """
+        if task is None:
+            return None, None
+
+        self.leases.grant(task, channel, now)
+
+        command, key = task
+        self.parent_server.metrics.increment("%s.%s" % (command, kind))
+
+        if command == "map":
+            return command, (key, self.working_maps[key])
+
+        return command, (key, self.reduce_input(key))
+
+    def task_started(self, task, channel):
+        """
+        Record that a channel's client started running a task, measuring it's runtime from now.
+
+        Args:
+            task (tuple): Started task, e.g. ("map", map_key).
+            channel (ServerChannel): Channel whose client started the task.
+
+        Returns:
+            None
+        """
+        self.leases.start(task, channel, time.time())
+
+    def expire_leases(self, now):
+        """
+        Expire leases whose deadline has passed, so their tasks are handed out again.
+
+        Args:
+            now (float): Current time.
+
+        Returns:
+            int: Number of tasks to be handed out again.
+        """
+        return self.leases.expire(now)
+
+    def release_channel(self, channel):
+        """
+        Expire leases of a closed channel, so it's tasks are handed out again. With a peer to peer shuffle, map tasks
+        whose outputs the channel held are handed out again too, if any partition they hold has not been reduced yet.
+
+        Args:
+            channel (ServerChannel): Closed channel.
+
+        Returns:
+            int: Number of tasks to be handed out again.
+        """
+        self.stale_reduces = set(stale for stale in self.stale_reduces if stale[0] is not channel)
+
+        return self.lose_map_outputs(channel) + self.leases.release(channel)
+
+    def lose_map_outputs(self, channel):
+        """
+        Queue map tasks whose outputs were held by a closed channel to be handed out again. Reduce tasks in the works
+        can not fetch those outputs, so the task manager returns to the MAPPING state until they have been recreated.
 
-    def map_done(self, data):
+        Args:
+            channel (ServerChannel): Closed channel.
+
+        Returns:
+            int: Number of map tasks to be handed out again.
+        """
+        if not self.job.peer_shuffle or self.state == TaskManager.DONE:
+            return 0
+
+        lost = [map_key for map_key, (owner, _) in self.map_locations.iteritems() if owner is channel]
+        needed = []
+        for map_key in lost:
+            _, partitions = self.map_locations.pop(map_key)
+            if any(partition not in self.finished_reduces for partition in partitions):
+                needed.append(map_key)
+
+        if not needed:
+            return 0
+
+        logging.warning("Outputs of %i map tasks of job %i lost, handing them out again.", len(needed),
+                        self.job.job_id)
+        self.parent_server.metrics.increment("map.lost", len(needed))
+        self.lost_maps.extend(needed)
+
+        if self.state == TaskManager.REDUCING:
+            self.state = TaskManager.MAPPING
+            self.leases.reset()
+            self.working_reduces = {}
+
+        return len(needed)
+
+    def map_done(self, data, channel=None, staged=None):
         """
         Handle incoming data from completed Map task.
 
         Args:
              data (dict): Completed Map task data.
+             channel (ServerChannel/None): Channel the data was received from, holding the map outputs with a peer to
+                peer shuffle.
+             staged (StagedOutput/None): Chunks of the map task data received ahead of it, if any.
 
         Returns:
             None
         """
-        if data[0] not in self.working_maps:
+        if data[0] not in self.working_maps or data[0] in self.merging:
             # This map job is already finished by someone else. Do nothing.
+            self.parent_server.metrics.increment("map.duplicate")
+            if staged is not None:
+                staged.close()
             return
 
-        logging.debug("Map job done: %s." % data[0])
+        if self.checkpoint is not None:
+            self.checkpoint_chunks(data[0], staged)
+            self.checkpoint.append(("map_done", data[0], self.split_end(data[0]), data[1]))
+
+        if self.job.peer_shuffle:
+            partitions = data[1]
+        else:
+            # Append current tasks map data to overall map results.
+            started = time.time()
+            partitions = set() if self.job.early_reduce else None
+            if staged is not None:
+                for flags, payload in staged.frames():
+                    self.add_results(PayloadCodec.decode(flags, payload)[2], partitions)
+                staged.close()
+            self.add_results(data[1], partitions)
+            self.parent_server.metrics.observe("map_results.merge_seconds", time.time() - started)
+
+        self.finish_map(data[0], partitions, channel)
+
+    def add_results(self, results, partitions):
+        """
+        Merge data of a completed Map task, or a chunk of it, into the map results. Called on the event loop or on the
+        merge worker.
+
+        Args:
+            results (dict/ColumnarResults): Mapped keys and their values.
+            partitions (set/None): Numbers of partitions of the map task's data so far, updated with those of results,
+                or None if they are not tracked.
 
-        # Append current tasks map data to overall map results.
-        for key, values in data[1].iteritems():
-            if key not in self.map_results:
-                self.map_results[key] = []
-            self.map_results[key].extend(values)
+        Returns:
+            None
+        """
+        if partitions is not None:
+            partitions.update(partition_of(key, self.job.reduce_partitions) for key in results)
+
+        with self.merge_lock:
+            self.map_results.add(results)
+
+    def checkpoint_chunks(self, key, staged):
+        """
+        Append chunks of a completed Map task's data received ahead of it to the job's checkpoint, still encoded.
+        They are appended right before the map task, one event per chunk.
+
+        Args:
+            key: Key of the map task.
+            staged (StagedOutput/None): Chunks of the map task data, if any.
+
+        Returns:
+            None
+        """
+        if staged is None:
+            return
+
+        for flags, payload in staged.frames():
+            self.checkpoint.append(("map_chunk", key, flags, payload))
+
+    def queue_map_results(self, key, flags, payload, channel, staged=None):
+        """
+        Hand encoded data of a completed Map task to the parent server's merge worker, to be decoded and merged off the
+        event loop, preceded by it's chunks received ahead of it. The map task is finished once it has been merged.
+
+        Args:
+            key: Key of the map task.
+            flags (int): Header flags the data was received with, recording it's codec.
+            payload (bytearray): Encoded job id, map task key and map task data.
+            channel (ServerChannel): Channel the data was received from.
+            staged (StagedOutput/None): Chunks of the map task data received ahead of it, if any.
+
+        Returns:
+            None
+        """
+        if key not in self.working_maps or key in self.merging:
+            # This map job is already finished by someone else, it's data is not even decoded.
+            self.parent_server.metrics.increment("map.duplicate")
+            if staged is not None:
+                staged.close()
+            return
+
+        self.merging.add(key)
+        size = len(payload) + (staged.size if staged is not None else 0)
+        channel.merge_queued(size)
+
+        if self.checkpoint is not None:
+            # Encoded data is logged as received, so it is not encoded again.
+            self.checkpoint_chunks(key, staged)
+            self.checkpoint.append(("map_payload", key, self.split_end(key), flags, str(payload)))
+
+        def merge():
+            # Runs on the merge worker, decoding and merging one chunk at a time.
+            frames = [] if staged is None else staged.frames()
+            partitions = set() if self.job.early_reduce else None
+            decode_seconds = merge_seconds = 0.0
+
+            try:
+                for frame_flags, frame in frames:
+                    started = time.time()
+                    results = PayloadCodec.decode(frame_flags, frame)[2]
+                    decoded = time.time()
+                    self.add_results(results, partitions)
+                    decode_seconds += decoded - started
+                    merge_seconds += time.time() - decoded
+            finally:
+                if staged is not None:
+                    staged.close()
+
+            started = time.time()
+            results = PayloadCodec.decode(flags, payload)[2]
+            decoded = time.time()
+            self.add_results(results, partitions)
+            return partitions, decode_seconds + decoded - started, merge_seconds + time.time() - decoded
+
+        def merged(outcome):
+            channel.merge_finished(size)
+            self.map_merged(key, channel, outcome)
+
+        self.parent_server.merge_worker.submit(merge, merged)
+
+    def map_merged(self, key, channel, outcome):
+        """
+        Finish Map task whose data has been merged by the merge worker. If decoding or merging failed, the map task is
+        handed out again.
+
+        Args:
+            key: Key of the map task.
+            channel (ServerChannel): Channel the data was received from.
+            outcome (tuple/None): Numbers of partitions of the map task data, if tracked, and seconds taken to decode
+                and merge it, or None if either failed.
+
+        Returns:
+            None
+        """
+        self.merging.discard(key)
+        self.parent_server.dispatch_pending = True
+
+        if outcome is None:
+            logging.error("Merging results of map job failed: %s.", key)
+            self.parent_server.metrics.increment("map.merge_failed")
+
+            if isinstance(self.data, InputSplitter):
+                self.split_ends[key] = self.split_end(key)
+            del self.working_maps[key]
+            self.leases.revoke(("map", key))
+            self.lost_maps.append(key)
+            return
+
+        partitions, decode_seconds, merge_seconds = outcome
+        self.parent_server.metrics.observe("decode.seconds", decode_seconds)
+        self.parent_server.metrics.observe("map_results.merge_seconds", merge_seconds)
+
+        self.finish_map(key, partitions, channel)
+
+    def split_end(self, key):
+        """
+        Get end of the input split of an unfinished map task, so the split can be excluded from the splitter on
+        restart, or handed out again.
+
+        Args:
+            key: Key of the map task.
+
+        Returns:
+            int/None: Offset after the last byte of the split, or None if the data is not an InputSplitter.
+        """
+        if not isinstance(self.data, InputSplitter):
+            return None
+
+        return key[1] + len(self.working_maps[key])
+
+    def finish_map(self, key, partitions, channel):
+        """
+        Finish Map task whose data has been merged into the map results, or is held by the client with a peer to peer
+        shuffle.
+
+        Args:
+            key: Key of the map task.
+            partitions (list/set/None): Numbers of partitions the map task data holds keys of, or None if they are not
+                tracked, as the job does not reduce early.
+            channel (ServerChannel/None): Channel the data was received from.
+
+        Returns:
+            None
+        """
+        logging.debug("Map job done: %s.", key)
+        self.parent_server.metrics.increment("map.completed")
+
+        if self.job.peer_shuffle:
+            # Map outputs stay on the client, which only reports the partitions they hold.
+            self.map_locations[key] = (channel, partitions)
+            if isinstance(self.data, InputSplitter):
+                self.split_ends[key] = self.split_end(key)
+
+        if partitions is not None and self.job.early_reduce:
+            self.partition_maps.update(partitions)
+            self.counted_maps += 1
+
+        if partitions is not None and (self.early_results or self.working_reduces):
+            self.invalidate_reduces(partitions)
 
         # Remove map task from in-progress map tasks.
-        del self.working_maps[data[0]]
+        del self.working_maps[key]
+        self.leases.finish(("map", key), time.time())
 
-    def reduce_done(self, data):
+    def reduce_done(self, data, channel=None):
         """
-        Handle incoming data from completed Reduce task.
+        Handle incoming data from completed Reduce task. Results of reduce tasks finished while mapping are held until
+        mapping is done.
 
         Args:
             data (dict): Completed Reduce task data.
+            channel (ServerChannel/None): Channel the data was received from.
 
         Returns:
             None
 
         """
+        if (channel, data[0]) in self.stale_reduces:
+            # Partition changed after this reduce task was handed out early.
+            self.stale_reduces.discard((channel, data[0]))
+            self.parent_server.metrics.increment("reduce.stale")
+            return
+
+        if data[1] is None:
+            self.fetch_failed(data[0], data[2], channel)
+            return
+
         if data[0] not in self.working_reduces:
             # This reduce job has been finished by someone else.
+            self.parent_server.metrics.increment("reduce.duplicate")
             return
 
-        logging.debug("Reduce job done: %s." % data[0])
+        logging.debug("Reduce job done: %s.", data[0])
+        self.parent_server.metrics.increment("reduce.completed")
 
-        self.results[data[0]] = data[1]
+        # Reduce task data contains the results of every key in the partition.
+        if self.state == TaskManager.MAPPING:
+            self.early_results[data[0]] = data[1]
+        else:
+            self.finish_reduce(data[0], data[1])
         del self.working_reduces[data[0]]
+        self.leases.finish(("reduce", data[0]), time.time())
+
+    def fetch_failed(self, partition, missing, channel):
+        """
+        Hand a reduce task whose client failed to fetch it's partition from peers out again right away. Map tasks whose
+        outputs were held by peers which no longer hold them are handed out again first, and the reduce task is then
+        dropped until mapping is done, as it's partition's sources change.
+
+        Args:
+            partition (int): Partition number.
+            missing ([tuple]): Shuffle addresses of peers which no longer hold outputs of the partition.
+            channel (ServerChannel/None): Channel whose client failed the task.
+
+        Returns:
+            None
+        """
+        logging.warning("Reduce job failed to fetch partition: %s.", partition)
+        self.parent_server.metrics.increment("reduce.fetch_failed")
+
+        missing = set(tuple(address) for address in missing)
+        lost_channels = set(owner for owner, _ in self.map_locations.itervalues()
+                            if tuple(owner.shuffle_address) in missing)
+
+        lost = 0
+        for owner in lost_channels:
+            lost += self.lose_map_outputs(owner)
+
+        if partition not in self.working_reduces:
+            return
+
+        if lost:
+            # Reduced early, while mapping. The partition is reduced again once it's map outputs are recreated.
+            del self.working_reduces[partition]
+            self.leases.revoke(("reduce", partition))
+        else:
+            self.leases.release_task(("reduce", partition), channel)
+
+    def stats(self):
+        """
+        Get state of the job's tasks and map results, in a JSON serializable format.
+
+        Returns:
+            dict: State name, numbers of unfinished map and reduce tasks and of held early reduce results, and map
+                results stats once mapping started.
+        """
+        state_names = ["start", "mapping", "reducing", "done"]
+
+        map_stats = None
+        if self.map_results is not None:
+            with self.merge_lock:
+                map_stats = self.map_results.stats()
+
+        return {
+            "state": state_names[self.state],
+            "working_maps": len(self.working_maps),
+            "working_reduces": len(self.working_reduces),
+            "early_results": len(self.early_results),
+            "map_results": map_stats
+        }
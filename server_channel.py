@@ -1,21 +1,79 @@
 from channel_protocol import ChannelProtocol
-import marshal
+from payload_codec import PayloadCodec
+from shuffle_store import StagedOutput
+from throughput import ThroughputMeter
+import collections
 import logging
+import socket
+import time
 
 
 class ServerChannel(ChannelProtocol):
     """
-    Server channels are created by the server to communicate with clients. Server channels send the initial map reduce
-    functions to the client, new tasks to be processed by clients, and receive processed data from clients to send
-    back to the server.
+    Server channels are created by the server to communicate with clients. Server channels offer the map reduce
+    functions of each job to the client before it's first task of the job, new tasks to be processed by clients, and
+    receive processed data from clients to send back to the server.
+
+    Functions are offered by the digest of their code. Their code is only sent if the client asks for it, not having
+    the function cached already.
+
+    Tasks are only sent once the client has accepted a codec, so other connections, such as those asking for stats,
+    are never handed tasks.
+
+    Broadcast values seen by a job are sent along with it's functions, unless the client already has their version.
+    Versions no longer seen by any job the client works on, nor current on the server, are dropped from the client.
+
+    For jobs with a peer to peer shuffle, the client is told the job's number of reduce partitions and shuffle token
+    along with it's functions. The client then keeps it's map outputs, serving them to peers from the shuffle address it
+    sends.
+
+    Map results are handed to the server's merge worker still encoded, the task they belong to being known from the
+    task id of their frame. While the merge worker is saturated, the channel stops reading from the client.
+
+    Clients are told how to chunk the output of large map tasks once they accept a codec. Chunks sent ahead of a map
+    task's results are staged still encoded, and acknowledged once staged, so the client may send more. Chunks of map
+    tasks no longer in flight are acknowledged and dropped. While more than a window of the client's chunk and results
+    bytes of finished map tasks wait on the merge worker, acknowledgements are held back until merges catch up, so the
+    client stops sending chunks. Chunks of map tasks still in flight do not count, as they can only be merged once
+    their task finishes.
+
+    Map outputs of a reduce task's partition are sent in frames of a bounded number of values, ahead of the reduce task
+    itself. The frames are produced from the partition as it is read, only once the connection is ready for them, so
+    the server never holds a partition's outputs as a whole, encoded or not.
+
+    Each server channel keeps a window of tasks in flight to it's client, so the client can start on the next task
+    without waiting on the server after sending results. The window is refilled as results arrive.
 
     Attributes:
         parent_server (Server): Instance of parent server which created this server channel.
+        task_window (int): Number of tasks the client may have in flight at once. Starts at the server's task window,
+            clients may ask for a larger one.
+        tasks_in_flight (dict): Tasks sent to the client which have not had results returned yet. Keyed by the task id
+            sent in the frame header, with values of the job id followed by the task as identified to the job's task
+            manager, e.g. (job_id, "map", map_key).
+        jobs_sent (set): Job ids whose functions have been offered to the client.
+        broadcasts_sent (set): Broadcast (name, version) pairs the client holds.
+        next_task_id (int): Task id for the next task sent to the client.
+        tasks_sent (dict): Task id of tasks in flight to the client to when they were sent.
+        map_tasks_sent (dict): Task id of map tasks in flight to the client to the number of records and bytes of
+            their data.
+        map_tasks_started (dict): Task id of map tasks in flight to the client to when the client started running them.
+        throughput (ThroughputMeter): Measured map task throughput of the client.
+        shuffle_address (tuple/None): Address and port peers fetch map outputs held by the client from, once sent.
+        staged_outputs (dict): Task id of map tasks in flight to the client to the chunks of their output received so
+            far (StagedOutput).
+        merging_bytes (int): Number of bytes of chunks and results of the client's map tasks handed to the merge worker
+            which have not been merged yet.
+        held_acks (deque): Acknowledgements held back while merges catch up, as (task id, bytes) tuples.
     """
+    # Number of map output values of a partition sent per frame ahead of it's reduce task.
+    REDUCE_INPUT_VALUES = 100000
+
     def __init__(self, connection, map, parent_server):
         """
-        Initialize server channel and it's base class. Map reduce functions are immediately sent to the client,
-        followed by the first map reduce task.
+        Initialize server channel and it's base class. Codecs are immediately offered to the client. Once the client
+        accepts a codec, it is sent a full window of map reduce tasks, each job's functions being offered before it's
+        first task.
 
         Args:
             connection (Socket): Client connection.
@@ -24,21 +82,134 @@ class ServerChannel(ChannelProtocol):
         """
         ChannelProtocol.__init__(self, connection, map)
         self.parentServer = parent_server
+        self.task_window = parent_server.task_window
+        self.tasks_in_flight = {}
+        self.jobs_sent = set()
+        self.broadcasts_sent = set()
+        self.next_task_id = 1
+        self.tasks_sent = {}
+        self.map_tasks_sent = {}
+        self.map_tasks_started = {}
+        self.throughput = ThroughputMeter()
+        self.shuffle_address = None
+        self.staged_outputs = {}
+        self.merging_bytes = 0
+        self.held_acks = collections.deque()
+        self.metrics = parent_server.metrics
+
+        self.send_command("offer_codecs", PayloadCodec.make_offer(parent_server.compressions,
+                                                                   parent_server.compression_threshold,
+                                                                   parent_server.columnar))
+
+    def fill_task_window(self):
+        """
+        Send new tasks to client until the window of tasks in flight is full, or the server has no task to give. If
+        the server has no task to give, the channel is marked idle so it is refilled once there may be new tasks.
 
-        self.send_mapreduce_functions()
-        self.start_new_task()
+        Returns:
+            None
+        """
+        while len(self.tasks_in_flight) < self.task_window:
+            if not self.start_new_task():
+                break
+        else:
+            self.parentServer.idle_channels.discard(self)
 
     def start_new_task(self):
         """
-        Get new task from server and send to client.
+        Get new task from server and send to client, preceded by an offer of the functions of it's job if they have not
+        been offered to the client yet. Tasks already in flight to the client are never sent again.
+
+        Returns:
+            Bool whether a task was sent to the client.
+        """
+        job, command, data = self.parentServer.get_next_task(self)
+
+        if command is None:
+            self.parentServer.idle_channels.add(self)
+            return False
+
+        if job.job_id not in self.jobs_sent:
+            self.send_broadcasts(job)
+            if job.peer_shuffle:
+                self.send_command("set_job_shuffle", (job.job_id, job.reduce_partitions, job.shuffle_token))
+            self.send_mapreduce_functions(job)
+
+        task_id = self.next_task_id
+        self.next_task_id += 1
+
+        self.tasks_in_flight[task_id] = (job.job_id, command, data[0])
+        self.tasks_sent[task_id] = time.time()
+        if command == "map":
+            self.map_tasks_sent[task_id] = job.task_manager.measure_map_data(data[1])
+
+        if command == "reduce" and not job.peer_shuffle:
+            self.send_reduce_input(job.job_id, data[0], data[1], task_id)
+        else:
+            self.send_command(command, (job.job_id,) + data, task_id)
+        return True
+
+    def send_reduce_input(self, job_id, partition, items, task_id):
+        """
+        Send reduce task along with it's partition's map outputs, in frames of a bounded number of values, read from
+        the partition as the connection drains. Values of a key with more values than fit in a frame are split across
+        frames. The last frame is the reduce task itself.
+
+        Args:
+            job_id (int): Job id.
+            partition (int): Partition number.
+            items (dict/iterable): Mapped keys of the partition and their values, as a dictionary or an iterable of
+                (key, values).
+            task_id (int): Task id of the reduce task.
+
+        Returns:
+            None
+        """
+        if isinstance(items, dict):
+            items = items.iteritems()
+
+        def commands():
+            frame, frame_values = {}, 0
+
+            for key, values in items:
+                for start in xrange(0, max(len(values), 1), ServerChannel.REDUCE_INPUT_VALUES):
+                    piece = values if len(values) <= ServerChannel.REDUCE_INPUT_VALUES else \
+                        values[start:start + ServerChannel.REDUCE_INPUT_VALUES]
+
+                    if frame and frame_values + len(piece) > ServerChannel.REDUCE_INPUT_VALUES:
+                        yield "reduce_input", (job_id, partition, frame)
+                        frame, frame_values = {}, 0
+
+                    frame[key] = piece
+                    frame_values += len(piece)
+
+            yield "reduce", (job_id, partition, frame)
+
+        self.send_commands_lazily(commands(), task_id)
+
+    def end_job(self, job_id):
+        """
+        Tell client a job is finished, so it can drop the job's functions. Tasks of the job still in flight are only
+        speculative copies, whose results are no longer needed, so they no longer take up the task window.
+
+        Args:
+            job_id (int): Finished job's id.
 
         Returns:
             None
         """
-        command, data = self.parentServer.task_manager.get_next_task()
+        for task_id, task in self.tasks_in_flight.items():
+            if task[0] == job_id:
+                del self.tasks_in_flight[task_id]
+                self.tasks_sent.pop(task_id, None)
+                self.map_tasks_sent.pop(task_id, None)
+                self.map_tasks_started.pop(task_id, None)
+                self.drop_staged_output(task_id)
 
-        if command is not None:
-            self.send_command(command, data)
+        if job_id in self.jobs_sent:
+            self.jobs_sent.discard(job_id)
+            self.send_command("end_job", job_id)
+            self.drop_broadcasts()
 
     def process_command(self, command, data=None):
         """
@@ -54,8 +225,14 @@ class ServerChannel(ChannelProtocol):
         Returns:
             None or NotImplementedError if command does not exist in both client and channel protocol functions.
         """
-        commands = {"map_done": self.map_done,
-                    "reduce_done": self.reduce_done
+        commands = {"accept_codecs": self.accept_codecs,
+                    "request_function": self.request_function,
+                    "map_done": self.map_done,
+                    "reduce_done": self.reduce_done,
+                    "set_task_window": self.set_task_window,
+                    "task_started": self.task_started,
+                    "set_shuffle_address": self.set_shuffle_address,
+                    "stats": self.send_stats
                     }
 
         if command in commands:
@@ -63,71 +240,398 @@ class ServerChannel(ChannelProtocol):
         else:
             ChannelProtocol.process_command(self, command, data)
 
+    def process_payload(self, command, flags, payload):
+        """
+        Hand encoded map results to the server's merge worker, to be decoded and merged off the event loop, and stage
+        chunks of map results without decoding them. Data of other commands, of map tasks no longer in flight and of
+        jobs shuffling peer to peer is decoded and processed by the parent class.
+
+        Args:
+            command (str): Command the data belongs to.
+            flags (int): Header flags of the command, recording the codec the data was encoded with.
+            payload (bytearray): Encoded data.
+
+        Returns:
+            None
+        """
+        if command == "map_chunk":
+            self.stage_chunk(flags, payload)
+            return
+
+        task = self.tasks_in_flight.get(self.task_id)
+
+        if command == "map_done" and self.parentServer.merge_worker is not None and task is not None:
+            job = self.parentServer.jobs.get(task[0])
+            if job is not None and not job.peer_shuffle:
+                staged = self.staged_outputs.pop(self.task_id, None)
+                self.finish_map_task(command)
+                job.task_manager.queue_map_results(task[2], flags, payload, self, staged)
+                self.fill_task_window()
+                self.parentServer.dispatch_tasks()
+                return
+
+        ChannelProtocol.process_payload(self, command, flags, payload)
+
+    def readable(self):
+        """
+        Channel is only read from while the server's merge worker is not saturated, so map results do not pile up
+        waiting on it.
+
+        Returns:
+            Bool whether channel should be checked for reading.
+        """
+        return not self.parentServer.merge_saturated()
+
+    def accept_codecs(self, command, data):
+        """
+        Send further commands with the codec accepted by the client, starting with how to chunk map task output and a
+        full window of tasks.
+
+        Args:
+            command (str): Command to be processed, in this case is "accept_codecs".
+            data (dict): Codec accepted by the client.
+
+        Returns:
+            None
+        """
+        self.codec = PayloadCodec.from_accepted(data)
+
+        logging.debug("Client accepted codec: %s.", data)
+
+        if self.parentServer.map_chunk_bytes > 0:
+            self.send_command("set_map_chunking", (self.parentServer.map_chunk_bytes,
+                                                   self.parentServer.map_chunk_values,
+                                                   self.parentServer.map_chunk_window))
+        self.fill_task_window()
+
+    def set_task_window(self, command, data):
+        """
+        Set number of tasks the client may have in flight at once, as asked by the client, and refill the window.
+
+        Args:
+            command (str): Command to be processed, in this case is "set_task_window".
+            data (int): Number of tasks the client may have in flight at once.
+
+        Returns:
+            None
+        """
+        self.task_window = max(data, 1)
+        self.fill_task_window()
+
+    def task_started(self, command, data):
+        """
+        Tell the task manager of a task in flight that the client started running it, so it's runtime is measured
+        from now rather than from when it was sent.
+
+        Args:
+            command (str): Command to be processed, in this case is "task_started".
+            data (None): Command has no data, the task is identified by it's task id.
+
+        Returns:
+            None
+        """
+        task = self.tasks_in_flight.get(self.task_id)
+        if task is None:
+            return
+
+        if self.task_id in self.map_tasks_sent:
+            self.map_tasks_started[self.task_id] = time.time()
+
+        job = self.parentServer.jobs.get(task[0])
+        if job is not None:
+            job.task_manager.task_started(task[1:], self)
+
+    def set_shuffle_address(self, command, data):
+        """
+        Set address peers fetch map outputs held by the client from.
+
+        Args:
+            command (str): Command to be processed, in this case is "set_shuffle_address".
+            data (tuple): Address and port of the client's shuffle endpoint.
+
+        Returns:
+            None
+        """
+        self.shuffle_address = data
+
     def map_done(self, command, data):
         """
-        Send finished map task data back to parent server. Immediately send client a new task.
+        Send finished map task data back to parent server. Immediately refill client's window of tasks, and those of
+        idle clients.
 
         Args:
             command (str): Command to be processed, in this case is "map_done".
-            data: Map task data to be sent to parent server.
+            data: Job id followed by map task data to be sent to parent server.
 
         Returns:
             None
         """
-        self.parentServer.task_manager.map_done(data)
-        self.start_new_task()
+        staged = self.staged_outputs.pop(self.task_id, None)
+        self.finish_map_task(command)
+
+        job = self.parentServer.jobs.get(data[0])
+        if job is not None:  # Results of a finished job's speculative copies are dropped.
+            job.task_manager.map_done(data[1:], self, staged)
+        elif staged is not None:
+            staged.close()
+        self.fill_task_window()
+        self.parentServer.dispatch_tasks()
 
     def reduce_done(self, command, data):
         """
-        Send finished reduce task data back to parent server. Immediately send client a new task.
+        Send finished reduce task data back to parent server. Immediately refill client's window of tasks, and those
+        of idle clients.
 
         Args:
             command (str): Command to be processed, in this case is "reduce_done".
-            data: Reduce task data to be sent to parent server.
+            data: Job id followed by reduce task data to be sent to parent server.
+
+        Returns:
+            None
+        """
+        self.tasks_in_flight.pop(self.task_id, None)
+        self.record_latency(command)
+
+        job = self.parentServer.jobs.get(data[0])
+        if job is not None:  # Results of a finished job's speculative copies are dropped.
+            job.task_manager.reduce_done(data[1:], self)
+        self.fill_task_window()
+        self.parentServer.dispatch_tasks()
+
+    def stage_chunk(self, flags, payload):
+        """
+        Stage an encoded chunk of the output of a map task in flight, and acknowledge it so the client may send more.
+        Chunks of map tasks no longer in flight are dropped, but still acknowledged. The acknowledgement is held back
+        while more than a window of the client's map task bytes wait on the merge worker.
+
+        Args:
+            flags (int): Header flags the chunk was received with, recording it's codec.
+            payload (bytearray): Encoded job id, map task key and chunk of the map task data.
+
+        Returns:
+            None
+        """
+        task = self.tasks_in_flight.get(self.task_id)
+
+        if task is not None and task[0] in self.parentServer.jobs:
+            staged = self.staged_outputs.get(self.task_id)
+            if staged is None:
+                staged = self.staged_outputs[self.task_id] = StagedOutput(self.parentServer.shuffle_directory)
+            staged.append(flags, payload)
+            self.metrics.increment("map.chunks")
+
+        # Acknowledged as a whole frame, as counted by the client.
+        size = ChannelProtocol.HEADER.size + len(payload)
+
+        if self.merging_bytes > self.parentServer.map_chunk_window:
+            self.held_acks.append((self.task_id, size))
+            self.metrics.increment("map.chunk_acks_held")
+        else:
+            self.send_command("ack_chunk", size, self.task_id)
+
+    def merge_queued(self, size):
+        """
+        Count bytes of a map task's chunks and results handed to the merge worker.
+
+        Args:
+            size (int): Number of bytes.
+
+        Returns:
+            None
+        """
+        self.merging_bytes += size
+
+    def merge_finished(self, size):
+        """
+        Uncount bytes of a map task's chunks and results once merged, or failed to, sending acknowledgements held back
+        while there is room in the window again.
+
+        Args:
+            size (int): Number of bytes.
+
+        Returns:
+            None
+        """
+        self.merging_bytes -= size
+
+        while self.held_acks and self.merging_bytes <= self.parentServer.map_chunk_window and self.connected:
+            task_id, ack_size = self.held_acks.popleft()
+            self.send_command("ack_chunk", ack_size, task_id)
+
+    def drop_staged_output(self, task_id):
+        """
+        Drop chunks staged for a map task whose results are no longer needed.
+
+        Args:
+            task_id (int): Task id of the map task.
 
         Returns:
             None
         """
-        self.parentServer.task_manager.reduce_done(data)
-        self.start_new_task()
+        staged = self.staged_outputs.pop(task_id, None)
+        if staged is not None:
+            staged.close()
 
-    def send_mapreduce_functions(self):
+    def finish_map_task(self, command):
         """
-        Send map reduce functions to clients. Functions are dumped to a binary format and sent as a command with data.
+        Stop tracking the map task whose results have been received as in flight, recording it's latency and the
+        client's throughput over the time from when the client started running it.
+
+        Args:
+            command (str): Command the results were received with, "map_done".
+
+        Returns:
+            None
+        """
+        self.tasks_in_flight.pop(self.task_id, None)
+        sent = self.record_latency(command)
+        started = self.map_tasks_started.pop(self.task_id, sent)
+        if self.task_id in self.map_tasks_sent:
+            records, size = self.map_tasks_sent.pop(self.task_id)
+            self.throughput.record(started, time.time(), records, size)
+
+    def record_latency(self, command):
+        """
+        Record latency of the task whose results have been received, from when it was sent.
+
+        Args:
+            command (str): Command the results were received with, "map_done" or "reduce_done".
+
+        Returns:
+            float/None: Time the task was sent, or None if it is no longer in flight.
+        """
+        sent = self.tasks_sent.pop(self.task_id, None)
+
+        if sent is not None:
+            self.metrics.observe(command[:-len("_done")] + ".latency", time.time() - sent)
+
+        return sent
+
+    def send_stats(self, command, data):
+        """
+        Send stats of the parent server, as asked for over the connection.
+
+        Args:
+            command (str): Command to be processed, in this case is "stats".
+            data: Not used.
+
+        Returns:
+            None
+        """
+        self.send_command("stats", self.parentServer.stats())
+
+    def stats(self):
+        """
+        Get state of the channel, in a JSON serializable format.
+
+        Returns:
+            dict: Client address, bytes sent and received, tasks in flight, task window and measured throughput.
+        """
+        try:
+            address = "%s:%s" % self.getpeername()[:2]
+        except socket.error:
+            address = None
+
+        return {
+            "address": address,
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+            "tasks_in_flight": len(self.tasks_in_flight),
+            "task_window": self.task_window,
+            "records_per_second": self.throughput.records_per_second,
+            "bytes_per_second": self.throughput.bytes_per_second
+        }
+
+    def send_mapreduce_functions(self, job):
+        """
+        Offer map reduce functions of a job to client, by the digest of their code.
+
+        Args:
+            job (Job): Job whose functions are offered.
 
         Returns:
              None
         """
-        commands_and_functions = [
-            ("set_map", self.parentServer.map),
-            ("set_reduce", self.parentServer.reduce),
-            ("set_collect", self.parentServer.collect)
-        ]
+        for name, (digest, code) in job.function_codes.iteritems():
+            self.send_command("offer_function", (job.job_id, name, digest))
 
-        for command, func in commands_and_functions:
-            if func is not None:  # Collect function does not have to exist.
-                self.send_function(command, func)
+        self.jobs_sent.add(job.job_id)
 
-    def send_function(self, command, func):
+    def send_broadcasts(self, job):
         """
-        Given command and function, send command along with function in binary format to the client.
+        Send broadcast values seen by a job which the client does not hold yet, followed by the versions the job sees.
 
         Args:
-            command (str): Command to be processed by client.
-            func (Function): Function to be sent to client in binary format.
+            job (Job): Job whose broadcast values are sent.
 
         Returns:
             None
         """
-        func_code = marshal.dumps(func.func_code)
-        self.send_command(command, func_code)
+        if not job.broadcasts:
+            return
+
+        for name, (version, value) in job.broadcasts.iteritems():
+            if (name, version) not in self.broadcasts_sent:
+                self.send_command("set_broadcast", (name, version, value))
+                self.broadcasts_sent.add((name, version))
+
+        versions = dict((name, version) for name, (version, value) in job.broadcasts.iteritems())
+        self.send_command("set_job_broadcasts", (job.job_id, versions))
+
+    def drop_broadcasts(self):
+        """
+        Drop broadcast versions from the client which no job it works on sees, and which are no longer current.
+
+        Returns:
+            None
+        """
+        needed = set((name, version) for name, (version, value) in self.parentServer.broadcasts.iteritems())
+
+        for job_id in self.jobs_sent:
+            job = self.parentServer.jobs.get(job_id)
+            if job is not None:
+                needed.update((name, version) for name, (version, value) in job.broadcasts.iteritems())
+
+        for name, version in self.broadcasts_sent - needed:
+            self.send_command("drop_broadcast", (name, version))
+            self.broadcasts_sent.discard((name, version))
+
+    def request_function(self, command, data):
+        """
+        Send code of an offered function the client does not have cached, in binary format.
+
+        Args:
+            command (str): Command to be processed, in this case is "request_function".
+            data (tuple): Job id and name of the function.
+
+        Returns:
+            None
+        """
+        job_id, name = data
+
+        job = self.parentServer.jobs.get(job_id)
+        if job is None:  # Job has finished since, and has been ended on the client.
+            return
+
+        digest, code = job.function_codes[name]
+        self.send_command("set_function", (job_id, name, code))
 
     def handle_close(self):
         """
-        Close ServerChannel and log it.
+        Close ServerChannel and log it. Tasks in flight to the client are handed to other clients.
 
         Returns:
             None
         """
         logging.debug("Server channel closing.")
         self.close()
+
+        self.metrics.increment("channel.bytes_sent", self.bytes_sent)
+        self.metrics.increment("channel.bytes_received", self.bytes_received)
+        self.parentServer.idle_channels.discard(self)
+
+        for task_id in self.staged_outputs.keys():
+            self.drop_staged_output(task_id)
+
+        if self.parentServer.release_channel(self):
+            self.parentServer.dispatch_tasks()
@@ -0,0 +1,408 @@
+import heapq
+import itertools
+import os
+import shutil
+import struct
+import tempfile
+import cPickle as pickle
+from operator import itemgetter
+
+from columnar import ColumnarResults
+from partitioning import partition_of
+
+
+class ShuffleStore(object):
+    """
+    ShuffleStore holds the data of finished map tasks, partitioned for the reduce phase by hashing each mapped key with
+    partition_of, so every process partitions keys the same way.
+
+    Map task data is buffered in memory until the number of buffered values exceeds the memory limit. The buffers are
+    then spilled to disk, as one run per partition sorted by key. A partition is read back by a k-way merge of it's
+    runs and remaining buffer, so only the partition being read is ever held in memory as a whole.
+
+    Map task data sent as ColumnarResults is kept in columns per partition, merged by concatenating the columns. With a
+    collect function, a partition's columns are compacted by grouping their keys and combining their values whenever
+    they have doubled in length since they were last compacted, and every partition's columns are compacted before
+    spilling, which only happens if that does not bring them under the memory limit.
+
+    Attributes:
+        partition_count (int): Number of partitions mapped keys are hashed into.
+        memory_limit (int): Maximum number of values buffered in memory before spilling to disk.
+        directory (str/None): Directory in which to create the spill directory, the system default if None.
+        collect (Function/None): Collect function, used to combine values of a key when merging.
+        buffers (dict): Partition number to buffered mapped keys and their values.
+        columns (dict): Partition number to ColumnarResults of buffered mapped keys and their values.
+        compacted_values (dict): Partition number to the number of values of it's columns when last compacted.
+        buffered_values (int): Number of values in buffers and columns.
+        runs (dict): Partition number to paths of the partition's spilled runs.
+        spill_directory (str/None): Directory holding spilled runs, created on the first spill.
+    """
+    DEFAULT_MEMORY_LIMIT = 10000000
+
+    # Number of values a partition's columns hold before they are first compacted.
+    MIN_COMPACTION_VALUES = 4096
+
+    def __init__(self, partition_count, memory_limit=DEFAULT_MEMORY_LIMIT, directory=None, collect=None):
+        """
+        Initialize shuffle store.
+
+        Args:
+            partition_count (int): Number of partitions mapped keys are hashed into.
+            memory_limit (int): Maximum number of values buffered in memory before spilling to disk.
+            directory (str/None): Directory in which to create the spill directory, the system default if None.
+            collect (Function/None): Collect function, used to combine values of a key when merging.
+        """
+        self.partition_count = partition_count
+        self.memory_limit = memory_limit
+        self.directory = directory
+        self.collect = collect
+
+        self.buffers = {}
+        self.columns = {}
+        self.compacted_values = {}
+        self.buffered_values = 0
+
+        self.runs = {}
+        self.spill_directory = None
+
+    def add(self, map_results):
+        """
+        Add data of a finished map task, or a chunk of it, spilling buffers to disk if the memory limit is exceeded.
+
+        Args:
+            map_results (dict/ColumnarResults): Mapped keys and their values.
+
+        Returns:
+            None
+        """
+        if isinstance(map_results, ColumnarResults):
+            self.add_columns(map_results)
+        else:
+            self.add_dict(map_results)
+
+        if self.buffered_values > self.memory_limit:
+            for partition in self.columns.keys():
+                self.compact(partition)
+
+        if self.buffered_values > self.memory_limit:
+            self.spill()
+
+    def add_columns(self, map_results):
+        """
+        Add columnar map task data, concatenating each partition's columns onto those buffered. Columns whose values
+        are of another type than those buffered for the partition are buffered as a dictionary instead.
+
+        Args:
+            map_results (ColumnarResults): Mapped keys and their values.
+
+        Returns:
+            None
+        """
+        for partition, columns in map_results.split(self.partition_count).iteritems():
+            buffered = self.columns.get(partition)
+
+            if buffered is None:
+                buffered = self.columns[partition] = columns
+            elif buffered.value_type() == columns.value_type():
+                buffered.extend(columns)
+            else:
+                self.add_dict(columns.to_dict())
+                continue
+
+            self.buffered_values += len(columns.values)
+
+            threshold = max(self.compacted_values.get(partition, 0), ShuffleStore.MIN_COMPACTION_VALUES)
+            if len(buffered.values) > 2 * threshold:
+                self.compact(partition)
+
+    def add_dict(self, map_results):
+        """
+        Add map task data held as a dictionary to the buffers.
+
+        Args:
+            map_results (dict): Mapped keys and their values.
+
+        Returns:
+            None
+        """
+        for key, values in map_results.iteritems():
+            partition = partition_of(key, self.partition_count)
+            if partition not in self.buffers:
+                self.buffers[partition] = {}
+            buffer = self.buffers[partition]
+
+            if key not in buffer:
+                buffer[key] = values
+                self.buffered_values += len(values)
+                continue
+
+            merged = buffer[key]
+            self.buffered_values -= len(merged)
+
+            merged.extend(values)
+            if self.collect is not None:
+                # Combine merged values so map results of a key do not grow with the number of map tasks.
+                merged = list(self.collect(key, merged))
+
+            buffer[key] = merged
+            self.buffered_values += len(merged)
+
+    def compact(self, partition):
+        """
+        Group the keys of a partition's buffered columns, combining the values of each key with the collect function.
+        Does nothing without a collect function, as grouping alone does not reduce the number of values.
+
+        Args:
+            partition (int): Partition number.
+
+        Returns:
+            None
+        """
+        if self.collect is None:
+            return
+
+        columns = self.columns[partition]
+        self.buffered_values -= len(columns.values)
+
+        grouped = columns.to_dict(self.collect)
+        compacted = ColumnarResults.from_dict(grouped)
+
+        if compacted is None or compacted.value_type() != columns.value_type():
+            # Collect function changed the type of the values.
+            del self.columns[partition]
+            self.compacted_values.pop(partition, None)
+            self.add_dict(grouped)
+        else:
+            self.columns[partition] = compacted
+            self.compacted_values[partition] = len(compacted.values)
+            self.buffered_values += len(compacted.values)
+
+    def partition_buffer(self, partition):
+        """
+        Get buffered mapped keys of a partition and their values, grouping buffered columns into the buffer.
+
+        Args:
+            partition (int): Partition number.
+
+        Returns:
+            dict: Buffered mapped keys of the partition and their values.
+        """
+        buffer = self.buffers.get(partition, {})
+        columns = self.columns.get(partition)
+
+        if columns is None:
+            return buffer
+
+        grouped = columns.to_dict(self.collect)
+        for key, values in buffer.iteritems():
+            if key not in grouped:
+                grouped[key] = values
+                continue
+
+            grouped[key].extend(values)
+            if self.collect is not None:
+                grouped[key] = list(self.collect(key, grouped[key]))
+
+        return grouped
+
+    def spill(self):
+        """
+        Write every buffer to disk as a run sorted by key, and empty the buffers.
+
+        Returns:
+            None
+        """
+        if self.spill_directory is None:
+            self.spill_directory = tempfile.mkdtemp(prefix="shuffle-", dir=self.directory)
+
+        for partition in set(self.buffers) | set(self.columns):
+            buffer = self.partition_buffer(partition)
+
+            if partition not in self.runs:
+                self.runs[partition] = []
+            path = os.path.join(self.spill_directory, "%i-%i.run" % (partition, len(self.runs[partition])))
+
+            with open(path, "wb") as f:
+                for key in sorted(buffer):
+                    pickle.dump((key, buffer[key]), f, pickle.HIGHEST_PROTOCOL)
+
+            self.runs[partition].append(path)
+
+        self.buffers = {}
+        self.columns = {}
+        self.compacted_values = {}
+        self.buffered_values = 0
+
+    def partitions(self):
+        """
+        Get numbers of partitions holding any data.
+
+        Returns:
+            [int]: Sorted partition numbers.
+        """
+        return sorted(set(self.buffers) | set(self.columns) | set(self.runs))
+
+    @staticmethod
+    def read_run(path, index):
+        """
+        Lazily read spilled run from disk.
+
+        Args:
+            path (str): Path of the run.
+            index (int): Index of the run, used to order equal keys of different runs.
+
+        Returns:
+            Generator of (key, index, values), in key order.
+        """
+        with open(path, "rb") as f:
+            while True:
+                try:
+                    key, values = pickle.load(f)
+                except EOFError:
+                    return
+                yield key, index, values
+
+    def read_partition(self, partition):
+        """
+        Lazily read all mapped keys of a partition and their values, merging spilled runs with the partition's buffer.
+        Only the partition's buffer and one key of each spilled run are held in memory at a time, so a partition larger
+        than memory can be read as long as it is consumed as it is read.
+
+        Args:
+            partition (int): Partition number.
+
+        Returns:
+            Generator of (key, values), in key order if the partition has spilled runs.
+        """
+        buffer = self.partition_buffer(partition)
+        runs = self.runs.get(partition)
+
+        if not runs:
+            for key, values in buffer.iteritems():
+                yield key, values
+            return
+
+        streams = [self.read_run(path, index) for index, path in enumerate(runs)]
+        streams.append((key, len(runs), buffer[key]) for key in sorted(buffer))
+
+        for key, group in itertools.groupby(heapq.merge(*streams), key=itemgetter(0)):
+            values = []
+            for _, _, run_values in group:
+                values.extend(run_values)
+
+            if self.collect is not None:
+                values = list(self.collect(key, values))
+
+            yield key, values
+
+    def close(self):
+        """
+        Remove spilled runs from disk and drop buffers.
+
+        Returns:
+            None
+        """
+        if self.spill_directory is not None:
+            shutil.rmtree(self.spill_directory, ignore_errors=True)
+            self.spill_directory = None
+
+        self.buffers = {}
+        self.columns = {}
+        self.compacted_values = {}
+        self.buffered_values = 0
+        self.runs = {}
+
+    def stats(self):
+        """
+        Get size of the held map task data, in a JSON serializable format.
+
+        Returns:
+            dict: Numbers of buffered keys and values, size in bytes of buffered columns, and number and total size in
+                bytes of spilled runs.
+        """
+        run_paths = [path for paths in self.runs.itervalues() for path in paths]
+
+        return {
+            "buffered_keys": (sum(len(buffer) for buffer in self.buffers.itervalues()) +
+                              sum(len(columns) for columns in self.columns.itervalues())),
+            "buffered_values": self.buffered_values,
+            "columnar_bytes": sum(columns.nbytes() for columns in self.columns.itervalues()),
+            "spilled_runs": len(run_paths),
+            "spilled_bytes": sum(os.path.getsize(path) for path in run_paths)
+        }
+
+
+class StagedOutput(object):
+    """
+    StagedOutput holds the chunks of a map task's output a client sent ahead of finishing the task, until the task is
+    finished and they are merged, or dropped. Chunks are kept still encoded, in a temporary file, so the server holds
+    none of them in memory meanwhile. The file is removed once closed.
+
+    Attributes:
+        directory (str/None): Directory in which the file is created, the system default if None.
+        file (file/None): File holding the chunks, created on the first chunk.
+        chunks (int): Number of chunks held.
+        size (int): Number of bytes of encoded chunks held.
+    """
+
+    # Flags and length of each chunk.
+    HEADER = struct.Struct("!BI")
+
+    def __init__(self, directory=None):
+        """
+        Initialize staged output.
+
+        Args:
+            directory (str/None): Directory in which the file is created, the system default if None.
+        """
+        self.directory = directory
+        self.file = None
+        self.chunks = 0
+        self.size = 0
+
+    def append(self, flags, payload):
+        """
+        Append an encoded chunk.
+
+        Args:
+            flags (int): Header flags the chunk was received with, recording it's codec.
+            payload (bytearray): Encoded chunk.
+
+        Returns:
+            None
+        """
+        if self.file is None:
+            self.file = tempfile.TemporaryFile(prefix="staged-", dir=self.directory)
+
+        self.file.write(StagedOutput.HEADER.pack(flags, len(payload)))
+        self.file.write(payload)
+        self.chunks += 1
+        self.size += len(payload)
+
+    def frames(self):
+        """
+        Lazily read back the encoded chunks, in the order they were appended.
+
+        Returns:
+            Generator of (flags (int), payload (str)) tuples.
+        """
+        if self.file is None:
+            return
+
+        self.file.seek(0)
+        for _ in xrange(self.chunks):
+            flags, length = StagedOutput.HEADER.unpack(self.file.read(StagedOutput.HEADER.size))
+            yield flags, self.file.read(length)
+
+        self.file.seek(0, os.SEEK_END)
+
+    def close(self):
+        """
+        Close and remove the file holding the chunks.
+
+        Returns:
+            None
+        """
+        if self.file is not None:
+            self.file.close()
+            self.file = None
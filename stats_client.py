@@ -0,0 +1,72 @@
+import event_loop
+import socket
+
+from channel_protocol import ChannelProtocol
+
+
+class StatsClient(ChannelProtocol):
+    """
+    StatsClient connects to a server only to ask for it's stats. It never accepts a codec, so the server never hands it
+    tasks, and disconnects once the stats have been received.
+
+    Attributes:
+        stats (dict/None): Stats sent by the server, once received.
+    """
+    def __init__(self):
+        """
+        Initialize stats client and it's parent class. Stats client runs on it's own socket map, so it can be used
+        next to a running client or server.
+        """
+        ChannelProtocol.__init__(self, socket_map={})
+
+        self.stats = None
+
+    def request_stats(self, server_address, server_port):
+        """
+        Connect to server at given address and ask for it's stats.
+
+        Args:
+            server_address (str): Server address.
+            server_port (int): Server port number.
+
+        Returns:
+            dict/None: Stats of the server, or None if the connection closed before they were received.
+        """
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect((server_address, server_port))
+
+        self.send_command("stats")
+        event_loop.loop(self._map)
+
+        return self.stats
+
+    def process_command(self, command, data=None):
+        """
+        Keep stats and disconnect once they are received. Every other command is ignored.
+
+        Args:
+            command (str): Command to process.
+            data (None/str): Data to process with command, if exists.
+
+        Returns:
+            None
+        """
+        if command == "stats":
+            self.stats = data
+            self.handle_close()
+        elif command == "disconnect":
+            self.handle_close()
+
+
+def request_stats(server_address, server_port):
+    """
+    Ask server at given address for it's stats.
+
+    Args:
+        server_address (str): Server address.
+        server_port (int): Server port number.
+
+    Returns:
+        dict/None: Stats of the server, or None if the connection closed before they were received.
+    """
+    return StatsClient().request_stats(server_address, server_port)
@@ -0,0 +1,263 @@
+import bisect
+import collections
+
+Lease = collections.namedtuple("Lease", ["owner", "granted", "started"])
+
+
+class LeaseTracker(object):
+    """
+    LeaseTracker keeps track of which server channels unfinished tasks have been handed to, and since when. Every
+    hand out of a task grants a lease to the channel. Leases expire when their channel closes or their deadline
+    passes, and a task left without leases is queued to be handed out again.
+
+    Clients queue tasks handed to them ahead of time, so a lease is only considered running once the client reports
+    it started the task. Runtimes are measured from then, so time spent waiting in a client's task window does not
+    count. The deadline of a lease runs from it's grant until the task is started, and from it's start afterwards.
+
+    Runtimes of finished tasks are recorded, so tasks which have been running longer than a percentile of them can be
+    handed out speculatively to another channel. A task not started yet is only handed out speculatively if it's client
+    is running such a slow task, as it then waits behind a straggler.
+
+    Tasks are identified by their command and key, e.g. ("map", map_key).
+
+    Attributes:
+        timeout (float/None): Seconds after which a lease expires, or None if leases only expire with their channel.
+        speculation_percentile (float): Percentile of finished task runtimes, between 0 and 1, a task has to be running
+            longer than to be handed out speculatively.
+        leases (OrderedDict): Task to it's leases, oldest tasks first.
+        expired (deque): Tasks left without leases, waiting to be handed out again.
+        runtimes ([float]): Sorted runtimes of finished tasks.
+    """
+    def __init__(self, timeout, speculation_percentile):
+        """
+        Initialize lease tracker.
+
+        Args:
+            timeout (float/None): Seconds after which a lease expires, or None if leases only expire with their channel.
+            speculation_percentile (float): Percentile of finished task runtimes a task has to be running longer than
+                to be handed out speculatively.
+        """
+        self.timeout = timeout
+        self.speculation_percentile = speculation_percentile
+
+        self.leases = collections.OrderedDict()
+        self.expired = collections.deque()
+        self.runtimes = []
+
+    def reset(self, keep=None):
+        """
+        Forget runtimes and expired tasks, when switching to tasks of another state.
+
+        Args:
+            keep (func/None): Predicate on a task, whether it's leases are kept, e.g. for tasks of the next state which
+                have been handed out early.
+
+        Returns:
+            None
+        """
+        for task in self.leases.keys():
+            if keep is None or not keep(task):
+                del self.leases[task]
+
+        self.expired.clear()
+        self.runtimes = []
+
+    def revoke(self, task):
+        """
+        Drop leases of a task without queueing it to be handed out again, e.g. after it's data changed.
+
+        Args:
+            task (tuple): Task whose leases are dropped.
+
+        Returns:
+            [ServerChannel]: Channels the task had been handed to.
+        """
+        return [lease.owner for lease in self.leases.pop(task, [])]
+
+    def grant(self, task, owner, now):
+        """
+        Grant lease of task to a channel.
+
+        Args:
+            task (tuple): Task being handed out.
+            owner (ServerChannel): Channel the task is handed to.
+            now (float): Current time.
+
+        Returns:
+            None
+        """
+        if task not in self.leases:
+            self.leases[task] = []
+        self.leases[task].append(Lease(owner, now, None))
+
+    def start(self, task, owner, now):
+        """
+        Record that the client of a channel started running a task leased to it. Later reports are ignored.
+
+        Args:
+            task (tuple): Started task.
+            owner (ServerChannel): Channel whose client started the task.
+            now (float): Current time.
+
+        Returns:
+            None
+        """
+        leases = self.leases.get(task)
+
+        if leases:
+            self.leases[task] = [lease._replace(started=now) if lease.owner is owner and lease.started is None
+                                 else lease for lease in leases]
+
+    def finish(self, task, now):
+        """
+        Drop leases of a finished task, recording it's runtime from the earliest start of any of it's leases. A task
+        none of whose leases was reported started is not recorded.
+
+        Args:
+            task (tuple): Finished task.
+            now (float): Current time.
+
+        Returns:
+            None
+        """
+        starts = [lease.started for lease in self.leases.pop(task, []) if lease.started is not None]
+
+        if starts:
+            bisect.insort(self.runtimes, now - min(starts))
+
+    def release(self, owner):
+        """
+        Expire every lease of a channel, after the channel has been closed.
+
+        Args:
+            owner (ServerChannel): Closed channel.
+
+        Returns:
+            int: Number of tasks left without leases.
+        """
+        return self.expire_leases(lambda lease: lease.owner is owner)
+
+    def release_task(self, task, owner):
+        """
+        Expire the lease of a task held by a channel, after it's client failed the task, queueing the task to be handed
+        out again right away unless another channel holds a lease of it.
+
+        Args:
+            task (tuple): Failed task.
+            owner (ServerChannel): Channel whose client failed the task.
+
+        Returns:
+            Bool whether the task was queued to be handed out again.
+        """
+        leases = self.leases.get(task)
+        if not leases:
+            return False
+
+        remaining = [lease for lease in leases if lease.owner is not owner]
+        if remaining:
+            self.leases[task] = remaining
+            return False
+
+        del self.leases[task]
+        self.expired.append(task)
+        return True
+
+    def expire(self, now):
+        """
+        Expire leases whose deadline has passed.
+
+        Args:
+            now (float): Current time.
+
+        Returns:
+            int: Number of tasks left without leases.
+        """
+        if self.timeout is None:
+            return 0
+
+        return self.expire_leases(lambda lease: now - (lease.granted if lease.started is None else lease.started) >=
+                                  self.timeout)
+
+    def expire_leases(self, is_expired):
+        """
+        Drop leases matching a predicate, queueing tasks left without leases to be handed out again.
+
+        Args:
+            is_expired (func): Predicate on a lease, whether it has expired.
+
+        Returns:
+            int: Number of tasks left without leases.
+        """
+        expired_count = 0
+
+        for task, leases in self.leases.items():
+            remaining = [lease for lease in leases if not is_expired(lease)]
+
+            if len(remaining) == len(leases):
+                continue
+
+            if remaining:
+                self.leases[task] = remaining
+            else:
+                del self.leases[task]
+                self.expired.append(task)
+                expired_count += 1
+
+        return expired_count
+
+    def next_expired(self, is_unfinished, tasks_in_flight):
+        """
+        Take the oldest expired task which is still unfinished and not already in flight to the requesting channel.
+
+        Args:
+            is_unfinished (func): Predicate on a task, whether it is still unfinished.
+            tasks_in_flight (list): Tasks already in flight to the requesting channel.
+
+        Returns:
+            tuple/None: Expired task, or None if there is none for the channel.
+        """
+        for _ in xrange(len(self.expired)):
+            task = self.expired.popleft()
+
+            if not is_unfinished(task):
+                continue
+            if task in tasks_in_flight:
+                self.expired.append(task)
+                continue
+
+            return task
+
+        return None
+
+    def speculative_task(self, tasks_in_flight, now):
+        """
+        Find a task worth running a speculative copy of: a task with a single lease, started by it's client longer ago
+        than the speculation percentile of finished task runtimes, and not already in flight to the requesting channel.
+        A task not started yet is only copied if another task of it's client is that slow.
+
+        Args:
+            tasks_in_flight (list): Tasks already in flight to the requesting channel.
+            now (float): Current time.
+
+        Returns:
+            tuple/None: Task to copy, or None if no task is slow enough.
+        """
+        if not self.runtimes:
+            return None
+
+        threshold = self.runtimes[int(self.speculation_percentile * (len(self.runtimes) - 1))]
+
+        def is_slow(lease):
+            return lease.started is not None and now - lease.started > threshold
+
+        # Channels running a slow task, whose tasks not started yet wait behind it.
+        slow_owners = set(lease.owner for leases in self.leases.itervalues() for lease in leases if is_slow(lease))
+
+        for task, leases in self.leases.iteritems():
+            if len(leases) != 1 or task in tasks_in_flight or leases[0].owner not in slow_owners:
+                continue
+
+            if leases[0].started is None or is_slow(leases[0]):
+                return task
+
+        return None
@@ -0,0 +1,379 @@
+import asyncore
+import collections
+import marshal
+import os
+import traceback
+import types
+import cPickle as pickle
+
+from columnar import ColumnarResults
+from map_stream import MapStream, spool_map_stream
+
+# Functions of recent jobs in a worker process, by job id, built on the worker's first task of each job.
+worker_functions = collections.OrderedDict()
+
+# Number of jobs whose functions are kept built in a worker process.
+WORKER_JOB_CACHE_SIZE = 4
+
+# Broadcast values loaded in a worker process, by name, along with their version.
+worker_broadcasts = {}
+
+
+def function_globals(broadcast_values):
+    """
+    Create globals for the functions of a job, exposing the job's broadcast values to them as the broadcasts
+    dictionary. Every job's functions have globals of their own, so functions of jobs processed side by side, or by
+    clients running in threads of one process, never see each other's broadcast values.
+
+    Args:
+        broadcast_values (dict): Broadcast name to value.
+
+    Returns:
+        dict: Function globals.
+    """
+    return {"__builtins__": __builtins__, "broadcasts": broadcast_values}
+
+
+def build_function(code, name, namespace=None):
+    """
+    Build function from it's binary code, as sent by the server.
+
+    Args:
+        code (str): Binary version of function code.
+        name (str): Name of the function.
+        namespace (dict/None): Globals of the function, as created by function_globals, or globals without broadcast
+            values if None.
+
+    Returns:
+        Function built from given code.
+    """
+    if namespace is None:
+        namespace = function_globals({})
+
+    return types.FunctionType(marshal.loads(code), namespace, name)
+
+
+def bind_function(function, namespace):
+    """
+    Rebuild function with other globals, sharing it's code.
+
+    Args:
+        function (Function): Function built from server code.
+        namespace (dict): Globals of the rebuilt function, as created by function_globals.
+
+    Returns:
+        Function with given globals.
+    """
+    return types.FunctionType(function.func_code, namespace, function.func_name, function.func_defaults,
+                              function.func_closure)
+
+
+def map_task(map_fn, collect_fn, data):
+    """
+    Map given data with map function, combining the values of each key with collect function if it exists.
+
+    Args:
+        map_fn (func): Map function.
+        collect_fn (func/None): Collect function.
+        data (tuple): Map key and data being mapped.
+
+    Returns:
+        dict: Mapped keys and their values.
+    """
+    results = {}
+
+    for k, v in map_fn(data[0], data[1]):
+        if k not in results:
+            results[k] = []
+
+        results[k].append(v)
+
+    if collect_fn is not None:
+        # Combine values of each key before sending, reducing the amount of data sent back to the server.
+        for k, values in results.iteritems():
+            results[k] = list(collect_fn(k, values))
+
+    return results
+
+
+def batch_map_task(batch_map_fn, collect_fn, data):
+    """
+    Map given data with batch map function, called once with the whole task data, combining the values of each key
+    with collect function if it exists.
+
+    The batch map function returns it's output grouped by key, as either:
+        - a mapping of key to list of values,
+        - a mapping of key to a single value, such as a collections.Counter,
+        - a tuple of NumPy arrays of keys and their values, grouped without a Python level loop per pair.
+
+    Args:
+        batch_map_fn (func): Batch map function.
+        collect_fn (func/None): Collect function.
+        data (tuple): Map key and data being mapped.
+
+    Returns:
+        dict/ColumnarResults: Mapped keys and their values, in columns if they were returned as NumPy arrays of ints or
+            floats and there is no collect function.
+    """
+    output = batch_map_fn(data[0], data[1])
+
+    if isinstance(output, tuple):
+        results = group_arrays(*output)
+        if isinstance(results, ColumnarResults):
+            return results if collect_fn is None else results.to_dict(collect_fn)
+    else:
+        results = {}
+        for k, values in output.iteritems():
+            results[k] = values if isinstance(values, list) else [values]
+
+    if collect_fn is not None:
+        for k, values in results.iteritems():
+            results[k] = list(collect_fn(k, values))
+
+    return results
+
+
+def group_arrays(keys, values):
+    """
+    Group NumPy array of values by the array of their keys. Keys are sorted once, and values split at the boundaries
+    between keys, so grouping does not loop over every pair in Python. Ints and floats are kept in columns, as
+    ColumnarResults built from the raw buffers of the sorted arrays, so they are never boxed one by one. Other values
+    are converted to Python objects so results can be sent with any codec.
+
+    Args:
+        keys (numpy.ndarray): Key of every value.
+        values (numpy.ndarray): Values, along the first axis.
+
+    Returns:
+        dict/ColumnarResults: Keys and their values.
+    """
+    import numpy
+
+    if len(keys) == 0:
+        return {}
+
+    order = numpy.argsort(keys, kind="mergesort")
+    keys = keys[order]
+    values = values[order]
+
+    boundaries = numpy.flatnonzero(keys[1:] != keys[:-1]) + 1
+    starts = numpy.concatenate(([0], boundaries))
+    group_keys = keys[starts].tolist()
+
+    # Unsigned ints as wide as the widest int typecode may not fit in it.
+    if values.ndim == 1 and (values.dtype.kind in "if" or (values.dtype.kind == "u" and values.dtype.itemsize < 8)):
+        return ColumnarResults.from_arrays(group_keys, numpy.diff(numpy.append(starts, len(values))), values)
+
+    groups = numpy.split(values, boundaries)
+
+    return dict(zip(group_keys, [group.tolist() for group in groups]))
+
+
+def map_with(functions, data):
+    """
+    Map given data with the job's map or batch map function, whichever it has.
+
+    Args:
+        functions (dict): Function name, "map" or "batch_map", "reduce" and optionally "collect", to function.
+        data (tuple): Map key and data being mapped.
+
+    Returns:
+        dict: Mapped keys and their values.
+    """
+    if "batch_map" in functions:
+        return batch_map_task(functions["batch_map"], functions.get("collect"), data)
+
+    return map_task(functions["map"], functions.get("collect"), data)
+
+
+def map_output(functions, data):
+    """
+    Map given data lazily with the job's map function, so it's output can be consumed while the map function runs. A
+    batch map function is called at once, it's output being grouped by key. Values are not combined by the collect
+    function.
+
+    Args:
+        functions (dict): Function name, "map" or "batch_map", "reduce" and optionally "collect", to function.
+        data (tuple): Map key and data being mapped.
+
+    Returns:
+        (iterable of (key, value) or (key, values) pairs, whether values are grouped by key (bool))
+    """
+    if "batch_map" in functions:
+        return batch_map_task(functions["batch_map"], None, data).iteritems(), True
+
+    return functions["map"](data[0], data[1]), False
+
+
+def reduce_task(reduce_fn, data):
+    """
+    Reduce every key of a mapped data partition with reduce function.
+
+    Args:
+        reduce_fn (func): Reduce function.
+        data (tuple): Partition number and mapped keys and their values being reduced, as a dictionary or an iterable
+            of (key, values).
+
+    Returns:
+        dict: Reduced keys and their results.
+    """
+    results = {}
+    items = data[1].iteritems() if isinstance(data[1], dict) else data[1]
+
+    for k, values in items:
+        results[k] = reduce_fn(k, values)
+
+    return results
+
+
+def job_functions(job_id, function_codes, broadcast_files):
+    """
+    Get functions of a job in a worker process, building them on the worker's first task of the job along with the
+    job's broadcast values. Functions of the least recently started job are dropped once more jobs than the cache
+    size have been seen.
+
+    Args:
+        job_id (int): Job id.
+        function_codes (dict): Function name, "map" or "batch_map", "reduce" or "collect", to binary version of
+            function code.
+        broadcast_files (dict): Broadcast name to it's version and the path of the file holding it's value.
+
+    Returns:
+        dict: Function name to function.
+    """
+    if job_id not in worker_functions:
+        namespace = function_globals(load_broadcasts(broadcast_files))
+        worker_functions[job_id] = dict((name, build_function(code, name, namespace))
+                                        for name, code in function_codes.iteritems())
+
+        if len(worker_functions) > WORKER_JOB_CACHE_SIZE:
+            worker_functions.popitem(last=False)
+
+    return worker_functions[job_id]
+
+
+def load_broadcasts(broadcast_files):
+    """
+    Load broadcast values seen by a job in a worker process, reading versions the worker does not have from the
+    files written by the client.
+
+    Args:
+        broadcast_files (dict): Broadcast name to it's version and the path of the file holding it's value.
+
+    Returns:
+        dict: Broadcast name to value.
+    """
+    values = {}
+
+    for name, (version, path) in broadcast_files.iteritems():
+        if name not in worker_broadcasts or worker_broadcasts[name][0] != version:
+            with open(path, "rb") as f:
+                worker_broadcasts[name] = (version, pickle.load(f))
+
+        values[name] = worker_broadcasts[name][1]
+
+    return values
+
+
+def run_task(command, job_id, function_codes, broadcast_files, data, chunk_bytes=0, chunk_values=0, spool_path=None,
+             notify_fd=None):
+    """
+    Run map or reduce task in a worker process. Exceptions are caught so they can be reported by the client.
+
+    With chunk bytes, the output of a map task is written to a file in chunks as it is produced, instead of being
+    returned, so neither the worker nor the client hold it as a whole.
+
+    Args:
+        command (str): Task command, "map" or "reduce".
+        job_id (int): Job id of the task.
+        function_codes (dict): Binary versions of the job's functions by name.
+        broadcast_files (dict): Broadcast name to it's version and the path of the file holding it's value.
+        data (tuple): Task data.
+        chunk_bytes (int): Estimated encoded size in bytes of a chunk of a map task's output written to the file, or 0
+            to return the output whole.
+        chunk_values (int): Maximum number of values of a chunk, whatever their size.
+        spool_path (str/None): Path of the file chunks of a map task's output are written to, with chunk bytes.
+        notify_fd (int/None): Write end of the pipe the client is notified of written chunks through, if any.
+
+    Returns:
+        (succeeded (bool), task results, number of chunks written or formatted exception)
+    """
+    try:
+        functions = job_functions(job_id, function_codes, broadcast_files)
+
+        if command == "map" and chunk_bytes:
+            pairs, grouped = map_output(functions, data)
+            stream = MapStream(job_id, data[0], None, pairs, grouped, functions.get("collect"), chunk_bytes,
+                               chunk_values)
+            return True, spool_map_stream(stream, spool_path, notify_fd)
+
+        if command == "map":
+            return True, map_with(functions, data)
+
+        return True, reduce_task(functions["reduce"], data)
+    except Exception:
+        return False, traceback.format_exc()
+
+
+class TaskNotifier(asyncore.file_dispatcher):
+    """
+    TaskNotifier wakes up the event loop when a worker process finishes a task. Worker pool result callbacks run on a
+    separate thread, so they notify the event loop by writing to a pipe the notifier reads from.
+
+    Attributes:
+        write_fd (int): Write end of the pipe.
+        on_notify (func): Function called from the event loop after being notified.
+    """
+    def __init__(self, on_notify, socket_map=None):
+        """
+        Initialize task notifier and it's parent class.
+
+        Args:
+            on_notify (func): Function called from the event loop after being notified.
+            socket_map (map[socket]): Socket map to which to be added to, if exists.
+        """
+        read_fd, self.write_fd = os.pipe()
+        asyncore.file_dispatcher.__init__(self, read_fd, map=socket_map)
+
+        # Parent class works on a duplicate of the read end.
+        os.close(read_fd)
+
+        self.on_notify = on_notify
+
+    def notify(self):
+        """
+        Wake up the event loop. Safe to call from any thread.
+
+        Returns:
+            None
+        """
+        os.write(self.write_fd, "\0")
+
+    def writable(self):
+        """
+        Notifier is never written to from the event loop.
+
+        Returns:
+            False
+        """
+        return False
+
+    def handle_read(self):
+        """
+        Drain the pipe and call notified function.
+
+        Returns:
+            None
+        """
+        self.recv(4096)
+        self.on_notify()
+
+    def handle_close(self):
+        """
+        Close both ends of the pipe.
+
+        Returns:
+            None
+        """
+        self.close()
+        os.close(self.write_fd)
@@ -0,0 +1,270 @@
+import collections
+import multiprocessing
+import os
+import random
+import shutil
+import signal
+import tempfile
+import time
+import unittest
+
+from client import Client
+from server import Server
+
+# Map and reduce functions are sent to clients as code, so they may only use builtins and what they import.
+
+
+def count_words_map(key, values):
+    for word in values.split():
+        yield (word, 1)
+
+
+def slow_count_words_map(key, values):
+    for _ in xrange(300000):
+        pass
+    for word in values.split():
+        yield (word, 1)
+
+
+def sum_reduce(key, values):
+    return sum(values)
+
+
+def slow_sum_reduce(key, values):
+    for _ in xrange(20000):
+        pass
+    return sum(values)
+
+
+def run_client(port, workers=0):
+    """
+    Connect a client to the test server on localhost and process tasks until disconnected.
+
+    Args:
+        port (int): Server port number.
+        workers (int): Number of worker processes of the client.
+
+    Returns:
+        None
+    """
+    Client(workers, socket_map={}).connect_to_server("localhost", port)
+
+
+def word_count_data():
+    """
+    Build word count input of 120 entries of 50 lines each, and it's expected results.
+
+    Returns:
+        (dict, dict): Map key to lines of text, and word to number of occurrences.
+    """
+    rand = random.Random(3)
+    lines = [" ".join("w%d" % rand.randint(0, 300) for _ in xrange(rand.randint(0, 20))) for _ in xrange(6000)]
+    data = dict((key, "\n".join(lines[key * 50:(key + 1) * 50])) for key in xrange(120))
+
+    return data, dict(collections.Counter(" ".join(lines).split()))
+
+
+def start_clients(port, count=3, workers=0):
+    """
+    Start clients in processes of their own.
+
+    Args:
+        port (int): Server port number.
+        count (int): Number of clients.
+        workers (int): Number of worker processes of every client.
+
+    Returns:
+        [Process]: Started clients.
+    """
+    clients = [multiprocessing.Process(target=run_client, args=(port, workers)) for _ in xrange(count)]
+    for client in clients:
+        client.start()
+
+    return clients
+
+
+def build_server(map_fn=count_words_map, reduce_fn=sum_reduce, **settings):
+    """
+    Build a word count server bound to a free port on localhost.
+
+    Args:
+        map_fn (Function): Map function.
+        reduce_fn (Function): Reduce function.
+        settings: Server attribute name to value.
+
+    Returns:
+        (Server, int, dict): Server, port number it listens on and expected results.
+    """
+    data, expected = word_count_data()
+
+    server = Server()
+    server.map = map_fn
+    server.reduce = reduce_fn
+    server.data = data
+    for name, value in settings.iteritems():
+        setattr(server, name, value)
+
+    return server, server.bind_server("localhost", 0), expected
+
+
+def run_job(clients=3, workers=0, **settings):
+    """
+    Run a word count job on a server and clients on localhost.
+
+    Args:
+        clients (int): Number of clients.
+        workers (int): Number of worker processes of every client.
+        settings: Map and reduce functions and server attributes, as taken by build_server.
+
+    Returns:
+        (dict, dict, dict): Results, expected results and the server's metric counters.
+    """
+    server, port, expected = build_server(**settings)
+    processes = start_clients(port, clients, workers)
+    results = server.run_server()
+
+    for process in processes:
+        process.join(10)
+
+    return dict(results), expected, server.metrics.snapshot()["counters"]
+
+
+def serve_checkpointed(checkpoint_directory):
+    """
+    Run a slow word count job checkpointed to the given directory, to be killed before it's done.
+
+    Args:
+        checkpoint_directory (str): Directory the job is checkpointed to.
+
+    Returns:
+        None
+    """
+    server, port, _ = build_server(slow_count_words_map, checkpoint_directory=checkpoint_directory,
+                                   checkpoint_sync_interval=0.1, reduce_partitions=8)
+    start_clients(port, 2)
+    server.run_server()
+
+
+class MapChunkingTest(unittest.TestCase):
+    """
+    Map outputs sent in chunks, acknowledged within a small window, give the same results as whole map outputs.
+    """
+    def test_unchunked(self):
+        results, expected, counters = run_job(map_chunk_bytes=0)
+
+        self.assertEqual(results, expected)
+        self.assertNotIn("map.chunks", counters)
+
+    def test_chunked_with_ack_window(self):
+        results, expected, counters = run_job(map_chunk_bytes=7, map_chunk_window=200)
+
+        self.assertEqual(results, expected)
+        self.assertGreater(counters["map.chunks"], counters["map.completed"])
+
+    def test_chunked_from_worker_processes(self):
+        results, expected, counters = run_job(workers=2, map_chunk_bytes=7, map_chunk_window=200)
+
+        self.assertEqual(results, expected)
+        self.assertGreater(counters["map.chunks"], counters["map.completed"])
+
+
+class ShuffleSpillTest(unittest.TestCase):
+    """
+    Map outputs spilled to disk beyond the shuffle memory limit give the same results as those held in memory.
+    """
+    def run_watched(self, **settings):
+        server, port, expected = build_server(**settings)
+        spilled = []
+
+        def tick(tick=server.tick):
+            tick()
+            map_results = server.task_manager.map_results
+            if map_results is not None and map_results.spill_directory is not None:
+                spilled.append(True)
+        server.tick = tick
+
+        processes = start_clients(port)
+        results = server.run_server()
+        for process in processes:
+            process.join(10)
+
+        self.assertEqual(dict(results), expected)
+        return bool(spilled)
+
+    def test_no_spill(self):
+        self.assertFalse(self.run_watched(shuffle_memory_limit=10000000))
+
+    def test_spill(self):
+        self.assertTrue(self.run_watched(shuffle_memory_limit=3000))
+
+    def test_spill_without_merge_worker(self):
+        self.assertTrue(self.run_watched(shuffle_memory_limit=3000, merge_queue_size=0))
+
+
+class PeerShuffleTest(unittest.TestCase):
+    """
+    Map outputs shuffled peer to peer are recreated when a client holding them is killed mid-job.
+    """
+    def test_peer_shuffle(self):
+        results, expected, counters = run_job(peer_shuffle=True)
+
+        self.assertEqual(results, expected)
+
+    def test_client_killed_while_reducing(self):
+        server, port, expected = build_server(reduce_fn=slow_sum_reduce, peer_shuffle=True, reduce_partitions=64)
+        processes = start_clients(port)
+        killed = []
+
+        def tick(tick=server.tick):
+            tick()
+            task_manager = server.task_manager
+            if not killed and task_manager.state == task_manager.REDUCING and len(task_manager.finished_reduces) > 5:
+                os.kill(processes[0].pid, signal.SIGKILL)
+                killed.append(True)
+        server.tick = tick
+
+        results = server.run_server()
+        for process in processes:
+            process.join(10)
+
+        self.assertTrue(killed)
+        self.assertEqual(dict(results), expected)
+        self.assertGreater(server.metrics.snapshot()["counters"]["map.lost"], 0)
+
+
+class CheckpointResumeTest(unittest.TestCase):
+    """
+    A job whose server is killed mid-job resumes from it's checkpoint, even if the last record was cut short.
+    """
+    def setUp(self):
+        self.checkpoint_directory = tempfile.mkdtemp(prefix="checkpoint-test-")
+
+    def tearDown(self):
+        shutil.rmtree(self.checkpoint_directory, ignore_errors=True)
+
+    def test_resume(self):
+        log_path = os.path.join(self.checkpoint_directory, "job-1.log")
+
+        process = multiprocessing.Process(target=serve_checkpointed, args=(self.checkpoint_directory,))
+        process.start()
+        while not os.path.exists(log_path) or os.path.getsize(log_path) < 20000:
+            self.assertTrue(process.is_alive(), "Job finished before the server was killed.")
+            time.sleep(0.05)
+        os.kill(process.pid, signal.SIGKILL)
+        process.join()
+
+        # Cut the last record short, as if the server died mid-append.
+        with open(log_path, "r+b") as log:
+            log.truncate(os.path.getsize(log_path) - 7)
+
+        results, expected, counters = run_job(map_fn=slow_count_words_map, clients=2,
+                                              checkpoint_directory=self.checkpoint_directory, reduce_partitions=8)
+
+        self.assertEqual(results, expected)
+        self.assertGreater(counters["map.restored"], 0)
+        self.assertLess(counters["map.completed"], 120)
+        self.assertFalse(os.path.exists(log_path))
+
+
+if __name__ == "__main__":
+    unittest.main()
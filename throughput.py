@@ -0,0 +1,59 @@
+class ThroughputMeter(object):
+    """
+    ThroughputMeter measures the rate at which a client processes map tasks, in records and bytes per second. Rates
+    are smoothed with an exponentially weighted moving average over finished tasks.
+
+    Each task is timed from when the client reported starting it to when it's results were received, so the rate is
+    that of a single task running on one of the client's workers. Clients with several workers run tasks in flight
+    side by side, and their total throughput is about this rate times their number of workers. A task is sized for one
+    worker, so this per task rate is what input splits are sized by.
+
+    Attributes:
+        records_per_second (float/None): Measured records per second, or None before any task has finished.
+        bytes_per_second (float/None): Measured bytes per second, or None before any task has finished.
+    """
+    # Weight of the latest finished task in the moving averages.
+    SMOOTHING = 0.3
+
+    def __init__(self):
+        """
+        Initialize throughput meter.
+        """
+        self.records_per_second = None
+        self.bytes_per_second = None
+
+    def record(self, started, finished, records, size):
+        """
+        Record a finished task.
+
+        Args:
+            started (float): Time the client started running the task, or the time it was sent to the client if the
+                client did not report starting it.
+            finished (float): Time the task's results were received.
+            records (int): Number of records of the task.
+            size (int): Size of the task's data in bytes.
+
+        Returns:
+            None
+        """
+        elapsed = max(finished - started, 1e-6)
+
+        self.records_per_second = self.average(self.records_per_second, records / elapsed)
+        self.bytes_per_second = self.average(self.bytes_per_second, size / elapsed)
+
+    @staticmethod
+    def average(current, sample):
+        """
+        Fold a sample into a moving average.
+
+        Args:
+            current (float/None): Current average, or None if there is none yet.
+            sample (float): New sample.
+
+        Returns:
+            float: New average.
+        """
+        if current is None:
+            return sample
+
+        return (1 - ThroughputMeter.SMOOTHING) * current + ThroughputMeter.SMOOTHING * sample